@@ -0,0 +1,129 @@
+import pytest
+import selectors
+import socket
+from unittest.mock import Mock, patch
+import protocol  # Framing of the messages
+from registry import Registry  # Sessions of the connected clients
+from timerwheel import TimerWheel  # Deadlines of the clients
+from server import accept, handle, expire_timers  # Importing the functions to be tested from the server module
+from conftest import add_pending, feed  # Helpers shared by the tests
+
+# Fixture to set up a listening socket with one waiting connection
+@pytest.fixture
+def setup_server_and_client():
+    """
+    Fixture to set up a mock listening socket whose 'accept' returns a mock client once,
+    then reports that no more connections are waiting.
+    """
+    client = Mock()  # Create a mock client
+    server = Mock()  # Create a mock listening socket
+    server.accept.side_effect = [(client, ('127.0.0.1', 40000)), BlockingIOError()]
+    return server, client  # Return the mocks to use in tests
+
+# Test 1: Optimal case - the connection is accepted without waiting for the nickname
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.pending', new_callable=list)  # Mocking the sessions to flush at the end of the loop pass
+@patch('server.timers', new_callable=lambda: TimerWheel(0))  # Mocking the deadlines of the clients
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_accept_pending(mock_registry, mock_timers, mock_pending, mock_selector, setup_server_and_client):
+    """
+    Test case where a client connects. It should be tracked as pending with the nickname
+    request queued, without reading from it and without joining the chat yet.
+    """
+    server, client = setup_server_and_client
+
+    accept(server)
+
+    client.recv.assert_not_called()  # accept never waits for the client to answer
+    client.recv_into.assert_not_called()
+    client.setblocking.assert_called_once_with(False)
+    client.setsockopt.assert_called_once_with(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Small messages are not delayed
+    session = mock_registry.get(client)
+    assert session.nickname is None  # The client is waiting for its handshake
+    assert session in mock_timers  # With a deadline to send its nickname
+    assert mock_registry.fanout == []  # But has not joined yet
+    assert list(session.outbox.messages) == [protocol.encode_prompt(protocol.COMPRESSION)]  # The nickname request is queued, offering compression
+    assert mock_pending == [session]  # And sent at the end of the loop pass
+    mock_selector.register.assert_called_once_with(client, selectors.EVENT_READ, session)
+
+# Test 2: The handshake finishes when the nickname arrives
+@patch('server.broadcast')  # Mocking the 'broadcast' function in the server module
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_handshake_join(mock_registry, mock_broadcast, setup_server_and_client):
+    """
+    Test case where a pending client sends its nickname and color. It should join the chat
+    and the others should be told who joined, in that color.
+    """
+    server, client = setup_server_and_client
+    session = add_pending(mock_registry, client)
+    feed(client, protocol.encode_nick('TestUser', protocol.COLORS.index('blue')))
+
+    assert handle(client) is True
+
+    assert session.nickname == "TestUser"  # The client joined with its nickname
+    assert mock_registry.find("TestUser") is session
+    assert mock_registry.fanout == [session]  # And now receives broadcasts
+    assert session.sender == b'\x08TestUser\x04'  # Sent with its messages: length, nickname, color
+    mock_broadcast.assert_called_once_with(protocol.encode(protocol.JOIN, session.sender), client, 'lobby')  # Announced in the default room
+
+# Test 3: A client that never sends its nickname is dropped after the timeout
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.timers', new_callable=lambda: TimerWheel(80))  # Mocking the deadlines of the clients
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+@patch('server.time.monotonic', return_value=100)  # The current time
+def test_handshake_timeout(mock_monotonic, mock_registry, mock_timers, mock_selector, setup_server_and_client):
+    """
+    Test case where one pending client is past its deadline and another is not.
+    Only the late client should be dropped, and the time until the next tick returned.
+    """
+    server, late = setup_server_and_client
+    on_time = Mock()
+    add_pending(mock_registry, late, mock_timers, 90)
+    add_pending(mock_registry, on_time, mock_timers, 105)
+
+    assert expire_timers() == 1  # The wheel ticks every second while it has timers
+
+    late.close.assert_called_once()  # The late client was disconnected
+    assert late not in mock_registry
+    on_time.close.assert_not_called()  # The other one still has time
+    assert on_time in mock_registry
+
+# Test 4: An invalid nickname is refused and asked again
+@patch('protocol.MAX_NICKNAME', 8)  # Longest nickname accepted
+@patch('server.broadcast')  # Mocking the 'broadcast' function in the server module
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_handshake_invalid_nickname(mock_registry, mock_broadcast, setup_server_and_client):
+    """
+    Test case where a pending client sends a nickname that is too long. It should be told
+    why and asked again, without joining the chat.
+    """
+    server, client = setup_server_and_client
+    session = add_pending(mock_registry, client)
+    feed(client, protocol.encode_nick('LongNickname'))
+
+    assert handle(client) is True
+
+    assert session.nickname is None  # Still in its handshake
+    assert list(session.outbox.messages) == [protocol.encode_error("Nicknames are 1 to 8 bytes long"),
+                                             protocol.encode_prompt(protocol.COMPRESSION)]
+    mock_broadcast.assert_not_called()
+
+# Test 5: A nickname that is not UTF-8 is refused and asked again
+@patch('protocol.MAX_NICKNAME', 8)  # Longest nickname accepted
+@patch('server.broadcast')  # Mocking the 'broadcast' function in the server module
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_handshake_nickname_not_utf8(mock_registry, mock_broadcast, setup_server_and_client):
+    """
+    Test case where a pending client sends a nickname that is not valid UTF-8. It should be
+    refused like any other invalid nickname, without stopping the server.
+    """
+    server, client = setup_server_and_client
+    session = add_pending(mock_registry, client)
+    feed(client, protocol.encode(protocol.NICK, b'\xff\xfe\0\x01\x00'))
+
+    assert handle(client) is True
+
+    assert session.nickname is None  # Still in its handshake
+    assert list(session.outbox.messages) == [protocol.encode_error("Nicknames are 1 to 8 bytes long"),
+                                             protocol.encode_prompt(protocol.COMPRESSION)]
+    mock_broadcast.assert_not_called()
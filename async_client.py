@@ -0,0 +1,208 @@
+import argparse
+import asyncio
+import logging
+import random
+import sys
+import async_server
+import client
+import protocol
+
+# Connection problems and reconnections are logged, the terminal shows them too
+log = logging.getLogger('chat.client')
+
+HOST = '127.0.0.1'  # Server host address
+PORT = 55555  # Server port
+
+# Seconds to wait before reconnecting, doubled after every failed attempt up to
+# RECONNECT_MAX. The wait is a random fraction of it, so clients dropped at the
+# same time don't all come back at the same instant
+RECONNECT_MIN = 0.5
+RECONNECT_MAX = 30.0
+
+# Seconds to wait before the reconnection attempt number `attempt` (from 0)
+def backoff(attempt):
+    return random.uniform(0, min(RECONNECT_MAX, RECONNECT_MIN * 2 ** attempt))
+
+# A chat client on an asyncio loop, without a terminal. It answers the nickname
+# request and pings by itself, passes every other message to
+# `on_message(kind, payload)`, and reconnects when the connection is lost.
+# When the server refuses the nickname, `await rename(nickname)` gives another
+# one, or None to give up. Without rename(), a nickname refused on a reconnection
+# is tried again after the usual wait instead. It only holds a reader and a writer, so a single loop
+# can run thousands of them
+class ChatClient:
+    def __init__(self, nickname, color=protocol.DEFAULT_COLOR, host=HOST, port=PORT, on_message=None, reconnect=True,
+                 compression=True, rename=None):
+        self.nickname = nickname
+        self.color = color
+        self.host = host
+        self.port = port
+        self.on_message = on_message or (lambda kind, payload: None)
+        self.reconnect = reconnect
+        self.rename = rename
+        self.renaming = False  # Waiting for rename() to give another nickname
+        self.features = protocol.COMPRESSION if compression else 0  # Sent with the nickname
+        self.compress = False  # Whether the server takes compressed messages, on this connection
+        self.writer = None  # Writer of the current connection, None while disconnected
+        self.joined = asyncio.Event()  # Set once the nickname was sent on the current connection
+        self.stopped = asyncio.Event()  # Set by stop(), cuts a wait before reconnecting short
+        self.connections = 0  # Connections made so far
+
+    # Connect, and connect again whenever the connection is lost, until stop()
+    # is called. Without `reconnect`, returns when the first connection ends
+    async def run(self):
+        attempt = 0
+        while not self.stopped.is_set():
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+            except OSError as error:
+                if not self.reconnect:
+                    raise
+                log.info("Could not connect to %s:%s: %s", self.host, self.port, error)
+            else:
+                self.connections += 1
+                if await self._serve(reader, writer):
+                    attempt = 0  # The server knew us, start over from a short wait
+            if not self.reconnect or self.stopped.is_set():
+                break
+
+            delay = backoff(attempt)
+            attempt += 1
+            log.info("Reconnecting in %.1f seconds", delay)
+            try:
+                await asyncio.wait_for(self.stopped.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    # Handle a connection until it is lost, returns whether the nickname was sent
+    async def _serve(self, reader, writer):
+        self.writer = writer
+        handshake = False
+        try:
+            while True:
+                for kind, frame in protocol.expand([await async_server.read_frame(reader)]):
+                    if kind == protocol.NICK:
+                        self.compress = bool(self.features & protocol.decode_prompt(protocol.payload(frame)))
+                        if self.joined.is_set():
+                            # Asked again, the nickname was refused
+                            self.joined.clear()
+                            self.renaming = True
+                            try:
+                                nickname = await self.rename(self.nickname) if self.rename else None
+                            finally:
+                                self.renaming = False
+                            if nickname is None and self.connections > 1:
+                                # Most likely held by our previous connection, which the server
+                                # has not found dead yet. Try again later with the same one
+                                log.info("The server still has the nickname %s, trying again", self.nickname)
+                                return False
+                            if nickname is None:
+                                log.info("The server refused the nickname %s", self.nickname)
+                                self.stop()
+                                return handshake
+                            self.nickname = nickname
+                        writer.write(protocol.encode_nick(self.nickname, self.color, self.features))
+                        handshake = True
+                        self.joined.set()
+                    elif kind == protocol.PING:  # The server checks we are still here
+                        writer.write(protocol.encode(protocol.PONG))
+                    else:
+                        self.on_message(kind, protocol.payload(frame))
+        except (asyncio.IncompleteReadError, ConnectionError, protocol.FrameError):
+            if not self.stopped.is_set():
+                log.info("Lost the connection to %s:%s", self.host, self.port)
+        finally:
+            self.writer = None
+            self.compress = False
+            self.joined.clear()
+            writer.close()
+        return handshake
+
+    # Send a frame to the server, returns False while disconnected. The write is
+    # buffered by the transport, so it never blocks the loop
+    def send(self, message):
+        if self.writer is None or self.writer.is_closing():
+            return False
+        if self.compress and len(message) >= protocol.COMPRESS_THRESHOLD:
+            message = protocol.compress(message)
+        self.writer.write(message)
+        return True
+
+    # Send a line the way a user types it: a room command or a chat message
+    def say(self, line):
+        return self.send(client.build_message(line))
+
+    # Close the connection and stop reconnecting, run() returns soon after
+    def stop(self):
+        self.stopped.set()
+        if self.writer is not None:
+            self.writer.close()
+
+# Shows lines on the terminal. Lines added in the same pass of the loop, such
+# as a burst of messages read at once, are shown with a single write
+class Terminal:
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self.lines = []
+        self.scheduled = False
+
+    def show(self, line):
+        self.lines.append(line)
+        if not self.scheduled:
+            self.scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        self.scheduled = False
+        if self.lines:
+            self.stream.write('\n'.join(self.lines) + '\n')
+            self.stream.flush()
+            self.lines.clear()
+
+# Run the client in the terminal: lines typed are sent, messages received are
+# shown, both on the same loop
+async def main(nickname, color, host=HOST, port=PORT):
+    terminal = Terminal()
+    nicknames = asyncio.Queue()  # Nicknames typed after the server refused one
+
+    def show(kind, payload):
+        if kind in client.SHOWN:
+            terminal.show(client.render(kind, payload))
+
+    async def rename(refused):
+        terminal.show("Enter another nickname:")
+        return await nicknames.get()
+
+    chat = ChatClient(nickname, color, host, port, on_message=show, rename=rename)
+    runner = asyncio.ensure_future(chat.run())
+
+    # Read the standard input without a thread
+    loop = asyncio.get_running_loop()
+    stdin = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(stdin), sys.stdin)
+    try:
+        while line := await stdin.readline():
+            line = line.decode('utf-8').rstrip('\n')
+            if chat.renaming:
+                nicknames.put_nowait(line)
+            elif not chat.say(line):
+                terminal.show("Not connected to the server, the message was not sent")
+    finally:
+        chat.stop()
+        await runner
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat client on a single asyncio loop")
+    parser.add_argument('--host', default=HOST, help="Address of the server")
+    parser.add_argument('--port', type=int, default=PORT, help="Port of the server")
+    args = parser.parse_args()
+
+    print(client.BANNER)
+    nickname = input("Enter your nickname: ")
+    color = client.color_checker()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    try:
+        asyncio.run(main(nickname, color, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
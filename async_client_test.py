@@ -0,0 +1,255 @@
+import asyncio
+import pytest
+from unittest.mock import Mock, patch
+import async_client
+import async_server  # The server the clients talk to
+import protocol  # Framing of the messages
+from async_client import ChatClient, Terminal  # Importing the client to be tested
+from offline import OfflineQueues  # Direct messages kept for later
+
+
+async def start_server():
+    """Starts the asyncio engine of the server on a free port, returns it and the port."""
+    server = await asyncio.start_server(async_server.handle_connection, '127.0.0.1', 0)
+    return server, server.sockets[0].getsockname()[1]
+
+
+async def wait_for(condition, timeout=2):
+    """Lets the loop run until the condition holds."""
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("The condition never held")
+
+
+# Test 1: The wait before reconnecting grows, up to a limit
+@patch('async_client.random.uniform', side_effect=lambda low, high: high)  # Always the longest wait
+def test_backoff(mock_uniform):
+    """
+    Test case where the client fails to reconnect again and again. The longest wait should
+    double every time until RECONNECT_MAX, and the actual wait be drawn below it.
+    """
+    delays = [async_client.backoff(attempt) for attempt in range(8)]
+
+    assert delays == [0.5, 1, 2, 4, 8, 16, 30, 30]
+    mock_uniform.assert_called_with(0, 30)
+
+
+# Test 2: Headless clients chat through the server
+@patch('async_server.writers', new_callable=dict)  # Mocking 'writers' dictionary in the async_server module
+@patch('async_server.senders', new_callable=dict)  # Mocking 'senders' dictionary in the async_server module
+@patch('async_server.nicknames', new_callable=dict)  # Mocking 'nicknames' dictionary in the async_server module
+def test_headless_chat(mock_nicknames, mock_senders, mock_writers):
+    """
+    Test case where two clients without a terminal join the server and one of them sends a
+    line. The other should be passed the message with its sender, and neither see the
+    nickname request.
+    """
+    async def session():
+        server, port = await start_server()
+        received = {"First": [], "Second": []}
+        clients = [ChatClient(name, 2, port=port, on_message=lambda kind, payload, name=name: received[name].append((kind, bytes(payload))))
+                   for name in received]
+        runners = [asyncio.ensure_future(chat.run()) for chat in clients]
+        await wait_for(lambda: len(mock_senders) == 2)
+
+        assert clients[1].say("hello") is True
+        await wait_for(lambda: (protocol.CHAT, protocol.encode_sender("Second", 2) + b'hello') in received["First"])
+
+        for chat in clients:
+            chat.stop()
+        await asyncio.gather(*runners)
+        server.close()
+        await server.wait_closed()
+        return clients, received
+
+    clients, received = asyncio.run(session())
+
+    assert all(kind != protocol.NICK for messages in received.values() for kind, payload in messages)
+    assert all(chat.connections == 1 for chat in clients)
+    assert clients[0].send(protocol.encode(protocol.TEXT, b'late')) is False  # Disconnected
+
+
+# Test 3: A lost connection is made again
+@patch('async_client.backoff', return_value=0)  # Reconnect at once
+def test_reconnect(mock_backoff):
+    """
+    Test case where the server closes the first connection right after the nickname. The
+    client should connect again and answer the nickname request a second time.
+    """
+    nicks = []
+
+    async def handler(reader, writer):
+        writer.write(protocol.encode(protocol.NICK))
+        kind, frame = await async_server.read_frame(reader)
+        nicks.append(bytes(protocol.payload(frame)))
+        if len(nicks) == 1:
+            writer.close()  # Drop the first connection
+        else:
+            await reader.read()  # Keep the second one until the client leaves
+
+    async def session():
+        server = await asyncio.start_server(handler, '127.0.0.1', 0)
+        chat = ChatClient("TestUser", port=server.sockets[0].getsockname()[1])
+        runner = asyncio.ensure_future(chat.run())
+        await wait_for(lambda: len(nicks) == 2)
+        assert chat.joined.is_set()
+
+        chat.stop()
+        await runner
+        server.close()
+        await server.wait_closed()
+        return chat
+
+    chat = asyncio.run(session())
+
+    assert chat.connections == 2
+    assert nicks == [b'TestUser\0\x07\x01'] * 2
+    mock_backoff.assert_called_once_with(0)  # The server knew us, so the first wait again
+
+
+# Test 4: Stopping cuts the wait before reconnecting short
+@patch('async_client.backoff', return_value=60)  # A long wait
+def test_stop_while_waiting(mock_backoff):
+    """
+    Test case where no server listens and the client is stopped while it waits to try
+    again. It should return at once instead of finishing the wait.
+    """
+    async def session():
+        server, port = await start_server()
+        server.close()
+        await server.wait_closed()  # Nothing listens on the port anymore
+
+        chat = ChatClient("TestUser", port=port)
+        runner = asyncio.ensure_future(chat.run())
+        await wait_for(lambda: mock_backoff.called)
+        chat.stop()
+        await asyncio.wait_for(runner, 1)
+        return chat
+
+    chat = asyncio.run(session())
+
+    assert chat.connections == 0
+
+
+# Test 5: Without reconnecting, a refused connection is raised
+def test_no_reconnect():
+    """
+    Test case where the client must not reconnect and nothing listens on the port. The
+    error should reach the caller.
+    """
+    async def session():
+        server, port = await start_server()
+        server.close()
+        await server.wait_closed()
+        await ChatClient("TestUser", port=port, reconnect=False).run()
+
+    with pytest.raises(OSError):
+        asyncio.run(session())
+
+
+# Test 6: Lines shown in the same loop pass are written at once
+def test_terminal_batching():
+    """
+    Test case where three messages are shown in one pass of the loop, then one in the next.
+    The first three should take a single write, the last one another.
+    """
+    stream = Mock()
+    terminal = Terminal(stream)
+
+    async def burst():
+        for line in ("one", "two", "three"):
+            terminal.show(line)
+        await asyncio.sleep(0)
+        terminal.show("four")
+        await asyncio.sleep(0)
+
+    asyncio.run(burst())
+
+    assert [call.args[0] for call in stream.write.call_args_list] == ["one\ntwo\nthree\n", "four\n"]
+
+
+# Test 7: A refused nickname is replaced by the one rename() gives
+@patch('async_server.offline', new_callable=OfflineQueues)  # Mocking the direct messages kept for later
+@patch('async_server.writers', new_callable=dict)  # Mocking 'writers' dictionary in the async_server module
+@patch('async_server.senders', new_callable=dict)  # Mocking 'senders' dictionary in the async_server module
+@patch('async_server.nicknames', new_callable=dict)  # Mocking 'nicknames' dictionary in the async_server module
+def test_rename(mock_nicknames, mock_senders, mock_writers, mock_offline):
+    """
+    Test case where a client joins with a nickname already taken. It should be asked for
+    another one through rename(), and be told why. A client without rename() gives up.
+    """
+    async def session():
+        server, port = await start_server()
+        errors = []
+        first = ChatClient("TestUser", port=port)
+        runners = [asyncio.ensure_future(first.run())]
+        await wait_for(lambda: "TestUser" in mock_writers)
+
+        async def rename(nickname):
+            return nickname + "2"
+        second = ChatClient("TestUser", port=port, rename=rename,
+                            on_message=lambda kind, payload: errors.append(bytes(payload)) if kind == protocol.ERROR else None)
+        runners.append(asyncio.ensure_future(second.run()))
+        await wait_for(lambda: "TestUser2" in mock_writers)
+
+        third = ChatClient("TestUser", port=port)  # Gives up
+        await asyncio.wait_for(third.run(), 1)
+
+        for chat in (first, second):
+            chat.stop()
+        await asyncio.gather(*runners)
+        server.close()
+        await server.wait_closed()
+        return second, third, errors
+
+    second, third, errors = asyncio.run(session())
+
+    assert second.nickname == "TestUser2"
+    assert errors == [b'The nickname TestUser is already taken']
+    assert third.stopped.is_set() and third.connections == 1
+
+
+# Test 8: A nickname refused on a reconnection is tried again
+@patch('async_client.backoff', return_value=0)  # Reconnect at once
+def test_reconnect_refused(mock_backoff):
+    """
+    Test case where the server drops the connection, then refuses the nickname on the next
+    one because it has not noticed the old connection is gone. A client without rename()
+    should keep waiting longer and trying the same nickname until it is accepted.
+    """
+    nicks = []
+
+    async def handler(reader, writer):
+        writer.write(protocol.encode(protocol.NICK))
+        kind, frame = await async_server.read_frame(reader)
+        nicks.append(bytes(protocol.payload(frame)))
+        if len(nicks) == 1:
+            writer.close()  # Drop the first connection
+        elif len(nicks) == 2:
+            writer.write(protocol.encode_error("The nickname TestUser is already taken"))
+            writer.write(protocol.encode(protocol.NICK))  # Asked again
+            await reader.read()
+        else:
+            await reader.read()  # Keep the third one until the client leaves
+
+    async def session():
+        server = await asyncio.start_server(handler, '127.0.0.1', 0)
+        chat = ChatClient("TestUser", port=server.sockets[0].getsockname()[1])
+        runner = asyncio.ensure_future(chat.run())
+        await wait_for(lambda: len(nicks) == 3)
+        assert chat.joined.is_set()
+        assert not chat.stopped.is_set()
+
+        chat.stop()
+        await runner
+        server.close()
+        await server.wait_closed()
+        return chat
+
+    chat = asyncio.run(session())
+
+    assert chat.connections == 3
+    assert nicks == [b'TestUser\0\x07\x01'] * 3
+    assert [call.args[0] for call in mock_backoff.call_args_list] == [0, 1]  # The refusal made the wait longer
@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import socket
+import time
+from collections import deque
+import protocol
+from logger import Payload
+from offline import OfflineQueues
+
+# Messages about every single chat message are logged at DEBUG, off by default
+log = logging.getLogger('chat.async')
+
+# Maximum amount of data allowed to pile up for a single client before it is
+# considered stuck and disconnected (instead of slowing everyone else down)
+WRITE_BUFFER_LIMIT = 1024 * 1024
+
+# Writers of the connected clients and their nicknames
+nicknames = {}
+
+# Writers of the connected clients and the sender part of their messages
+senders = {}
+
+# Nicknames of the connected clients and their writers, to find the recipient of a direct message
+writers = {}
+
+# Direct messages waiting for their recipient to join, replaced by the queues serve() is given
+offline = OfflineQueues()
+
+# Senders of the clients dropped for not reading whose departure is still to be announced
+departures = deque()
+
+# Function to remove and disconnect clients
+def remove(writer):
+    if writer in nicknames:
+        log.info("Client %s has disconnected", nicknames[writer])
+        writers.pop(nicknames.pop(writer), None)
+    senders.pop(writer, None)
+    writer.close()
+
+# Broadcast messages to all clients (announcement)
+def broadcast(message, sender=None):
+    # List of problematic clients
+    clients_to_remove = []
+
+    for writer in nicknames:
+        if writer != sender and not writer.is_closing():
+            # The write is buffered by the transport, so it never blocks the loop
+            if writer.transport.get_write_buffer_size() > WRITE_BUFFER_LIMIT:
+                clients_to_remove.append(writer)
+            else:
+                writer.write(message)
+
+    # Remove clients that stopped reading their messages
+    for writer in clients_to_remove:
+        # It may have been dropped by the leave message of another one meanwhile
+        if writer in nicknames:
+            disconnect(writer)
+
+# Remove a client that stopped reading its messages, and tell the others
+def disconnect(writer):
+    sender = senders.get(writer)
+    remove(writer)
+    if sender is None:
+        return
+
+    departures.append(sender)
+    if len(departures) > 1:
+        # The disconnect() already telling the others tells them this one too. Telling
+        # them here could drop more clients, and recurse once for each of them
+        return
+    while departures:
+        broadcast(protocol.encode_leave(departures[0]))
+        departures.popleft()
+
+# Read a single frame, returns its type and the whole frame
+async def read_frame(reader):
+    header = await reader.readexactly(protocol.HEADER.size)
+    length, kind = protocol.HEADER.unpack(header)
+    if length > protocol.MAX_MESSAGE_SIZE:
+        raise protocol.FrameError(f"Frame of {length} bytes is over the limit of {protocol.MAX_MESSAGE_SIZE}")
+    return kind, header + await reader.readexactly(length)
+
+# Handle a client from the nickname request until it disconnects
+async def handle_connection(reader, writer):
+    address = writer.get_extra_info('peername')
+    log.info("Address %s connected", address)
+
+    try:
+        # Request the client's nickname, until it sends a valid one nobody uses
+        while True:
+            writer.write(protocol.encode(protocol.NICK))
+            kind = None
+            while kind != protocol.NICK:
+                kind, frame = await read_frame(reader)
+            try:
+                nickname, color = protocol.decode_nick(protocol.payload(frame))
+            except UnicodeDecodeError:
+                # Refused like any other invalid nickname
+                nickname, color = '', protocol.DEFAULT_COLOR
+            if not protocol.valid_nickname(nickname):
+                writer.write(protocol.encode_error(f"Nicknames are 1 to {protocol.MAX_NICKNAME} bytes long"))
+            elif nickname in writers:
+                writer.write(protocol.encode_error(f"The nickname {nickname} is already taken"))
+            else:
+                break
+    except (asyncio.IncompleteReadError, ConnectionError, protocol.FrameError):
+        writer.close()
+        return
+    except asyncio.CancelledError:
+        # The server is stopping
+        writer.close()
+        raise
+    nicknames[writer] = nickname
+    writers[nickname] = writer
+    sender = senders[writer] = protocol.encode_sender(nickname, color)
+
+    # Direct messages sent while it was away
+    for message in offline.take(nickname, time.monotonic()):
+        writer.write(message)
+
+    # Announce the new connection
+    log.info("The client's nickname is '%s'", nickname)
+    broadcast(protocol.encode_join(sender), writer)
+
+    try:
+        while writer in nicknames:
+            kind, frame = await read_frame(reader)
+            if kind == protocol.TEXT:
+                text = protocol.payload(frame)
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug("Received %s from %s", Payload(text), nickname)
+                if len(text) + len(sender) > protocol.MAX_MESSAGE_SIZE:
+                    writer.write(protocol.encode_error("Message too long"))
+                else:
+                    # The sender comes from the connection, whatever the client wrote in the text
+                    broadcast(protocol.encode_chat(sender, text), writer)
+            elif kind == protocol.MSG:
+                direct(writer, sender, protocol.payload(frame))
+            elif kind in (protocol.ROOM_JOIN, protocol.ROOM_LEAVE, protocol.ROOM_LIST):
+                # Everybody shares a single room in this engine
+                writer.write(protocol.encode_error("Rooms are not supported by this server"))
+            elif kind == protocol.PING:
+                # This engine does not ping, but answers the clients that do
+                writer.write(protocol.encode(protocol.PONG))
+
+    except asyncio.IncompleteReadError:
+        # Client exited cleanly
+        pass
+
+    except (ConnectionError, protocol.FrameError) as error:
+        log.warning("Error receiving data from a client: %s", error)
+
+    finally:
+        # Whatever ended the connection, the nickname is freed and the others told.
+        # The client may have already been dropped by broadcast()
+        if writer in nicknames:
+            broadcast(protocol.encode_leave(sender), writer)
+            remove(writer)
+
+# Send a direct message to the client using a nickname, or keep it until the nickname joins
+def direct(writer, sender, payload):
+    try:
+        nickname, text = protocol.decode_msg(payload)
+    except UnicodeDecodeError:
+        # Refused like a message without a nickname
+        nickname, text = '', b''
+    if not protocol.valid_nickname(nickname) or not text:
+        writer.write(protocol.encode_error("Direct messages need a nickname and a text: /msg <nickname> <text>"))
+    elif writers.get(nickname) is writer:
+        writer.write(protocol.encode_error("You can't send a direct message to yourself"))
+    elif len(text) + len(sender) > protocol.MAX_MESSAGE_SIZE:
+        writer.write(protocol.encode_error("Message too long"))
+    elif nickname in writers:
+        recipient = writers[nickname]
+        if recipient.transport.get_write_buffer_size() > WRITE_BUFFER_LIMIT:
+            # Stopped reading its messages, like in broadcast()
+            disconnect(recipient)
+        else:
+            recipient.write(protocol.encode_direct(sender, text))
+    elif offline.put(nickname, protocol.encode_direct(sender, text), time.monotonic()):
+        writer.write(protocol.encode_text(f"{nickname} is not connected, the message will be delivered when they join"))
+    else:
+        writer.write(protocol.encode_error(f"{nickname} is not connected"))
+
+# Serve clients on an already bound and listening socket, keeping the direct
+# messages for nicknames that are not connected in the given queues
+async def serve(server, queues):
+    global offline
+    offline = queues
+    # Keep the listen backlog large enough for connection storms
+    async_server = await asyncio.start_server(handle_connection, sock=server, backlog=socket.SOMAXCONN)
+    async with async_server:
+        try:
+            await async_server.serve_forever()
+        finally:
+            # Stopping the server also hangs up on the clients
+            for writer in list(nicknames):
+                remove(writer)
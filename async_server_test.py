@@ -0,0 +1,274 @@
+import asyncio
+from collections import deque
+import pytest
+from unittest.mock import Mock, patch
+import async_server  # Importing the asyncio engine of the server
+import protocol  # Framing of the messages
+from offline import OfflineQueues  # Direct messages kept for later
+
+
+async def connect(port, nickname):
+    """Connects a client to the asyncio server and answers the nickname request."""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    assert await reader.readexactly(protocol.HEADER.size) == protocol.encode(protocol.NICK)  # The server asks for the nickname first
+    writer.write(protocol.encode_nick(nickname, protocol.COLORS.index('green')))
+    await writer.drain()
+    return reader, writer
+
+
+async def receive(reader, timeout=1):
+    """Receives the next message, as a whole frame."""
+    kind, frame = await asyncio.wait_for(async_server.read_frame(reader), timeout)
+    return frame
+
+
+async def chat_session():
+    """Runs two clients against a server on a free port and returns what each received."""
+    server = await asyncio.start_server(async_server.handle_connection, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+
+    reader1, writer1 = await connect(port, "Client1")
+    await asyncio.sleep(0.1)
+    reader2, writer2 = await connect(port, "Client2")
+
+    # Client1 hears about Client2 joining
+    joined = await receive(reader1)
+
+    # Client2 sends a message that only Client1 should receive
+    writer2.write(protocol.encode(protocol.TEXT, b'Hello from Client2'))
+    await writer2.drain()
+    message = await receive(reader1)
+
+    # Nothing was echoed back to Client2
+    with pytest.raises(asyncio.TimeoutError):
+        await receive(reader2, 0.2)
+
+    # Client2 leaves and Client1 is told about it
+    writer2.close()
+    left = await receive(reader1)
+
+    writer1.close()
+    server.close()
+    await server.wait_closed()
+    return joined, message, left
+
+
+# Test 1: Optimal case - join, message and leave reach the other client only
+@patch('async_server.writers', new_callable=dict)  # Mocking 'writers' dictionary in the async_server module
+@patch('async_server.senders', new_callable=dict)  # Mocking 'senders' dictionary in the async_server module
+@patch('async_server.nicknames', new_callable=dict)  # Mocking 'nicknames' dictionary in the async_server module
+def test_async_chat_session(mock_nicknames, mock_senders, mock_writers):
+    """
+    Test case where two clients connect to the asyncio engine. The protocol should match the
+    select engine: NICK prompt, join/leave announcements and no echo to the sender.
+    """
+    joined, message, left = asyncio.run(chat_session())
+
+    sender = protocol.encode_sender("Client2", protocol.COLORS.index('green'))  # Who sent them, and in which color
+    assert joined == protocol.encode_join(sender)  # The join announcement reached Client1
+    assert message == protocol.encode_chat(sender, b'Hello from Client2')  # The message reached Client1
+    assert left == protocol.encode_leave(sender)  # The leave announcement reached Client1
+
+
+# Test 2: A client that stops reading is dropped instead of buffering forever
+@patch('async_server.senders', new_callable=dict)  # Mocking 'senders' dictionary in the async_server module
+@patch('async_server.nicknames', new_callable=dict)  # Mocking 'nicknames' dictionary in the async_server module
+def test_async_broadcast_slow_client(mock_nicknames, mock_senders):
+    """
+    Test case where a client has more data waiting than the write buffer limit.
+    The client should be removed and the others told that it left.
+    """
+    slow, fast = Mock(), Mock()
+    slow.is_closing.return_value = False
+    fast.is_closing.return_value = False
+    slow.transport.get_write_buffer_size.return_value = async_server.WRITE_BUFFER_LIMIT + 1
+    fast.transport.get_write_buffer_size.return_value = 0
+    mock_nicknames[slow] = "Slow"
+    mock_nicknames[fast] = "Fast"
+    mock_senders[slow] = protocol.encode_sender("Slow")
+    mock_senders[fast] = protocol.encode_sender("Fast")
+
+    async_server.broadcast(b'Hello')
+
+    slow.write.assert_not_called()  # Nothing more is queued for the stuck client
+    slow.close.assert_called_once()  # The stuck client is disconnected
+    assert slow not in mock_nicknames
+    fast.write.assert_any_call(b'Hello')  # The other client still gets the message
+    fast.write.assert_any_call(protocol.encode_leave(protocol.encode_sender("Slow")))  # And hears that the stuck client left
+
+
+async def direct_session():
+    """
+    Runs a client sending direct messages to a connected client and to one that joins later,
+    and a client trying a nickname already taken. Returns what the recipients received.
+    """
+    server = await asyncio.start_server(async_server.handle_connection, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    reader1, writer1 = await connect(port, "Client1")
+
+    # The nickname is taken, the second client is asked again
+    reader2, writer2 = await connect(port, "Client1")
+    taken = await receive(reader2)
+    assert await receive(reader2) == protocol.encode(protocol.NICK)
+    writer2.write(protocol.encode_nick("Client2"))
+    assert await receive(reader1) == protocol.encode_join(protocol.encode_sender("Client2"))
+
+    writer1.write(protocol.encode_msg("Client2", "just for you"))
+    writer1.write(protocol.encode_msg("Later", "see you"))
+    direct = await receive(reader2)
+    notice = await receive(reader1)
+
+    reader3, writer3 = await connect(port, "Later")
+    delivered = await receive(reader3)
+
+    for writer in (writer1, writer2, writer3):
+        writer.close()
+    server.close()
+    await server.wait_closed()
+    return taken, direct, notice, delivered
+
+
+# Test 3: Direct messages only reach their recipient, even one that joins later
+@patch('async_server.offline', new_callable=OfflineQueues)  # Mocking the direct messages kept for later
+@patch('async_server.writers', new_callable=dict)  # Mocking 'writers' dictionary in the async_server module
+@patch('async_server.senders', new_callable=dict)  # Mocking 'senders' dictionary in the async_server module
+@patch('async_server.nicknames', new_callable=dict)  # Mocking 'nicknames' dictionary in the async_server module
+def test_async_direct(mock_nicknames, mock_senders, mock_writers, mock_offline):
+    """
+    Test case where a client sends a direct message to another client, and one to a nickname
+    nobody uses yet. The first should reach its recipient only, the second be kept until
+    the nickname joins. A client using a taken nickname should be asked for another one.
+    """
+    taken, direct, notice, delivered = asyncio.run(direct_session())
+
+    sender = protocol.encode_sender("Client1", protocol.COLORS.index('green'))
+    assert taken == protocol.encode_error("The nickname Client1 is already taken")
+    assert direct == protocol.encode_direct(sender, b'just for you')
+    assert notice == protocol.encode_text("Later is not connected, the message will be delivered when they join")
+    assert delivered == protocol.encode_direct(sender, b'see you')
+    assert len(mock_offline) == 0
+
+
+async def invalid_nickname_session():
+    """
+    Runs a client that answers the nickname request with bytes that are not UTF-8, then with
+    a valid nickname. Returns what it received before joining.
+    """
+    server = await asyncio.start_server(async_server.handle_connection, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    assert await receive(reader) == protocol.encode(protocol.NICK)
+    writer.write(protocol.encode(protocol.NICK, b'\xff\xfe\0\x01\x00'))
+    refused = await receive(reader)
+    prompt = await receive(reader)
+    writer.write(protocol.encode_nick("Client1"))
+    await asyncio.sleep(0.1)
+    joined = list(async_server.writers)
+
+    writer.close()
+    server.close()
+    await server.wait_closed()
+    return refused, prompt, joined
+
+
+# Test 4: A nickname that is not UTF-8 is refused and asked again
+@patch('async_server.writers', new_callable=dict)  # Mocking 'writers' dictionary in the async_server module
+@patch('async_server.senders', new_callable=dict)  # Mocking 'senders' dictionary in the async_server module
+@patch('async_server.nicknames', new_callable=dict)  # Mocking 'nicknames' dictionary in the async_server module
+def test_async_nickname_not_utf8(mock_nicknames, mock_senders, mock_writers):
+    """
+    Test case where a client sends a nickname that is not valid UTF-8. It should be refused
+    like any other invalid nickname, and join with the next one it sends.
+    """
+    refused, prompt, joined = asyncio.run(invalid_nickname_session())
+
+    assert refused == protocol.encode_error(f"Nicknames are 1 to {protocol.MAX_NICKNAME} bytes long")
+    assert prompt == protocol.encode(protocol.NICK)
+    assert joined == ["Client1"]
+
+
+async def invalid_direct_session():
+    """
+    Runs a client sending a direct message to a nickname that is not UTF-8, then leaving, and
+    another client taking its nickname afterwards. Returns what the first one was told and
+    whether the second one joined.
+    """
+    server = await asyncio.start_server(async_server.handle_connection, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    reader1, writer1 = await connect(port, "Client1")
+    writer1.write(protocol.encode(protocol.MSG, b'\xff\xfe\0hello'))
+    refused = await receive(reader1)
+    writer1.close()
+    await asyncio.sleep(0.1)
+
+    reader2, writer2 = await connect(port, "Client1")
+    await asyncio.sleep(0.1)
+    joined = "Client1" in async_server.writers
+
+    writer2.close()
+    server.close()
+    await server.wait_closed()
+    return refused, joined
+
+
+# Test 5: A direct message to a nickname that is not UTF-8 is refused
+@patch('async_server.writers', new_callable=dict)  # Mocking 'writers' dictionary in the async_server module
+@patch('async_server.senders', new_callable=dict)  # Mocking 'senders' dictionary in the async_server module
+@patch('async_server.nicknames', new_callable=dict)  # Mocking 'nicknames' dictionary in the async_server module
+def test_async_direct_not_utf8(mock_nicknames, mock_senders, mock_writers):
+    """
+    Test case where a client sends a direct message whose nickname is not valid UTF-8, then
+    leaves. It should be told why, and its nickname be free once it left.
+    """
+    refused, joined = asyncio.run(invalid_direct_session())
+
+    assert refused == protocol.encode_error("Direct messages need a nickname and a text: /msg <nickname> <text>")
+    assert joined
+
+
+class BufferingWriter:
+    """A writer whose transport keeps everything written to it, as a client that never reads."""
+
+    def __init__(self, buffered):
+        self.buffered = buffered
+        self.closed = False
+        self.transport = self
+
+    def get_write_buffer_size(self):
+        return self.buffered
+
+    def write(self, data):
+        self.buffered += len(data)
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+
+# Test 6: Clients dropped one after the other by the leave messages do not recurse
+@patch('async_server.departures', new_callable=deque)  # Mocking the departures still to be announced
+@patch('async_server.senders', new_callable=dict)  # Mocking 'senders' dictionary in the async_server module
+@patch('async_server.nicknames', new_callable=dict)  # Mocking 'nicknames' dictionary in the async_server module
+def test_async_disconnect_cascade(mock_nicknames, mock_senders, mock_departures):
+    """
+    Test case where every client's buffer has room for one message less than the next
+    one's, so each leave message takes one more client over the limit. All of them should
+    be removed, without going deeper in the stack for each one.
+    """
+    count = 1500  # More than the recursion limit
+    message = protocol.encode_leave(protocol.encode_sender("U00000"))  # As long as every leave message
+    writers = []
+    for number in range(count):
+        # Over the limit once it got `number` messages
+        writer = BufferingWriter(async_server.WRITE_BUFFER_LIMIT - number * len(message) + 1)
+        mock_nicknames[writer] = f"U{number:05d}"
+        mock_senders[writer] = protocol.encode_sender(f"U{number:05d}")
+        writers.append(writer)
+
+    async_server.broadcast(message)
+
+    assert not mock_nicknames
+    assert all(writer.closed for writer in writers)
+    assert not mock_departures
@@ -0,0 +1,839 @@
+"""
+Benchmarks for the chat server.
+
+Each benchmark that needs a server starts server.py in a subprocess on a free
+port, drives all the clients from a single asyncio loop, and reports the memory
+the server used (resident and peak, workers included).
+
+fanout: connects many clients once per engine and measures how fast the
+messages of one client reach all the others (throughput and tail latency).
+
+    python benchmark.py fanout --clients 1000 --messages 50 --json bench_output.txt
+
+With --workers the select engine is also run with several processes sharing the
+port, to see how the delivery rate scales with them:
+
+    python benchmark.py fanout --engines select --workers 1 2 4 --interval 0
+
+connect: opens a storm of connections at once, some of which never send their
+nickname, and measures how fast the server accepts them (time until each one
+gets the nickname request).
+
+    python benchmark.py connect --clients 5000 --silent 0.1
+
+wakeup: measures how long the event loop takes to notice one ready socket while
+many others are idle, with select.select (the old loop) and with the selector
+server.py uses now.
+
+    python benchmark.py wakeup --connections 100 1000 10000
+
+syscalls: runs the fan-out against the select engine with its stats socket, and
+reports the event loop wakeups, recv and send calls and changes of the watched
+events per delivered message (how well the writes are coalesced).
+
+    python benchmark.py syscalls --clients 1000 --messages 50 --interval 0
+
+history: measures what recording a broadcast in the history costs, in memory
+only and with the memory-mapped log, per message size.
+
+    python benchmark.py history --sizes 64 1024 16384
+
+timers: measures what the timer wheel costs per tick with many idle clients,
+whose deadlines keep being moved by their activity.
+
+    python benchmark.py timers --timers 1000 10000 100000
+
+load: connects thousands of clients spread over rooms, many of which send
+messages at a steady rate, and measures the connect rate, the messages
+delivered per second and the delivery latency under that load.
+
+    python benchmark.py load --clients 2000 --senders 200 --rooms 20 --rate 1
+
+flood: has a few clients send as fast as they can while others send at a steady
+rate, and measures the delivery latency of the steady senders' messages, to see
+whether the flooders delay everybody else. The rate limits are turned off unless
+--limits is given, to measure the fairness of the event loop alone.
+
+    python benchmark.py flood --clients 500 --flooders 5 --senders 50 --rate 2
+
+With --json the results are written with the revision and settings they were
+measured with, and compare shows the difference between two such files:
+
+    python benchmark.py --json before.json load
+    python benchmark.py --json after.json load
+    python benchmark.py compare before.json after.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import re
+import resource
+import select
+import selectors
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import async_server
+import protocol
+from history import History, MessageLog
+from metrics import read_stats
+from timerwheel import TimerWheel
+
+HOST = '127.0.0.1'  # Server host address
+
+# Benchmark messages carry their sequence number and send time
+BENCH_MESSAGE = re.compile(rb'bench (\d+) (\d+)')
+
+# The fan-out benchmarks send faster than a client is allowed to by default
+UNLIMITED = ['--message-rate', '0', '--byte-rate', '0']
+
+# Counters of the server's stats socket that count system calls
+SYSCALL_COUNTERS = ('wakeups', 'recv_calls', 'send_calls', 'poll_changes')
+
+
+class BenchClient:
+    """A chat client that records the latency of every benchmark message it receives."""
+
+    def __init__(self, nickname):
+        self.nickname = nickname
+        self.latencies = []  # Nanoseconds between send and receive of each message
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, port, retries=50):
+        """Connects to the server and answers the nickname request."""
+        for attempt in range(retries):
+            try:
+                self.reader, self.writer = await asyncio.open_connection(HOST, port)
+                break
+            except ConnectionRefusedError:
+                # The server is still starting
+                await asyncio.sleep(0.1)
+        else:
+            raise ConnectionRefusedError(f"Could not connect to {HOST}:{port}")
+
+        await async_server.read_frame(self.reader)  # Receive the 'NICK' prompt
+        self.writer.write(protocol.encode_nick(self.nickname))
+        await self.writer.drain()
+
+    async def listen(self):
+        """Reads until the connection is closed, timestamping benchmark messages."""
+        while True:
+            try:
+                kind, frame = await async_server.read_frame(self.reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                return
+            now = time.perf_counter_ns()
+            if kind == protocol.PING:
+                # Quiet clients would be dropped otherwise
+                self.writer.write(protocol.encode(protocol.PONG))
+                continue
+
+            if kind != protocol.CHAT:
+                continue
+            nickname, color, text = protocol.decode_sender(protocol.payload(frame))
+            match = BENCH_MESSAGE.match(text)
+            if match:
+                self.latencies.append(now - int(match.group(2)))
+
+    def send(self, message):
+        self.writer.write(message)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def percentile(values, fraction):
+    """Returns the value below which `fraction` of the sorted `values` fall."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def connect_all(bench_clients, port, listeners):
+    """Connects the clients and starts listening on each, returns the seconds it took."""
+    # Connect the first client alone to wait for the server to come up
+    await bench_clients[0].connect(port)
+    listeners.append(asyncio.ensure_future(bench_clients[0].listen()))
+
+    # Connect the rest a few at a time so the listen backlog is never exceeded
+    limit = asyncio.Semaphore(50)
+
+    async def connect(client):
+        async with limit:
+            await client.connect(port)
+        listeners.append(asyncio.ensure_future(client.listen()))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(connect(client) for client in bench_clients[1:]))
+    return time.perf_counter() - started
+
+
+def latency_summary(latencies):
+    """Returns the p50/p99/p999 of the sorted latencies (nanoseconds) in milliseconds."""
+    to_ms = lambda value: None if value is None else round(value / 1e6, 3)
+    return {
+        'latency_p50_ms': to_ms(percentile(latencies, 0.50)),
+        'latency_p99_ms': to_ms(percentile(latencies, 0.99)),
+        'latency_p999_ms': to_ms(percentile(latencies, 0.999)),
+    }
+
+
+async def run_fanout(port, clients, messages, interval, timeout, stats=None):
+    """
+    Connects `clients` clients and sends `messages` messages from the first one. With the
+    path of the server's stats socket, also counts its system calls per delivered message.
+    """
+    bench_clients = [BenchClient(f"bench{i}") for i in range(clients)]
+    listeners = []
+    connect_time = await connect_all(bench_clients, port, listeners)
+
+    # Let the join announcements drain before measuring
+    await asyncio.sleep(1)
+    for client in bench_clients:
+        client.latencies.clear()
+
+    sender, receivers = bench_clients[0], bench_clients[1:]
+    expected = messages * len(receivers)
+    before = read_stats(stats)['counters'] if stats else None
+
+    started = time.perf_counter()
+    for sequence in range(messages):
+        sender.send(protocol.encode(protocol.TEXT, f"bench {sequence} {time.perf_counter_ns()}".encode('utf-8')))
+        await sender.writer.drain()
+        if interval:
+            await asyncio.sleep(interval)
+
+    # Wait until every receiver got every message (or give up)
+    deadline = started + timeout
+    while time.perf_counter() < deadline:
+        if sum(len(client.latencies) for client in receivers) >= expected:
+            break
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    after = read_stats(stats)['counters'] if stats else None
+
+    for client in bench_clients:
+        client.close()
+    for listener in listeners:
+        listener.cancel()
+
+    latencies = sorted(latency for client in receivers for latency in client.latencies)
+    delivered = len(latencies)
+    syscalls = {}
+    if stats and delivered:
+        syscalls = {f"{name}_per_message": round((after[name] - before[name]) / delivered, 4)
+                    for name in SYSCALL_COUNTERS}
+    return {
+        'clients': clients,
+        'messages': messages,
+        'expected': expected,
+        'delivered': delivered,
+        'connect_seconds': round(connect_time, 3),
+        'connects_per_second': round((clients - 1) / connect_time, 1) if connect_time else None,
+        'elapsed_seconds': round(elapsed, 3),
+        'deliveries_per_second': round(delivered / elapsed, 1) if elapsed else None,
+        **latency_summary(latencies),
+        **syscalls,
+    }
+
+
+async def run_load(port, clients, senders, rooms, rate, duration, timeout):
+    """
+    Connects `clients` clients spread over `rooms` rooms, then has the first `senders`
+    of them send `rate` messages per second each for `duration` seconds.
+    """
+    bench_clients = [BenchClient(f"load{i}") for i in range(clients)]
+    listeners = []
+    connect_time = await connect_all(bench_clients, port, listeners)
+
+    # Client i goes to room i % rooms, so the senders are spread over the rooms too
+    members = [0] * rooms
+    for index, client in enumerate(bench_clients):
+        members[index % rooms] += 1
+        if rooms > 1:
+            client.send(protocol.encode(protocol.ROOM_JOIN, f"room{index % rooms}".encode('utf-8')))
+
+    # Let the join announcements drain before measuring
+    await asyncio.sleep(1)
+    for client in bench_clients:
+        client.latencies.clear()
+
+    sent = [0] * senders
+
+    async def send(index):
+        sender = bench_clients[index]
+        # Start at a random point of the period so the senders do not all send at once
+        await asyncio.sleep(random.random() / rate)
+        deadline = time.perf_counter() + duration
+        while time.perf_counter() < deadline:
+            sender.send(protocol.encode(protocol.TEXT, f"bench {sent[index]} {time.perf_counter_ns()}".encode('utf-8')))
+            sent[index] += 1
+            await sender.writer.drain()
+            await asyncio.sleep(1 / rate)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(send(index) for index in range(senders)))
+
+    # Every message reaches the rest of the sender's room
+    expected = sum(count * (members[index % rooms] - 1) for index, count in enumerate(sent))
+    deadline = started + duration + timeout
+    while time.perf_counter() < deadline:
+        if sum(len(client.latencies) for client in bench_clients) >= expected:
+            break
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+
+    for client in bench_clients:
+        client.close()
+    for listener in listeners:
+        listener.cancel()
+
+    latencies = sorted(latency for client in bench_clients for latency in client.latencies)
+    delivered = len(latencies)
+    return {
+        'clients': clients,
+        'senders': senders,
+        'rooms': rooms,
+        'sent': sum(sent),
+        'expected': expected,
+        'delivered': delivered,
+        'connect_seconds': round(connect_time, 3),
+        'connects_per_second': round((clients - 1) / connect_time, 1) if connect_time else None,
+        'elapsed_seconds': round(elapsed, 3),
+        'deliveries_per_second': round(delivered / elapsed, 1) if elapsed else None,
+        **latency_summary(latencies),
+    }
+
+
+async def run_flood(port, clients, flooders, senders, rate, duration, timeout):
+    """
+    Connects `clients` clients. The first `flooders` of them move to a room of their own
+    and send as fast as the server reads, the next `senders` send `rate` messages per
+    second each to the lobby, all for `duration` seconds. Only the latency of the steady
+    senders' messages is measured: the flood costs the server, but never waits in the
+    lobby's buffers.
+    """
+    bench_clients = [BenchClient(f"flood{i}") for i in range(clients)]
+    listeners = []
+    connect_time = await connect_all(bench_clients, port, listeners)
+    for flooder in bench_clients[:flooders]:
+        flooder.send(protocol.encode(protocol.ROOM_JOIN, b'flood'))
+
+    # Let the join announcements drain before measuring
+    await asyncio.sleep(1)
+    for client in bench_clients:
+        client.latencies.clear()
+
+    flooded = [0] * flooders
+    sent = [0] * senders
+    disconnected = []
+    batch = protocol.encode(protocol.TEXT, b'flood' * 20) * 100
+
+    async def flood(index):
+        flooder = bench_clients[index]
+        deadline = time.perf_counter() + duration
+        try:
+            while time.perf_counter() < deadline:
+                flooder.send(batch)
+                flooded[index] += 100
+                await flooder.writer.drain()
+        except ConnectionError:
+            # Dropped by the server (rate limits, or too slow to read the others' floods)
+            disconnected.append(flooder)
+
+    async def send(index):
+        sender = bench_clients[flooders + index]
+        await asyncio.sleep(random.random() / rate)
+        deadline = time.perf_counter() + duration
+        try:
+            while time.perf_counter() < deadline:
+                sender.send(protocol.encode(protocol.TEXT, f"bench {sent[index]} {time.perf_counter_ns()}".encode('utf-8')))
+                sent[index] += 1
+                await sender.writer.drain()
+                await asyncio.sleep(1 / rate)
+        except ConnectionError:
+            disconnected.append(sender)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(flood(index) for index in range(flooders)),
+                         *(send(index) for index in range(senders)))
+
+    expected = sum(sent) * (clients - flooders - 1)
+    deadline = started + duration + timeout
+    while time.perf_counter() < deadline:
+        if sum(len(client.latencies) for client in bench_clients) >= expected:
+            break
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+
+    for client in bench_clients:
+        client.close()
+    for listener in listeners:
+        listener.cancel()
+
+    latencies = sorted(latency for client in bench_clients for latency in client.latencies)
+    return {
+        'clients': clients,
+        'flooders': flooders,
+        'senders': senders,
+        'flood_sent': sum(flooded),
+        'disconnected': len(disconnected),
+        'sent': sum(sent),
+        'expected': expected,
+        'delivered': len(latencies),
+        'elapsed_seconds': round(elapsed, 3),
+        **latency_summary(latencies),
+    }
+
+
+async def run_connect_storm(port, clients, silent, concurrency):
+    """Opens `clients` connections at once, a `silent` fraction of them never answering."""
+    chooser = random.Random(0)
+    silent_clients = {index for index in range(clients) if chooser.random() < silent}
+    limit = asyncio.Semaphore(concurrency)
+    writers = []
+
+    async def connect(index):
+        async with limit:
+            started = time.perf_counter()
+            for attempt in range(50):
+                try:
+                    reader, writer = await asyncio.open_connection(HOST, port)
+                    break
+                except ConnectionRefusedError:
+                    # The server is still starting
+                    await asyncio.sleep(0.1)
+                    started = time.perf_counter()
+            else:
+                raise ConnectionRefusedError(f"Could not connect to {HOST}:{port}")
+            writers.append(writer)
+
+            # The nickname request only arrives once the server accepted the connection
+            await async_server.read_frame(reader)
+            accepted = time.perf_counter_ns() - int(started * 1e9)
+            if index not in silent_clients:
+                writer.write(protocol.encode_nick(f"storm{index}"))
+            return accepted
+
+    started = time.perf_counter()
+    delays = sorted(await asyncio.gather(*(connect(index) for index in range(clients))))
+    elapsed = time.perf_counter() - started
+
+    for writer in writers:
+        writer.close()
+
+    to_ms = lambda value: None if value is None else round(value / 1e6, 3)
+    return {
+        'clients': clients,
+        'silent': len(silent_clients),
+        'elapsed_seconds': round(elapsed, 3),
+        'connects_per_second': round(clients / elapsed, 1),
+        'accept_p50_ms': to_ms(percentile(delays, 0.50)),
+        'accept_p99_ms': to_ms(percentile(delays, 0.99)),
+        'accept_max_ms': to_ms(delays[-1] if delays else None),
+    }
+
+
+def free_port():
+    """Returns a port nothing is listening on."""
+    with socket.socket() as probe:
+        probe.bind((HOST, 0))
+        return probe.getsockname()[1]
+
+
+def start_server(engine, workers=1, options=()):
+    """
+    Starts server.py with the given engine (and worker processes) and extra command
+    line options in a subprocess on a free port, returns the process and the port.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    port = free_port()
+    process = subprocess.Popen([sys.executable, 'server.py', '--engine', engine, '--workers', str(workers),
+                                '--port', str(port), *options], cwd=here, stdout=subprocess.DEVNULL)
+    return process, port
+
+
+def server_memory(process):
+    """
+    Returns the resident and peak memory (KiB) of the server and its worker processes,
+    read from /proc (None where it is not available).
+    """
+    def status(pid):
+        fields = {}
+        with open(f'/proc/{pid}/status') as file:
+            for line in file:
+                name, _, value = line.partition(':')
+                fields[name] = value.split()
+        return fields
+
+    try:
+        pids = [process.pid]
+        for pid in os.listdir('/proc'):
+            if pid.isdigit() and status(pid).get('PPid') == [str(process.pid)]:
+                pids.append(pid)
+        rss = peak = 0
+        for pid in pids:
+            fields = status(pid)
+            rss += int(fields['VmRSS'][0])
+            peak += int(fields['VmHWM'][0])
+    except (OSError, KeyError):
+        return {'server_rss_kb': None, 'server_peak_rss_kb': None}
+    return {'server_rss_kb': rss, 'server_peak_rss_kb': peak}
+
+
+def run_against_server(engine, workers, benchmark, options=()):
+    """Starts a server, runs the benchmark coroutine function against its port and stops it."""
+    process, port = start_server(engine, workers, options)
+    try:
+        result = asyncio.run(benchmark(port))
+        result.update(server_memory(process))
+        return result
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def memory_text(result):
+    """Formats the server memory of a result for printing."""
+    if result['server_rss_kb'] is None:
+        return "server memory unknown"
+    return f"server RSS {result['server_rss_kb'] // 1024} MiB (peak {result['server_peak_rss_kb'] // 1024} MiB)"
+
+
+def raise_file_limit():
+    """Allows this process (and the servers it starts) to open as many sockets as possible."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def measure_wakeup(connections, rounds):
+    """
+    Returns the average microseconds select.select and the selector take to report
+    one ready socket among `connections` idle ones (None if select cannot handle them).
+    """
+    # Idle unconnected UDP sockets stand in for idle clients (one descriptor each)
+    idle = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(connections)]
+    sender, receiver = socket.socketpair()
+    watched = idle + [receiver]
+
+    def time_rounds(wait):
+        total = 0
+        for _ in range(rounds):
+            sender.send(b'x')
+            started = time.perf_counter_ns()
+            wait()
+            total += time.perf_counter_ns() - started
+            receiver.recv(1)
+        return total / rounds / 1000
+
+    try:
+        # The old loop passed the whole list of sockets on every call
+        select_cost = round(time_rounds(lambda: select.select(watched, [], watched)), 2)
+    except ValueError:
+        # Descriptors over FD_SETSIZE (1024) cannot be used with select()
+        select_cost = None
+
+    selector = selectors.DefaultSelector()
+    for sock in watched:
+        selector.register(sock, selectors.EVENT_READ)
+    selector_cost = round(time_rounds(selector.select), 2)
+
+    selector.close()
+    for sock in watched + [sender]:
+        sock.close()
+    return {'connections': connections, 'select_us': select_cost,
+            'selector': type(selector).__name__, 'selector_us': selector_cost}
+
+
+def measure_history(size, messages):
+    """
+    Returns the average microseconds History.record takes for a message of `size`
+    bytes, keeping it in memory only and also logging it.
+    """
+    message = protocol.encode(protocol.TEXT, b'x' * size)
+
+    def time_records(history):
+        started = time.perf_counter_ns()
+        for _ in range(messages):
+            history.record('lobby', message)
+        elapsed = time.perf_counter_ns() - started
+        history.close()
+        return round(elapsed / messages / 1000, 3)
+
+    memory_cost = time_records(History(50))
+    with tempfile.TemporaryDirectory() as directory:
+        logged_cost = time_records(History(50, MessageLog(directory)))
+    return {'size': size, 'memory_us': memory_cost, 'logged_us': logged_cost}
+
+
+def measure_timers(count, ticks):
+    """
+    Returns the average microseconds the timer wheel takes to move a deadline, and to
+    expire one tick, with `count` deadlines spread over the next minutes and 1% of them
+    due every tick.
+    """
+    wheel = TimerWheel(0)
+    for item in range(count):
+        wheel.schedule(item, 1 + item % 300)
+
+    started = time.perf_counter_ns()
+    for item in range(count):
+        wheel.schedule(item, 1 + (item + 7) % 300)  # Activity moves the deadline
+    schedule_cost = (time.perf_counter_ns() - started) / count
+
+    expire_cost = 0
+    for now in range(1, ticks + 1):
+        started = time.perf_counter_ns()
+        expired = wheel.expire(now)
+        expire_cost += time.perf_counter_ns() - started
+        for item in expired:
+            wheel.schedule(item, now + 300)  # Pinged, checked again later
+    return {'timers': count, 'schedule_us': round(schedule_cost / 1000, 3),
+            'tick_us': round(expire_cost / ticks / 1000, 3),
+            'tick_per_due_us': round(expire_cost / ticks / max(1, count / 300) / 1000, 3)}
+
+
+def fanout(args):
+    # Only the select engine can run with several workers
+    runs = [(engine, workers) for engine in args.engines
+            for workers in (args.workers if engine == 'select' else [1])]
+
+    results = {}
+    for engine, workers in runs:
+        name = engine if workers == 1 else f"{engine} x{workers}"
+        results[name] = result = run_against_server(engine, workers, lambda port: run_fanout(
+            port, args.clients, args.messages, args.interval, args.timeout), UNLIMITED)
+
+        print(f"{name:>10}: {result['delivered']}/{result['expected']} delivered, "
+              f"{result['deliveries_per_second']} msg/s, "
+              f"p50 {result['latency_p50_ms']} ms, p99 {result['latency_p99_ms']} ms, "
+              f"p999 {result['latency_p999_ms']} ms, {memory_text(result)}")
+    return results
+
+
+def syscalls(args):
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        stats = os.path.join(directory, 'stats.sock')
+        for nagle in args.nagle:
+            name = 'nagle' if nagle else 'nodelay'
+            options = UNLIMITED + ['--stats-socket', stats] + (['--nagle'] if nagle else [])
+            results[name] = result = run_against_server('select', 1, lambda port: run_fanout(
+                port, args.clients, args.messages, args.interval, args.timeout, stats), options)
+
+            print(f"{name:>8}: {result['delivered']}/{result['expected']} delivered, "
+                  f"{result['deliveries_per_second']} msg/s, p99 {result['latency_p99_ms']} ms, per message: "
+                  + ", ".join(f"{result.get(f'{counter}_per_message')} {counter}" for counter in SYSCALL_COUNTERS))
+    return results
+
+
+def connect(args):
+    results = {}
+    for engine in args.engines:
+        results[engine] = result = run_against_server(engine, 1, lambda port: run_connect_storm(
+            port, args.clients, args.silent, args.concurrency))
+
+        print(f"{engine:>8}: {result['clients']} connections ({result['silent']} silent) in "
+              f"{result['elapsed_seconds']} s, {result['connects_per_second']} connects/s, "
+              f"accept p50 {result['accept_p50_ms']} ms, p99 {result['accept_p99_ms']} ms, "
+              f"max {result['accept_max_ms']} ms, {memory_text(result)}")
+    return results
+
+
+def load(args):
+    results = {}
+    for workers in args.workers:
+        name = 'select' if workers == 1 else f"select x{workers}"
+        results[name] = result = run_against_server('select', workers, lambda port: run_load(
+            port, args.clients, args.senders, args.rooms, args.rate, args.duration, args.timeout))
+
+        print(f"{name:>10}: {result['clients']} clients at {result['connects_per_second']} connects/s, "
+              f"{result['delivered']}/{result['expected']} delivered, "
+              f"{result['deliveries_per_second']} msg/s, "
+              f"p50 {result['latency_p50_ms']} ms, p99 {result['latency_p99_ms']} ms, "
+              f"p999 {result['latency_p999_ms']} ms, {memory_text(result)}")
+    return results
+
+
+def flood(args):
+    options = [] if args.limits else UNLIMITED
+    result = run_against_server('select', 1, lambda port: run_flood(
+        port, args.clients, args.flooders, args.senders, args.rate, args.duration, args.timeout), options)
+
+    print(f"{args.flooders} flooders sent {result['flood_sent']} messages ({result['disconnected']} senders dropped); steady senders: "
+          f"{result['delivered']}/{result['expected']} delivered, "
+          f"p50 {result['latency_p50_ms']} ms, p99 {result['latency_p99_ms']} ms, "
+          f"p999 {result['latency_p999_ms']} ms, {memory_text(result)}")
+    return result
+
+
+def revision():
+    """Returns the git commit the benchmark runs on (None outside a git checkout)."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=here, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(args):
+    """Prints how every number of the second results file changed from the first."""
+    with open(args.before) as before_file, open(args.after) as after_file:
+        before, after = json.load(before_file), json.load(after_file)
+    print(f"{before['command']} {before['revision']} -> {after['command']} {after['revision']}")
+
+    def walk(old, new, path):
+        if isinstance(old, dict) and isinstance(new, dict):
+            for key in (key for key in old if key in new):
+                walk(old[key], new[key], path + [str(key)])
+        elif isinstance(old, list) and isinstance(new, list):
+            for index, (old_item, new_item) in enumerate(zip(old, new)):
+                walk(old_item, new_item, path + [str(index)])
+        elif isinstance(old, (int, float)) and isinstance(new, (int, float)) and old != new:
+            change = f"{(new - old) / old * 100:+.1f}%" if old else "new"
+            print(f"  {'.'.join(path)}: {old} -> {new} ({change})")
+
+    walk(before['results'], after['results'], [])
+
+
+def wakeup(args):
+    results = []
+    for connections in args.connections:
+        result = measure_wakeup(connections, args.rounds)
+        results.append(result)
+        select_cost = 'fails' if result['select_us'] is None else f"{result['select_us']} us"
+        print(f"{connections:>6} idle connections: select {select_cost}, "
+              f"{result['selector']} {result['selector_us']} us")
+    return results
+
+
+def history(args):
+    results = []
+    for size in args.sizes:
+        result = measure_history(size, args.messages)
+        results.append(result)
+        print(f"{size:>6} byte messages: in memory {result['memory_us']} us, "
+              f"logged {result['logged_us']} us")
+    return results
+
+
+def timers(args):
+    results = []
+    for count in args.timers:
+        result = measure_timers(count, args.ticks)
+        results.append(result)
+        print(f"{count:>7} timers: schedule {result['schedule_us']} us, "
+              f"tick {result['tick_us']} us ({result['tick_per_due_us']} us per timer due)")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--json', help="write the results to this file")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    fanout_parser = commands.add_parser('fanout', help="fan-out throughput and latency of the server engines")
+    fanout_parser.add_argument('--engines', nargs='+', default=['select', 'asyncio'], choices=['select', 'asyncio'])
+    fanout_parser.add_argument('--clients', type=int, default=1000, help="connected clients (default: 1000)")
+    fanout_parser.add_argument('--messages', type=int, default=50, help="messages sent by the first client (default: 50)")
+    fanout_parser.add_argument('--interval', type=float, default=0.01, help="seconds between messages (default: 0.01)")
+    fanout_parser.add_argument('--timeout', type=float, default=60, help="seconds to wait for all deliveries (default: 60)")
+    fanout_parser.add_argument('--workers', type=int, nargs='+', default=[1],
+                               help="worker processes to run the select engine with, e.g. 1 2 4 (default: 1)")
+    fanout_parser.set_defaults(run=fanout)
+
+    syscalls_parser = commands.add_parser('syscalls', help="system calls of the select engine per delivered message")
+    syscalls_parser.add_argument('--clients', type=int, default=1000, help="connected clients (default: 1000)")
+    syscalls_parser.add_argument('--messages', type=int, default=50, help="messages sent by the first client (default: 50)")
+    syscalls_parser.add_argument('--interval', type=float, default=0, help="seconds between messages (default: 0)")
+    syscalls_parser.add_argument('--timeout', type=float, default=60, help="seconds to wait for all deliveries (default: 60)")
+    syscalls_parser.add_argument('--nagle', type=int, nargs='+', default=[0, 1], choices=[0, 1],
+                                 help="run with TCP_NODELAY (0), with Nagle's algorithm (1) or both (default: 0 1)")
+    syscalls_parser.set_defaults(run=syscalls)
+
+    connect_parser = commands.add_parser('connect', help="accept rate during a connection storm")
+    connect_parser.add_argument('--engines', nargs='+', default=['select', 'asyncio'], choices=['select', 'asyncio'])
+    connect_parser.add_argument('--clients', type=int, default=5000, help="connections opened (default: 5000)")
+    connect_parser.add_argument('--silent', type=float, default=0.1,
+                                help="fraction of connections that never send a nickname (default: 0.1)")
+    connect_parser.add_argument('--concurrency', type=int, default=1000,
+                                help="connections being opened at the same time (default: 1000)")
+    connect_parser.set_defaults(run=connect)
+
+    wakeup_parser = commands.add_parser('wakeup', help="event loop wakeup cost with many idle connections")
+    wakeup_parser.add_argument('--connections', type=int, nargs='+', default=[100, 1000, 10000],
+                               help="idle connections to measure with (default: 100 1000 10000)")
+    wakeup_parser.add_argument('--rounds', type=int, default=1000, help="wakeups measured each time (default: 1000)")
+    wakeup_parser.set_defaults(run=wakeup)
+
+    history_parser = commands.add_parser('history', help="cost of recording broadcasts in the history")
+    history_parser.add_argument('--sizes', type=int, nargs='+', default=[64, 1024, 16384],
+                                help="message sizes in bytes (default: 64 1024 16384)")
+    history_parser.add_argument('--messages', type=int, default=100000,
+                                help="messages recorded for each size (default: 100000)")
+    history_parser.set_defaults(run=history)
+
+    timers_parser = commands.add_parser('timers', help="cost of the timer wheel with many deadlines")
+    timers_parser.add_argument('--timers', type=int, nargs='+', default=[1000, 10000, 100000],
+                               help="deadlines in the wheel (default: 1000 10000 100000)")
+    timers_parser.add_argument('--ticks', type=int, default=600, help="ticks expired (default: 600)")
+    timers_parser.set_defaults(run=timers)
+
+    load_parser = commands.add_parser('load', help="delivery rate and latency with many senders and rooms")
+    load_parser.add_argument('--clients', type=int, default=2000, help="connected clients (default: 2000)")
+    load_parser.add_argument('--senders', type=int, default=200, help="clients that send messages (default: 200)")
+    load_parser.add_argument('--rooms', type=int, default=20, help="rooms the clients are spread over (default: 20)")
+    load_parser.add_argument('--rate', type=float, default=1, help="messages per second of each sender (default: 1)")
+    load_parser.add_argument('--duration', type=float, default=10, help="seconds the senders send for (default: 10)")
+    load_parser.add_argument('--timeout', type=float, default=30,
+                             help="seconds to wait for the deliveries after that (default: 30)")
+    load_parser.add_argument('--workers', type=int, nargs='+', default=[1],
+                             help="worker processes to run the server with, e.g. 1 2 4 (default: 1)")
+    load_parser.set_defaults(run=load)
+
+    flood_parser = commands.add_parser('flood', help="latency of steady senders while a few clients flood")
+    flood_parser.add_argument('--clients', type=int, default=500, help="connected clients (default: 500)")
+    flood_parser.add_argument('--flooders', type=int, default=5, help="clients sending as fast as they can (default: 5)")
+    flood_parser.add_argument('--senders', type=int, default=50, help="clients sending at a steady rate (default: 50)")
+    flood_parser.add_argument('--rate', type=float, default=2, help="messages per second of each steady sender (default: 2)")
+    flood_parser.add_argument('--duration', type=float, default=10, help="seconds the clients send for (default: 10)")
+    flood_parser.add_argument('--timeout', type=float, default=30,
+                              help="seconds to wait for the deliveries after that (default: 30)")
+    flood_parser.add_argument('--limits', action='store_true', help="keep the server's rate limits on")
+    flood_parser.set_defaults(run=flood)
+
+    compare_parser = commands.add_parser('compare', help="difference between two --json results files")
+    compare_parser.add_argument('before')
+    compare_parser.add_argument('after')
+    compare_parser.set_defaults(run=compare)
+
+    args = parser.parse_args()
+    if args.command == 'compare':
+        compare(args)
+        return
+    if args.command == 'load' and args.senders > args.clients:
+        parser.error("--senders cannot be more than --clients")
+    if args.command == 'flood' and args.flooders + args.senders > args.clients:
+        parser.error("--flooders and --senders cannot be more than --clients")
+    raise_file_limit()
+    results = args.run(args)
+
+    if args.json:
+        # Keep what the results were measured on, to compare revisions later
+        settings = {name: value for name, value in vars(args).items() if name not in ('run', 'json')}
+        with open(args.json, 'w') as output:
+            json.dump({'command': args.command, 'revision': revision(), 'python': platform.python_version(),
+                       'platform': platform.platform(), 'settings': settings, 'results': results},
+                      output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
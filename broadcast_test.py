@@ -0,0 +1,292 @@
+import pytest
+import socket
+import selectors
+from collections import deque
+from unittest.mock import Mock, patch
+import protocol  # Framing of the messages
+from registry import Registry, Session  # Sessions of the connected clients
+from server import broadcast, flush, flush_pending, handle_peer, Outbox  # Importing the functions to be tested from the server module
+import server
+from conftest import add_client  # Helpers shared by the tests
+
+# Fixture to set up two mock clients
+@pytest.fixture
+def setup_clients():
+    """
+    Fixture to set up two mock clients: one that sends a message and one that receives it.
+    """
+    sender = Mock()  # Create a mock client that sends the message
+    receiver = Mock()  # Create a mock client that receives the message
+    return sender, receiver  # Return the mock clients to use in tests
+
+# Test 1: Optimal case - the message is queued without sending anything
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.pending', new_callable=list)  # Mocking the sessions to flush at the end of the loop pass
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_broadcast_queues(mock_registry, mock_pending, mock_selector, setup_clients):
+    """
+    Test case where a message is broadcast. It should be queued for every client except
+    the sender, and no socket should be written to until the end of the loop pass.
+    """
+    sender, receiver = setup_clients
+    sender_session = add_client(mock_registry, sender, "Sender")
+    receiver_session = add_client(mock_registry, receiver, "Receiver")
+
+    broadcast(b'Hello, world!', sender)
+
+    receiver.sendmsg.assert_not_called()  # Nothing is sent while broadcasting
+    assert list(receiver_session.outbox.messages) == [b'Hello, world!']  # The message waits in the receiver's buffer
+    assert not sender_session.outbox  # The message is not echoed to the sender
+    assert mock_pending == [receiver_session]  # The receiver is flushed at the end of the pass
+    mock_selector.modify.assert_not_called()  # Without watching it for writing
+
+# Test 2: The queued messages are sent once the socket is writable, even with partial writes
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_flush_partial_writes(mock_registry, mock_selector, setup_clients):
+    """
+    Test case where the socket accepts only part of the data, then would block.
+    The rest should stay queued and be sent on the next flush.
+    """
+    sender, receiver = setup_clients
+    session = add_client(mock_registry, receiver, "Receiver")
+    session.outbox.put(b'Hello')
+    session.outbox.put(b'World')
+
+    sent = []
+    # Accept 3 bytes, the socket buffer is full
+    receiver.sendmsg.side_effect = [3]
+    assert flush(receiver) is True
+    assert len(session.outbox) == 7  # 'lo' and 'World' are still waiting
+    mock_selector.modify.assert_called_once_with(receiver, selectors.EVENT_READ | selectors.EVENT_WRITE, session)  # Watched until writable
+
+    # Accept everything on the next flush
+    mock_selector.reset_mock()
+    receiver.sendmsg.side_effect = lambda buffers: sent.append([bytes(data) for data in buffers]) or sum(map(len, buffers))
+    assert flush(receiver) is True
+    assert sent == [[b'lo', b'World']]  # The half sent message is finished first, in the same call
+    assert len(session.outbox) == 0
+    assert session.bytes_out == 10  # Every byte was counted once
+    mock_selector.modify.assert_called_once_with(receiver, selectors.EVENT_READ, session)  # Nothing left to write
+
+# Test 3: A socket error while flushing asks for the client to be removed
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_flush_socket_error(mock_registry, setup_clients):
+    """
+    Test case where the socket fails while sending. flush should return False without retrying.
+    """
+    sender, receiver = setup_clients
+    session = add_client(mock_registry, receiver, "Receiver")
+    session.outbox.put(b'Hello')
+    receiver.sendmsg.side_effect = socket.error("Socket error during send")
+
+    assert flush(receiver) is False
+    receiver.sendmsg.assert_called_once()  # No retries that would stall the server
+
+# Test 4: Overflow with the 'disconnect' policy
+@patch('server.OVERFLOW_POLICY', 'disconnect')
+@patch('server.HIGH_WATERMARK', 30)
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_broadcast_overflow_disconnect(mock_registry, mock_selector, setup_clients):
+    """
+    Test case where a client stops reading and its buffer goes past the high watermark.
+    The client should be removed and the others told that it left.
+    """
+    sender, receiver = setup_clients
+    sender_session = add_client(mock_registry, sender, "Sender")
+    add_client(mock_registry, receiver, "Slow")
+
+    broadcast(b'A' * 16, sender)
+    broadcast(b'B' * 16, sender)  # 32 bytes queued, over the limit
+
+    receiver.close.assert_called_once()  # The slow client was disconnected
+    mock_selector.unregister.assert_called_once_with(receiver)  # And is no longer watched
+    assert receiver not in mock_registry
+    assert list(sender_session.outbox.messages) == [protocol.encode_leave(protocol.encode_sender('Slow'))]  # The others are told
+
+# Test 5: Overflow with the 'drop-oldest' policy
+@patch('server.OVERFLOW_POLICY', 'drop-oldest')
+@patch('server.HIGH_WATERMARK', 10)
+@patch('server.LOW_WATERMARK', 6)
+def test_outbox_drop_oldest():
+    """
+    Test case where the buffer goes past the high watermark with the 'drop-oldest' policy.
+    The oldest messages should be dropped until the buffer is under the low watermark,
+    keeping the newest ones and the client connected.
+    """
+    outbox = Outbox()
+    assert outbox.put(b'1111') is True
+    assert outbox.put(b'2222') is True
+    assert outbox.put(b'3333') is True  # 12 bytes, over the limit
+
+    assert list(outbox.messages) == [b'3333']  # Only the newest message is kept
+    assert len(outbox) == 4
+
+# Test 6: With several workers, broadcasts are forwarded once to every other worker
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.peers', new_callable=dict)  # Mocking the links to the other workers in the server module
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_broadcast_forwards_to_workers(mock_registry, mock_peers, mock_selector, setup_clients):
+    """
+    Test case where a local client sends a message while two other workers are running.
+    The local clients and each worker should get the message exactly once.
+    """
+    sender, receiver = setup_clients
+    add_client(mock_registry, sender, "Sender")
+    receiver_session = add_client(mock_registry, receiver, "Receiver")
+    links = [Session(Mock(), protocol.FrameReader(), Outbox()) for _ in range(2)]
+    for link in links:
+        mock_peers[link.sock] = link
+
+    broadcast(b'Hello, world!', sender)
+
+    assert list(receiver_session.outbox.messages) == [b'Hello, world!']  # Delivered to the local client
+    for link in links:
+        assert list(link.outbox.messages) == [protocol.encode_routed(b'', b'Hello, world!')]  # Forwarded once to each worker
+
+# Test 7: Messages from another worker are only delivered locally
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.peers', new_callable=dict)  # Mocking the links to the other workers in the server module
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_peer_messages_not_forwarded(mock_registry, mock_peers, mock_selector, setup_clients):
+    """
+    Test case where another worker forwards a message. It should reach the local clients
+    but never be sent back to any worker, so nobody gets it twice.
+    """
+    sender, receiver = setup_clients
+    receiver_session = add_client(mock_registry, receiver, "Receiver")
+    link = Session(Mock(), protocol.FrameReader(), Outbox())
+    mock_peers[link.sock] = link
+    message = protocol.encode(protocol.TEXT, b'Hello from another worker')
+    routed = protocol.encode_routed(b'', message)
+    def recv_into(buffer):
+        buffer[:len(routed)] = routed
+        return len(routed)
+    link.sock.recv_into.side_effect = recv_into
+
+    assert handle_peer(link.sock) is True
+
+    assert list(receiver_session.outbox.messages) == [message]  # Delivered to the local client
+    assert not link.outbox  # Not sent back to the worker it came from
+
+# Test 8: Messages queued during one loop pass go out in one call per client
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.pending', new_callable=list)  # Mocking the sessions to flush at the end of the loop pass
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_coalesced_flush(mock_registry, mock_pending, mock_selector, setup_clients):
+    """
+    Test case where several messages are broadcast before the end of the loop pass. Each
+    receiver should get all of them with a single vectored write, sharing the same frames,
+    and never be watched for writing since everything fit.
+    """
+    sender, receiver = setup_clients
+    first = add_client(mock_registry, receiver, "First")
+    second = add_client(mock_registry, Mock(), "Second")
+    messages = [protocol.encode(protocol.TEXT, f"message {number}".encode('utf-8')) for number in range(3)]
+    for client in (receiver, second.sock):
+        client.sendmsg.side_effect = lambda buffers: sum(map(len, buffers))
+
+    for message in messages:
+        broadcast(message, sender)
+    assert first.outbox.messages[0] is second.outbox.messages[0]  # Encoded once, shared by reference
+    flush_pending()
+
+    for session in (first, second):
+        session.sock.sendmsg.assert_called_once()
+        assert [bytes(data) for data in session.sock.sendmsg.call_args[0][0]] == messages
+        assert not session.outbox
+    assert mock_pending == []
+    mock_selector.modify.assert_not_called()
+
+# Test 9: A client that fails while flushing at the end of the pass is removed
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.pending', new_callable=list)  # Mocking the sessions to flush at the end of the loop pass
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_flush_pending_error(mock_registry, mock_pending, mock_selector, setup_clients):
+    """
+    Test case where a receiver's socket fails when its messages are flushed. It should be
+    removed, and the leave message flushed to the others in the same pass.
+    """
+    sender, receiver = setup_clients
+    sender_session = add_client(mock_registry, sender, "Sender")
+    add_client(mock_registry, receiver, "Broken")
+    receiver.sendmsg.side_effect = socket.error("Connection reset")
+    sender.sendmsg.side_effect = lambda buffers: sum(map(len, buffers))
+
+    broadcast(b'Hello, world!', sender)
+    flush_pending()
+
+    receiver.close.assert_called_once()
+    assert receiver not in mock_registry
+    assert [bytes(data) for data in sender.sendmsg.call_args[0][0]] == [protocol.encode_leave(protocol.encode_sender('Broken'))]
+    assert not sender_session.outbox
+
+# Test 10: A long backlog is sent in vectored writes of at most MAX_BUFFERS messages
+@patch('server.MAX_BUFFERS', 2)  # Messages per write
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_flush_max_buffers(mock_registry, mock_selector, setup_clients):
+    """
+    Test case where more messages are waiting than one write may carry. They should be
+    sent with several writes, in order, within the same flush.
+    """
+    sender, receiver = setup_clients
+    session = add_client(mock_registry, receiver, "Receiver")
+    for message in (b'one', b'two', b'three'):
+        session.outbox.put(message)
+    sent = []
+    receiver.sendmsg.side_effect = lambda buffers: sent.append([bytes(data) for data in buffers]) or sum(map(len, buffers))
+
+    assert flush(receiver) is True
+    assert sent == [[b'one', b'two'], [b'three']]
+    assert not session.outbox
+
+# Test 11: Clients dropped one after the other by the leave messages do not recurse
+@patch('server.OVERFLOW_POLICY', 'disconnect')  # Remove clients whose buffer is full
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.pending', new_callable=list)  # Mocking the sessions to flush at the end of the loop pass
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_disconnect_cascade(mock_registry, mock_pending, mock_selector):
+    """
+    Test case where every client's buffer has room for one message less than the next
+    one's, so each leave message overflows one more client. All of them should be
+    removed, without going deeper in the stack for each one.
+    """
+    count = 500
+    message = protocol.encode_leave(protocol.encode_sender("U00000"))  # As long as every leave message
+    sessions = [add_client(mock_registry, Mock(), f"U{number:05d}") for number in range(count)]
+    for number, session in enumerate(sessions):
+        # Overflows with its (number + 1)th message
+        session.outbox.put(b'x' * (server.HIGH_WATERMARK - (number + 1) * len(message) + 1))
+
+    broadcast(message)
+
+    assert len(mock_registry) == 0
+    assert server.departures == deque()
+
+# Test 12: The links to the other workers never drop or refuse a message
+@pytest.mark.parametrize('policy', ['drop-oldest', 'disconnect'])
+@patch('server.HIGH_WATERMARK', 30)
+@patch('server.LOW_WATERMARK', 10)
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.pending', new_callable=list)  # Mocking the sessions to flush at the end of the loop pass
+@patch('server.peers', new_callable=dict)  # Mocking the links to the other workers in the server module
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_worker_link_overflow(mock_registry, mock_peers, mock_pending, mock_selector, policy):
+    """
+    Test case where the link to another worker has more waiting than the high watermark,
+    with either overflow policy. Every message should stay queued for the other worker,
+    and the link be kept.
+    """
+    link = Session(Mock(), protocol.FrameReader(), Outbox(bounded=False))
+    mock_peers[link.sock] = link
+    messages = [bytes([65 + index]) * 16 for index in range(4)]
+
+    with patch('server.OVERFLOW_POLICY', policy):
+        for message in messages:
+            broadcast(message)
+
+    assert list(link.outbox.messages) == [protocol.encode_routed(b'', message) for message in messages]
+    assert mock_peers == {link.sock: link}
+    link.sock.close.assert_not_called()
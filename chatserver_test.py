@@ -0,0 +1,132 @@
+import socket
+from unittest.mock import patch
+import pytest
+import protocol  # Framing of the messages
+import server
+from server import ChatServer  # Importing the server to be tested
+
+def connect(port, nickname):
+    """
+    Connects a real client to the server and answers the nickname request. Returns the
+    socket and the messages it receives afterwards.
+    """
+    client = socket.create_connection(('127.0.0.1', port), timeout=5)
+    received = messages(client)
+    assert next(received)[0] == protocol.NICK
+    client.sendall(protocol.encode_nick(nickname))
+    return client, received
+
+def messages(client):
+    """
+    Yields the messages the client receives as (type, payload), until the server closes the
+    connection.
+    """
+    reader = protocol.FrameReader()
+    while reader.recv(client):
+        for kind, frame in reader.frames():
+            yield kind, bytes(protocol.payload(frame))
+
+# Test 1: Nothing is bound until the server is started
+def test_lazy_start():
+    """
+    Test case where a server is created on port 0, then started. It should only listen
+    once started, on the port the system picked.
+    """
+    chat = ChatServer(port=0)
+    assert chat.listener is None
+    assert server.server is None
+
+    chat.start()
+    try:
+        assert chat.port != 0
+        assert server.server.getsockname() == chat.address
+    finally:
+        chat.stop()
+    assert server.server is None
+
+# Test 2: A server run in a thread serves clients until it is stopped
+def test_run_in_thread():
+    """
+    Test case where two clients chat through a server running in a thread, then the server
+    is stopped. The message should get through, and both connections be closed.
+    """
+    chat = ChatServer(port=0)
+    chat.run_in_thread()
+    first, first_received = connect(chat.port, "First")
+    second, second_received = connect(chat.port, "Second")
+    assert next(first_received) == (protocol.JOIN, protocol.encode_sender("Second"))
+
+    second.sendall(protocol.encode(protocol.TEXT, b'hello'))
+    assert next(first_received) == (protocol.CHAT, protocol.encode_sender("Second") + b'hello')
+
+    chat.stop()
+    assert chat.thread is None
+    assert next(first_received, None) is None  # Closed by the server
+    assert list(second_received) == [(protocol.JOIN, protocol.encode_sender("First"))]  # Replayed from the history
+    first.close()
+    second.close()
+
+# Test 3: Only one server runs in a process at a time
+def test_one_per_process():
+    """
+    Test case where a second server is started while the first one runs. It should fail,
+    and start once the first one is stopped.
+    """
+    with ChatServer(port=0):
+        with pytest.raises(RuntimeError):
+            ChatServer(port=0).start()
+
+    with ChatServer(port=0) as chat:
+        assert chat.listener is not None
+
+# Test 4: A server run in a process has the port picked before it forks
+def test_run_in_process():
+    """
+    Test case where a server is run in a child process. A client should be able to join at
+    once, and the process should end when the server is stopped.
+    """
+    chat = ChatServer(port=0)
+    process = chat.run_in_process()
+    assert server.server is None  # Only the child listens
+    client, received = connect(chat.port, "TestUser")
+    client.sendall(protocol.encode(protocol.ROOM_LIST))
+    assert next(received) == (protocol.TEXT, b"Rooms: lobby (1)")
+
+    chat.stop()
+    assert not process.is_alive()
+    assert process.exitcode == 0  # Stopped cleanly, not by an error in the signal handler
+    client.close()
+
+# Test 5: The asyncio engine can be run and stopped the same way
+def test_asyncio_engine():
+    """
+    Test case where the asyncio engine is run in a thread, then stopped. A client should
+    be able to join, and be disconnected when the thread ends.
+    """
+    chat = ChatServer(port=0, engine='asyncio')
+    thread = chat.run_in_thread()
+    client, received = connect(chat.port, "TestUser")
+    client.sendall(protocol.encode(protocol.PING))
+    assert next(received) == (protocol.PONG, b"")
+
+    chat.stop()
+    assert not thread.is_alive()
+    assert next(received, None) is None  # Closed by the server
+    client.close()
+
+# Test 6: The asyncio engine keeps direct messages as the options say
+@patch('server.OFFLINE_QUEUE_SIZE', 0)  # --offline-queue 0, keep none
+def test_asyncio_offline_queue():
+    """
+    Test case where the asyncio engine is told to keep no direct messages for nicknames that
+    are not connected. A direct message to one should be refused instead of kept.
+    """
+    chat = ChatServer(port=0, engine='asyncio')
+    chat.run_in_thread()
+    try:
+        client, received = connect(chat.port, "TestUser")
+        client.sendall(protocol.encode_msg("Later", "see you"))
+        assert next(received) == (protocol.ERROR, b"Later is not connected")
+    finally:
+        chat.stop()
+    client.close()
@@ -2,10 +2,24 @@ import socket
 import threading
 from simple_chalk import chalk
 import sys
+import protocol
 
-COLORS = ["black" , "red", "green", "yellow", "blue", "magenta", "cyan", "white"]
+# Both threads send to the server, a frame must never be cut by another
+send_lock = threading.Lock()
 
-def color_checker(nick):
+# The colors the server knows, sent once with the nickname
+COLORS = protocol.COLORS
+
+# Whether the server said it takes compressed messages, in its nickname request
+server_compresses = False
+
+# Whether the nickname was sent, and whether the server refused it and the next
+# line typed is another one
+introduced = False
+renaming = False
+
+# Ask the user for the color of their nickname, returns its index in COLORS
+def color_checker():
     print(f"Colors available: {', '.join(COLORS)}")
 
     for attempt in range(3):
@@ -13,11 +27,9 @@ def color_checker(nick):
         
         # Check if color is valid or if input is empty
         if color == "":
-            nickname = chalk.white(nick)
-            return nickname
+            return protocol.DEFAULT_COLOR
         elif color in COLORS:
-            nickname = getattr(chalk, color)(nick)  # Use chalk to apply the color
-            return nickname
+            return COLORS.index(color)
         else:
             print(f"Invalid color '{color}', please choose from the list.")
     
@@ -25,40 +37,120 @@ def color_checker(nick):
     print("Failed to choose a valid color. Closing the program...")
     sys.exit(0)
 
+# Show a nickname in the color its owner chose. Only the index of the color is
+# sent, the escape codes are added here
+def paint(nickname, color):
+    return getattr(chalk, COLORS[color])(nickname)
+
+# Turn a message from the server into the line shown to the user
+def render(kind, payload):
+    if kind == protocol.TEXT:
+        return bytes(payload).decode('utf-8')
+    if kind == protocol.ERROR:
+        return chalk.red(bytes(payload).decode('utf-8'))
+
+    # Chat messages and announcements start with who they are about
+    nickname, color, rest = protocol.decode_sender(payload)
+    name = paint(nickname, color)
+    if kind == protocol.CHAT:
+        return f"{name}: {bytes(rest).decode('utf-8')}"
+    if kind == protocol.DIRECT:
+        return f"{name} (private): {bytes(rest).decode('utf-8')}"
+    if kind == protocol.JOIN:
+        room = bytes(rest).decode('utf-8')
+        return f"{name} joined {room}" if room else f"{name} joined the chat"
+    # LEAVE
+    reason, room = rest[0], bytes(rest[1:]).decode('utf-8')
+    if reason == protocol.FLOODED:
+        return f"{name} was disconnected for flooding."
+    return f"{name} left {room}" if room else f"{name} left the chat."
+
+# Messages shown to the user
+SHOWN = (protocol.TEXT, protocol.CHAT, protocol.DIRECT, protocol.JOIN, protocol.LEAVE, protocol.ERROR)
+
 
 # Function to receive messages
 def receive():
+    global server_compresses, introduced, renaming
+    reader = protocol.FrameReader()
     while True:
         # Try to receive messages from the server
         try:
-            message = client.recv(1024).decode('utf-8')
-            if message == 'NICK':  # If the server requests our nickname
-                client.send(nickname.encode('utf-8'))
-            else:
-                print(message)
+            if not reader.recv(client):
+                print("The server closed the connection")
+                client.close()
+                break
+            # A single read may hold several messages, or only part of one
+            for kind, frame in protocol.expand(reader.frames()):
+                if kind == protocol.NICK:  # If the server requests our nickname
+                    server_compresses = bool(protocol.decode_prompt(protocol.payload(frame)) & protocol.COMPRESSION)
+                    if introduced:
+                        # The server refused it and told us why, the user picks another one
+                        renaming = True
+                        print("Enter another nickname:")
+                    else:
+                        introduced = True
+                        send(protocol.encode_nick(nickname, color, protocol.COMPRESSION))
+                elif kind in SHOWN:
+                    print(render(kind, protocol.payload(frame)))
+                elif kind == protocol.PING:  # The server checks we are still here
+                    send(protocol.encode(protocol.PONG))
         # If there was an error receiving messages, close the connection
         except:
             print("An error occurred!")
             client.close()
             break
 
+# Turn a line typed by the user into the message for the server.
+# /join <room>, /leave and /rooms are room commands, /msg <nickname> <text> a
+# direct message, anything else is chat, which the server sends on with our nickname
+def build_message(line):
+    command, _, argument = line.strip().partition(' ')
+    if command == '/msg':
+        # Never sent as chat, even without a text, so it can't reach everybody
+        recipient, _, text = argument.strip().partition(' ')
+        return protocol.encode_msg(recipient, text)
+    elif command == '/join' and argument.strip():
+        return protocol.encode(protocol.ROOM_JOIN, argument.strip().encode('utf-8'))
+    elif command == '/leave':
+        return protocol.encode(protocol.ROOM_LEAVE)
+    elif command == '/rooms':
+        return protocol.encode(protocol.ROOM_LIST)
+    return protocol.encode(protocol.TEXT, line.encode('utf-8'))
+
+# Send a whole message to the server, compressed if it is large and the server takes it
+def send(message):
+    if server_compresses and len(message) >= protocol.COMPRESS_THRESHOLD:
+        message = protocol.compress(message)
+    with send_lock:
+        client.sendall(message)
+
 # Function to send messages
 def write():
+    global nickname, renaming
     while True:
-        message = f'{nickname}: {input("")}'
-        client.send(message.encode('utf-8'))
+        line = input("")
+        if renaming:
+            renaming = False
+            nickname = line
+            send(protocol.encode_nick(nickname, color, protocol.COMPRESSION))
+        else:
+            send(build_message(line))
         
-if __name__ == "__main__":
-    print("""
+# Shown when the client starts
+BANNER = """
         ##################################################################
             █▀ █▀█ █▀▀ █▄▀   █ ▀█▀   ▀█▀ █▀█   █▀▄▀█ █▀▀   █▀▀ █░█ ▄▀█ ▀█▀
             ▄█ █▄█ █▄▄ █░█   █ ░█░   ░█░ █▄█   █░▀░█ ██▄   █▄▄ █▀█ █▀█ ░█░
         ##################################################################
-        """)
+        """
+
+if __name__ == "__main__":
+    print(BANNER)
 
-    nick = input("Enter your nickname: ")
+    nickname = input("Enter your nickname: ")
 
-    nickname = color_checker(nick)
+    color = color_checker()
 
     # Connect to the server
     client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -1,4 +1,4 @@
-from client import color_checker  # Import the function to be tested
+from client import color_checker, paint  # Import the functions to be tested
 import pytest  # Pytest is used for testing
 from unittest.mock import patch  # To mock built-in functions like `input`
 import sys  # For handling system exit in tests
@@ -8,12 +8,13 @@ def test_valid_color(): # HAPPY PATH
     """
     This test case simulates a scenario where the user provides a valid color 
     ('blue') through input, and the color_checker function should return the 
-    nickname with blue color (using ANSI escape codes).
+    index of blue, which is sent to the server with the nickname.
     """
     with patch('builtins.input', return_value='blue'):  # Mocking user input to return 'blue'
-        result = color_checker("TestUser")  # Call the function with a sample username
-        # Assert that the result matches the ANSI escape code for blue color
-        assert result == '\x1b[34mTestUser\x1b[0m' # (blue color for the text)
+        result = color_checker()  # Call the function
+        # Assert that the result is the index of blue
+        assert result == 4 # (blue in the list of colors)
+        assert paint("TestUser", result) == '\x1b[34mTestUser\x1b[0m' # (shown with the ANSI escape code for blue)
 
 # Test 2: User chooses an empty string (should default to 'white')
 def test_empty_string_color(): # EDGE CASE
@@ -22,9 +23,9 @@ def test_empty_string_color(): # EDGE CASE
     as input. The function should default to 'white' if no valid color is chosen.
     """
     with patch('builtins.input', return_value=''):  # Mocking user input as an empty string
-        result = color_checker("TestUser")  # Call the function with a sample username
-        # Assert that the result matches the ANSI escape code for white color
-        assert result == '\x1b[37mTestUser\x1b[0m' # (white color for the text)
+        result = color_checker()  # Call the function
+        # Assert that the result is the index of white
+        assert result == 7 # (white in the list of colors)
 
 # Test 3: User provides an invalid color three times
 def test_invalid_colors(): # ERROR CASE
@@ -35,7 +36,7 @@ def test_invalid_colors(): # ERROR CASE
     """
     with patch('builtins.input', side_effect=['purple', 'orange', 'pink']):  # Mocking invalid inputs
         with pytest.raises(SystemExit):  # Expecting a system exit after 3 invalid attempts
-            color_checker("TestUser")  # Call the function with a sample username
+            color_checker()  # Call the function
 
 # Test 4: User chooses a valid color after one invalid attempt
 def test_invalid_then_valid_color(): # RECOVERY CASE
@@ -45,6 +46,6 @@ def test_invalid_then_valid_color(): # RECOVERY CASE
     apply the valid color ('red') after one invalid attempt.
     """
     with patch('builtins.input', side_effect=['purple', 'red']):  # Mocking first invalid, then valid input
-        result = color_checker("TestUser")  # Call the function with a sample username
-        # Assert that the result matches the ANSI escape code for red color
-        assert result == '\x1b[31mTestUser\x1b[0m' # (red color for the text)
+        result = color_checker()  # Call the function
+        # Assert that the result is the index of red
+        assert result == 1 # (red in the list of colors)
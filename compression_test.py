@@ -0,0 +1,171 @@
+import pytest
+from unittest.mock import Mock, patch
+import protocol  # Framing of the messages
+from history import History  # Recent messages of the rooms
+from metrics import Metrics  # Counters of the server
+from registry import Registry, Session  # Sessions of the connected clients
+from timerwheel import TimerWheel  # Deadlines of the clients
+from server import handle, broadcast, Outbox  # Importing the functions to be tested from the server module
+from conftest import add_client, feed  # Helpers shared by the tests
+
+def received(message):
+    """
+    Returns the (type, payload) of every message a client gets out of a queued message,
+    decompressing it the way the clients do.
+    """
+    reader = protocol.FrameReader()
+    feed(client := Mock(), message)
+    reader.recv(client)
+    return [(kind, bytes(protocol.payload(frame))) for kind, frame in protocol.expand(reader.frames())]
+
+# A message large enough to be compressed, and one too small for it
+LARGE = protocol.encode_chat(protocol.encode_sender("Sender"), b'All work and no play makes Jack a dull boy. ' * 40)
+SMALL = protocol.encode_chat(protocol.encode_sender("Sender"), b'hello')
+
+# Test 1: Frames come out of compression as they went in
+def test_round_trip():
+    """
+    Test case where a large message and a small one are compressed together. The result
+    should be much smaller, and hold both messages once decompressed.
+    """
+    compressed = protocol.compress(LARGE + SMALL)
+
+    assert len(compressed) < len(LARGE) / 5
+    assert received(compressed) == [(protocol.CHAT, bytes(protocol.payload(LARGE))),
+                                    (protocol.CHAT, bytes(protocol.payload(SMALL)))]
+
+# Test 2: Frames that don't get smaller are left as they are
+def test_incompressible():
+    """
+    Test case where a small message is compressed. It should be returned unchanged, since
+    compressing it would only make it larger.
+    """
+    assert protocol.compress(SMALL) is SMALL
+
+# Test 3: Invalid compressed frames are refused
+@patch('protocol.MAX_DECOMPRESSED_SIZE', 1024)  # Largest content of a compressed frame
+@pytest.mark.parametrize('payload', [
+    protocol.payload(protocol.compress(LARGE)),  # Over the limit once decompressed
+    protocol.payload(protocol.compress(protocol.compress(LARGE) + SMALL * 20)),  # A compressed frame in a compressed frame
+    protocol.payload(protocol.compress(LARGE))[:-10],  # Cut
+    b'not deflate at all',
+])
+def test_invalid(payload):
+    """
+    Test case where the payload of a compressed frame is too large once decompressed, nested,
+    cut or not compressed at all. It should fail like any invalid frame.
+    """
+    with pytest.raises(protocol.FrameError):
+        protocol.decompress(payload)
+
+# Test 4: Compression is agreed on during the handshake
+@pytest.mark.parametrize('threshold, features, expected', [
+    (512, protocol.COMPRESSION, True),  # Both sides support it
+    (512, 0, False),  # The client doesn't
+    (0, protocol.COMPRESSION, False),  # The server has it turned off
+])
+@patch('server.history', new=History(0))  # No messages to replay
+@patch('server.timers', new_callable=lambda: TimerWheel(0))  # Mocking the deadlines of the clients
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_negotiation(mock_registry, mock_selector, mock_timers, threshold, features, expected):
+    """
+    Test case where a client answers the nickname request with or without the compression
+    feature, to a server with compression on or off. Only clients that support it on a
+    server that offers it should get compressed messages.
+    """
+    client = Mock()
+    session = Session(client, protocol.FrameReader(), Outbox())
+    mock_registry.add(session)
+    feed(client, protocol.encode_nick("TestUser", features=features))
+
+    with patch('server.COMPRESS_THRESHOLD', threshold):
+        assert handle(client) is True
+
+    assert session.nickname == "TestUser"
+    assert session.compress is expected
+
+# Test 5: A large broadcast is compressed once for every client that supports it
+@patch('server.history', new=History(0))  # No messages to replay
+@patch('server.metrics', new_callable=Metrics)  # Mocking the metrics in the server module
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+@patch('protocol.compress', wraps=protocol.compress)  # Counting the compressions
+def test_broadcast_once(mock_compress, mock_registry, mock_metrics):
+    """
+    Test case where a large and a small message are broadcast to two clients that support
+    compression and one that doesn't. The large one should be compressed once and the same
+    frame queued for both, the small one and the other client get the messages as they are.
+    """
+    first = add_client(mock_registry, Mock(), "First", compress=True)
+    second = add_client(mock_registry, Mock(), "Second", compress=True)
+    plain = add_client(mock_registry, Mock(), "Plain")
+
+    broadcast(LARGE)
+    broadcast(SMALL)
+
+    mock_compress.assert_called_once_with(LARGE)
+    assert first.outbox.messages[0] is second.outbox.messages[0]  # Shared, never copied
+    assert received(first.outbox.messages[0]) == received(LARGE)
+    assert first.outbox.messages[1] is SMALL
+    assert list(plain.outbox.messages) == [LARGE, SMALL]
+    assert mock_metrics.compressed == 1
+    assert mock_metrics.compression_saved == 2 * (len(LARGE) - len(first.outbox.messages[0]))
+
+# Test 6: Large messages may also be sent compressed
+@patch('server.history', new=History(0))  # No messages to replay
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_compressed_from_client(mock_registry, mock_selector):
+    """
+    Test case where a client sends a large message compressed. It should be broadcast with
+    its sender like any other message.
+    """
+    sender = add_client(mock_registry, Mock(), "Sender", compress=True)
+    receiver = add_client(mock_registry, Mock(), "Receiver")
+    text = b'All work and no play makes Jack a dull boy. ' * 40
+    feed(sender.sock, protocol.compress(protocol.encode(protocol.TEXT, text)))
+
+    assert handle(sender.sock) is True
+
+    assert list(receiver.outbox.messages) == [LARGE]
+
+# Test 7: A client sending an invalid compressed frame is removed
+@patch('server.metrics', new_callable=Metrics)  # Mocking the metrics in the server module
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_invalid_from_client(mock_registry, mock_selector, mock_metrics):
+    """
+    Test case where a client sends a compressed frame that can't be decompressed. The
+    handling should fail so the client is removed.
+    """
+    session = add_client(mock_registry, Mock(), "TestUser")
+    feed(session.sock, protocol.encode(protocol.COMPRESSED, b'not deflate at all'))
+
+    assert handle(session.sock) is False
+    assert mock_metrics.forced_removals == 1
+
+# Test 8: The history replayed to a client is compressed as a whole
+@patch('server.timers', new_callable=lambda: TimerWheel(0))  # Mocking the deadlines of the clients
+@patch('server.history', new=History(10))  # Messages replayed to the clients entering a room
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_replay(mock_registry, mock_selector, mock_timers):
+    """
+    Test case where a client that supports compression joins a room with messages in its
+    history. They should be queued as a single compressed frame holding all of them.
+    """
+    add_client(mock_registry, Mock(), "Sender")
+    messages = [protocol.encode_chat(protocol.encode_sender("Sender"), f"message {i}, with the same words as every other message".encode()) for i in range(20)]
+    for message in messages:
+        broadcast(message, room='lobby')
+    client = Mock()
+    session = Session(client, protocol.FrameReader(), Outbox())
+    mock_registry.add(session)
+    feed(client, protocol.encode_nick("TestUser", features=protocol.COMPRESSION))
+
+    assert handle(client) is True
+
+    replay = session.outbox.messages[0]
+    assert protocol.HEADER.unpack_from(replay)[1] == protocol.COMPRESSED
+    assert received(replay) == received(b''.join(messages[-10:]))
+    assert len(replay) < len(b''.join(messages[-10:])) / 2
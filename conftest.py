@@ -0,0 +1,53 @@
+import protocol  # Framing of the messages
+from registry import DEFAULT_ROOM, Session  # Sessions of the connected clients
+from server import Outbox  # Outbound buffers of the sessions
+
+# Helpers shared by the tests of the server, imported with `from conftest import ...`
+
+def add_pending(registry, client, timers=None, deadline=None):
+    """
+    Registers a mock client that has not sent its nickname yet, with a handshake deadline
+    in the timers if one is given.
+    """
+    session = Session(client, protocol.FrameReader(), Outbox())
+    registry.add(session)
+    if timers is not None:
+        timers.schedule(session, deadline)
+    return session
+
+def add_client(registry, client, nickname, room=DEFAULT_ROOM, color=protocol.DEFAULT_COLOR, compress=False, limiter=None):
+    """
+    Registers a mock client as if it had finished its handshake with the given nickname and
+    color, and moved to the given room. It may say it supports compression, and have rate
+    limits.
+    """
+    session = add_pending(registry, client)
+    registry.join(session, nickname, room, color)
+    session.compress = compress
+    session.limiter = limiter
+    return session
+
+def feed(client, *chunks):
+    """
+    Makes the mock client's 'recv_into' deliver each chunk of data in turn, the way a socket
+    fills the receive buffer it is given. The last chunk is delivered again by any read after it.
+    """
+    chunks = list(chunks)
+    def recv_into(buffer):
+        data = chunks.pop(0) if len(chunks) > 1 else chunks[0]
+        buffer[:len(data)] = data
+        return len(data)
+    client.recv_into.side_effect = recv_into
+
+def texts(session):
+    """
+    Returns the text of the messages queued for a session, without the sender of the chat
+    messages.
+    """
+    texts = []
+    for message in session.outbox.messages:
+        text = protocol.payload(message)
+        if protocol.HEADER.unpack_from(message)[1] == protocol.CHAT:
+            nickname, color, text = protocol.decode_sender(text)
+        texts.append(bytes(text))
+    return texts
@@ -0,0 +1,174 @@
+import pytest
+from unittest.mock import Mock, patch
+import protocol  # Framing of the messages
+from history import History  # Recent messages of the rooms
+from metrics import Metrics  # Counters of the server
+from offline import OfflineQueues  # Importing the queues to be tested
+from registry import Registry  # Sessions of the connected clients
+from timerwheel import TimerWheel  # Deadlines of the clients
+from server import handle  # Importing the functions to be tested from the server module
+import client as chat_client
+from conftest import add_pending, add_client, feed  # Helpers shared by the tests
+
+# Test 1: A nickname keeps only its newest messages
+def test_queue_size():
+    """
+    Test case where more messages are kept for a nickname than its queue holds. The oldest
+    should be dropped, the others delivered in order, once.
+    """
+    queues = OfflineQueues(size=2, ttl=60)
+    for message in (b'one', b'two', b'six'):
+        assert queues.put("Away", message, 0) is True
+
+    assert len(queues) == 2
+    assert queues.take("Away", 10) == [b'two', b'six']
+    assert queues.take("Away", 10) == []
+    assert len(queues) == 0
+    assert queues.bytes == 0
+
+# Test 2: Messages waiting too long are dropped
+def test_queue_ttl():
+    """
+    Test case where a nickname joins after some of its messages expired. Only the recent
+    ones should be delivered.
+    """
+    queues = OfflineQueues(size=10, ttl=60)
+    queues.put("Away", b'old', 0)
+    queues.put("Away", b'new', 30)
+
+    assert queues.take("Away", 70) == [b'new']
+    assert queues.bytes == 0
+
+# Test 3: Past the byte limit, the queues written to least recently are dropped
+def test_queue_bytes():
+    """
+    Test case where messages for three nicknames go over the byte limit. The queue of the
+    nickname written to least recently should be dropped whole.
+    """
+    queues = OfflineQueues(size=10, ttl=60, max_bytes=10)
+    queues.put("First", b'aaaa', 0)
+    queues.put("Second", b'bbbb', 1)
+    queues.put("First", b'cc', 2)  # First is now the most recent
+    queues.put("Third", b'dddd', 3)
+
+    assert "Second" not in queues
+    assert queues.bytes == 10
+    assert queues.take("First", 4) == [b'aaaa', b'cc']
+    assert queues.put("Huge", b'x' * 11, 5) is False  # Would never fit
+
+# Test 4: A direct message only reaches its recipient
+@patch('server.metrics', new_callable=Metrics)  # Mocking the metrics in the server module
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_direct(mock_registry, mock_selector, mock_metrics):
+    """
+    Test case where a client sends a direct message to another one. Only the recipient
+    should get it, with the sender the server knows.
+    """
+    sender = add_client(mock_registry, Mock(), "Sender")
+    recipient = add_client(mock_registry, Mock(), "Recipient")
+    other = add_client(mock_registry, Mock(), "Other")
+    feed(sender.sock, chat_client.build_message("/msg Recipient just for you"))
+
+    assert handle(sender.sock) is True
+
+    assert list(recipient.outbox.messages) == [protocol.encode_direct(sender.sender, b'just for you')]
+    assert not other.outbox
+    assert not sender.outbox  # Nothing echoed
+    assert mock_metrics.direct_messages == 1
+
+# Test 5: A direct message for a nickname that is not connected waits for it to join
+@patch('server.offline', new_callable=OfflineQueues)  # Mocking the direct messages kept for later
+@patch('server.history', new=History(0))  # No messages to replay
+@patch('server.timers', new_callable=lambda: TimerWheel(0))  # Mocking the deadlines of the clients
+@patch('server.metrics', new_callable=Metrics)  # Mocking the metrics in the server module
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_offline(mock_registry, mock_selector, mock_metrics, mock_timers, mock_offline):
+    """
+    Test case where a client sends a direct message to a nickname nobody uses, then a client
+    joins with it. The sender should be told, and the message delivered at the handshake.
+    """
+    sender = add_client(mock_registry, Mock(), "Sender")
+    feed(sender.sock, protocol.encode_msg("Later", "see you"))
+
+    assert handle(sender.sock) is True
+    assert list(sender.outbox.messages) == [protocol.encode_text("Later is not connected, the message will be delivered when they join")]
+    assert len(mock_offline) == 1
+
+    later = add_pending(mock_registry, Mock())
+    feed(later.sock, protocol.encode_nick("Later"))
+    assert handle(later.sock) is True
+
+    assert list(later.outbox.messages) == [protocol.encode_direct(sender.sender, b'see you')]
+    assert len(mock_offline) == 0
+    assert (mock_metrics.offline_queued, mock_metrics.offline_delivered) == (1, 1)
+
+# Test 6: Direct messages without a recipient or a text are refused
+@pytest.mark.parametrize('line, error', [
+    ("/msg Recipient", "Direct messages need a nickname and a text: /msg <nickname> <text>"),
+    ("/msg", "Direct messages need a nickname and a text: /msg <nickname> <text>"),
+    ("/msg Sender hello", "You can't send a direct message to yourself"),
+])
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_invalid_direct(mock_registry, mock_selector, line, error):
+    """
+    Test case where a client sends a direct message missing its text or recipient, or to
+    itself. It should be told why, and nobody else get anything.
+    """
+    sender = add_client(mock_registry, Mock(), "Sender")
+    recipient = add_client(mock_registry, Mock(), "Recipient")
+    feed(sender.sock, chat_client.build_message(line))
+
+    assert handle(sender.sock) is True
+
+    assert list(sender.outbox.messages) == [protocol.encode_error(error)]
+    assert not recipient.outbox
+
+# Test 7: A nickname already used is refused
+@patch('server.broadcast')  # Mocking the 'broadcast' function in the server module
+@patch('server.timers', new_callable=lambda: TimerWheel(0))  # Mocking the deadlines of the clients
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_duplicate_nickname(mock_registry, mock_selector, mock_timers, mock_broadcast):
+    """
+    Test case where a client sends the nickname of a connected client. It should be told and
+    asked for another one, and the connected client keep it.
+    """
+    first = add_client(mock_registry, Mock(), "TestUser")
+    second = add_pending(mock_registry, Mock())
+    feed(second.sock, protocol.encode_nick("TestUser"))
+
+    assert handle(second.sock) is True
+
+    assert second.nickname is None  # Still in its handshake
+    assert list(second.outbox.messages) == [protocol.encode_error("The nickname TestUser is already taken"),
+                                            protocol.encode_prompt(protocol.COMPRESSION)]
+    assert mock_registry.find("TestUser") is first
+    mock_broadcast.assert_not_called()
+
+# Test 8: The client shows direct messages apart from the chat
+def test_render_direct():
+    """
+    Test case where the client gets a direct message from a blue user. It should be shown
+    as private.
+    """
+    message = protocol.encode_direct(protocol.encode_sender('Bob', 4), b'psst')
+
+    assert chat_client.render(protocol.DIRECT, protocol.payload(message)) == '\x1b[34mBob\x1b[0m (private): psst'
+
+# Test 9: A direct message to a nickname that is not UTF-8 is refused
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_direct_not_utf8(mock_registry, mock_selector):
+    """
+    Test case where a client sends a direct message whose nickname is not valid UTF-8. It
+    should be told why, and the server keep going.
+    """
+    sender = add_client(mock_registry, Mock(), "Sender")
+    feed(sender.sock, protocol.encode(protocol.MSG, b'\xff\xfe\0hello'))
+
+    assert handle(sender.sock) is True
+
+    assert list(sender.outbox.messages) == [protocol.encode_error("Direct messages need a nickname and a text: /msg <nickname> <text>")]
@@ -1,7 +1,10 @@
 import pytest
 import socket
 from unittest.mock import Mock, patch
+import protocol  # Framing of the messages
+from registry import Registry  # Sessions of the connected clients
 from server import handle  # Importing the 'handle' function from the server module
+from conftest import add_client, feed  # Helpers shared by the tests
 
 # Fixture to set up a mock client 
 @pytest.fixture
@@ -11,98 +14,159 @@ def setup_clients_and_nicknames():
     This mock client will be used in the test cases to simulate communication between the server and the client.
     """
     client = Mock()  # Create a mock client
-    client.recv = Mock()  # Mock the 'recv' method to simulate receiving data from the client
+    client.recv_into = Mock()  # Mock the 'recv_into' method to simulate receiving data from the client
     return client  # Return the mock client to use in tests
 
+def chat(nickname, text):
+    """
+    Returns the frame the server broadcasts for a chat message sent by the given client.
+    """
+    return protocol.encode_chat(protocol.encode_sender(nickname), text)
+
 # Test 1: Optimal case - client sends a valid message
-@patch('server.nicknames', new_callable=dict)  # Mocking 'nicknames' dictionary in the server module
-@patch('server.clients', new_callable=list)  # Mocking 'clients' list in the server module
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
 @patch('server.broadcast')  # Mocking the 'broadcast' function in the server module
-def test_handle_optimal(mock_broadcast, mock_clients, mock_nicknames, setup_clients_and_nicknames):
+def test_handle_optimal(mock_broadcast, mock_registry, setup_clients_and_nicknames):
     """
     Test case where the client sends a valid message. The message should be broadcast to all other clients.
     The function should return True in this optimal case.
     """
     client = setup_clients_and_nicknames  # Set up a mock client using the fixture
-    mock_clients.append(client)  # Add the mock client to the clients list
-    mock_nicknames[client] = "TestUser"  # Add a nickname for the mock client
+    add_client(mock_registry, client, "TestUser")  # Add the mock client with a nickname to the registry
     
     # Mock the client sending a valid message
-    client.recv.return_value = b'Hello, world!'  # Simulate receiving a message from the client
+    message = protocol.encode(protocol.TEXT, b'Hello, world!')
+    feed(client, message)  # Simulate receiving a message from the client
     
     # Call the handle function with the mock client
     result = handle(client)  # The handle function processes the message
     
     # Assertions to check the expected behavior
-    mock_broadcast.assert_called_once_with(b'Hello, world!', client)  # Ensure the broadcast function is called with the correct message
+    mock_broadcast.assert_called_once_with(chat('TestUser', protocol.payload(message)), client, 'lobby')  # Ensure the broadcast function is called with the correct message
     assert result is True  # Ensure the handle function returns True (indicating a successful operation)
 
 # Test 2: Client exits gracefully (no message sent)
-@patch('server.nicknames', new_callable=dict)  # Mocking 'nicknames' dictionary in the server module
-@patch('server.clients', new_callable=list)  # Mocking 'clients' list in the server module
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
 @patch('server.broadcast')  # Mocking the 'broadcast' function in the server module
-def test_handle_client_exit(mock_broadcast, mock_clients, mock_nicknames, setup_clients_and_nicknames):
+def test_handle_client_exit(mock_broadcast, mock_registry, setup_clients_and_nicknames):
     """
     Test case where the client disconnects (sends an empty message). This simulates a graceful exit.
     The function should broadcast a message indicating the client has left the chat.
     """
     client = setup_clients_and_nicknames  # Set up a mock client using the fixture
-    mock_clients.append(client)  # Add the mock client to the clients list
-    mock_nicknames[client] = "TestUser"  # Add a nickname for the mock client
+    add_client(mock_registry, client, "TestUser")  # Add the mock client with a nickname to the registry
     
     # Simulate the client sending no message (disconnection)
-    client.recv.return_value = b''  # Simulate an empty message indicating client exit
+    feed(client, b'')  # Simulate an empty message indicating client exit
     
     # Call the handle function
     result = handle(client)  # The handle function should handle the disconnection
     
     # Assertions to verify the expected behavior
-    mock_broadcast.assert_called_once_with("TestUser left the chat.".encode('utf-8'))  # Ensure the exit message is broadcasted
+    mock_broadcast.assert_called_once_with(protocol.encode_leave(protocol.encode_sender("TestUser")), client, 'lobby')  # Ensure the exit message is broadcasted to the client's room
     assert result is False  # The function should return False when the client exits gracefully
 
 # Test 3: Client encounters a socket error
-@patch('server.nicknames', new_callable=dict)  # Mocking 'nicknames' dictionary in the server module
-@patch('server.clients', new_callable=list)  # Mocking 'clients' list in the server module
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
 @patch('server.broadcast')  # Mocking the 'broadcast' function in the server module
-def test_handle_socket_error(mock_broadcast, mock_clients, mock_nicknames, setup_clients_and_nicknames):
+def test_handle_socket_error(mock_broadcast, mock_registry, setup_clients_and_nicknames):
     """
-    Test case where the client encounters a socket error while receiving data.
-    The function should not broadcast any message and should return False due to the error.
+    Test case where the client encounters a socket error while receiving data, like a reset connection.
+    The function should tell the client's room that it left and return False due to the error.
     """
     client = setup_clients_and_nicknames  # Set up a mock client using the fixture
-    mock_clients.append(client)  # Add the mock client to the clients list
-    mock_nicknames[client] = "TestUser"  # Add a nickname for the mock client
+    add_client(mock_registry, client, "TestUser")  # Add the mock client with a nickname to the registry
     
     # Simulate a socket error during data reception
-    client.recv.side_effect = socket.error("Socket error during recv")  # Raise a socket error when trying to recv
+    client.recv_into.side_effect = socket.error("Socket error during recv")  # Raise a socket error when trying to recv
     
     # Call the handle function
     result = handle(client)  # The handle function should handle the error
     
     # Assertions to verify the expected behavior
-    mock_broadcast.assert_not_called()  # Ensure that no broadcast happens when there's a socket error
+    mock_broadcast.assert_called_once_with(protocol.encode_leave(protocol.encode_sender("TestUser")), client, 'lobby')  # The room hears it left, like on a clean exit
     assert result is False  # The function should return False due to the socket error
+    client.recv_into.assert_called_once()  # No retries that would stall the other clients
 
 # Test 4: Client sends a message that is too long
-@patch('server.nicknames', new_callable=dict)  # Mocking 'nicknames' dictionary in the server module
-@patch('server.clients', new_callable=list)  # Mocking 'clients' list in the server module
+@patch('protocol.MAX_MESSAGE_SIZE', 1024)  # Limit the size of the messages to 1024 bytes
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
 @patch('server.broadcast')  # Mocking the 'broadcast' function in the server module
-def test_handle_long_message(mock_broadcast, mock_clients, mock_nicknames, setup_clients_and_nicknames):
+def test_handle_long_message(mock_broadcast, mock_registry, setup_clients_and_nicknames):
     """
     Test case where the client sends a message that is too long (e.g., longer than the allowed size).
-    The function should not broadcast the message and should return False.
+    The function should not broadcast the message, only that the client left, and should return False.
     """
     client = setup_clients_and_nicknames  # Set up a mock client using the fixture
-    mock_clients.append(client)  # Add the mock client to the clients list
-    mock_nicknames[client] = "TestUser"  # Add a nickname for the mock client
+    add_client(mock_registry, client, "TestUser")  # Add the mock client with a nickname to the registry
     
     # Mock the client sending a message that exceeds the allowed length (e.g., 2048 bytes)
-    long_message = b'A' * 2048  # Simulate a message longer than 1024 bytes (limit)
-    client.recv.return_value = long_message  # Simulate receiving a long message
+    long_message = protocol.encode(protocol.TEXT, b'A' * 2048)  # Simulate a message longer than 1024 bytes (limit)
+    feed(client, long_message)  # Simulate receiving a long message
     
     # Call the handle function
     result = handle(client)  # The handle function should handle the long message case
     
     # Assertions to verify the expected behavior
-    mock_broadcast.assert_not_called()  # Ensure no broadcast happens for a long message
+    mock_broadcast.assert_called_once_with(protocol.encode_leave(protocol.encode_sender("TestUser")), client, 'lobby')  # Ensure the long message is not broadcast, only the departure
     assert result is False  # The function should return False for long messages
+
+# Test 5: Client sends a message larger than a single read used to be
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+@patch('server.broadcast')  # Mocking the 'broadcast' function in the server module
+def test_handle_large_message(mock_broadcast, mock_registry, setup_clients_and_nicknames):
+    """
+    Test case where the client sends a 2048 byte message, under the size limit.
+    The whole message should be broadcast at once.
+    """
+    client = setup_clients_and_nicknames  # Set up a mock client using the fixture
+    add_client(mock_registry, client, "TestUser")  # Add the mock client to the registry
+    
+    message = protocol.encode(protocol.TEXT, b'A' * 2048)
+    feed(client, message)  # Simulate receiving the large message
+    
+    result = handle(client)
+    
+    mock_broadcast.assert_called_once_with(chat('TestUser', protocol.payload(message)), client, 'lobby')  # The message was not cut
+    assert result is True
+
+# Test 6: Several messages arrive glued together in a single read
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+@patch('server.broadcast')  # Mocking the 'broadcast' function in the server module
+def test_handle_glued_messages(mock_broadcast, mock_registry, setup_clients_and_nicknames):
+    """
+    Test case where TCP merges two messages into a single read.
+    Both messages should be broadcast separately.
+    """
+    client = setup_clients_and_nicknames  # Set up a mock client using the fixture
+    add_client(mock_registry, client, "TestUser")  # Add the mock client to the registry
+    
+    first = protocol.encode(protocol.TEXT, b'Hello')
+    second = protocol.encode(protocol.TEXT, b'World')
+    feed(client, first + second)  # Simulate both messages arriving at once
+    
+    result = handle(client)
+    
+    assert mock_broadcast.call_args_list == [((chat('TestUser', b'Hello'), client, 'lobby'),),
+                                             ((chat('TestUser', b'World'), client, 'lobby'),)]  # Each message is broadcast on its own
+    assert result is True
+
+# Test 7: A message arrives split across two reads
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+@patch('server.broadcast')  # Mocking the 'broadcast' function in the server module
+def test_handle_split_message(mock_broadcast, mock_registry, setup_clients_and_nicknames):
+    """
+    Test case where TCP splits a message across two reads.
+    Nothing should be broadcast until the message is complete.
+    """
+    client = setup_clients_and_nicknames  # Set up a mock client using the fixture
+    add_client(mock_registry, client, "TestUser")  # Add the mock client to the registry
+    
+    message = protocol.encode(protocol.TEXT, b'Hello, world!')
+    feed(client, message[:7], message[7:])  # Simulate the message arriving in two parts
+    
+    assert handle(client) is True  # First part received
+    mock_broadcast.assert_not_called()  # Nothing is broadcast with half a message
+    
+    assert handle(client) is True  # Rest of the message received
+    mock_broadcast.assert_called_once_with(chat('TestUser', protocol.payload(message)), client, 'lobby')  # The whole message is broadcast
@@ -0,0 +1,110 @@
+import json
+import socket
+import struct
+import protocol
+
+# A running server hands its listening socket and its clients over to a new
+# process through a Unix socket: the sockets themselves go as SCM_RIGHTS
+# ancillary data, then the state of the clients follows as frames, with the
+# same framing as the chat protocol. The clients keep their connections, and
+# never see the server change
+
+# Types of frame sent over the handoff socket
+SOCKETS = 1  # Carries up to FDS_PER_FRAME sockets: their count, then the count of all of them
+SESSION = 2  # A client, as JSON, in the order of the sockets (the listening socket comes first)
+INPUT = 3  # Bytes the client sent that were not handled yet
+OUTPUT = 4  # A message waiting to be sent to the client, only its unsent end for the first one
+HISTORY = 5  # A recent message of a room: the room's length and name, then the message
+OFFLINE = 6  # A direct message for a nickname that is not connected: seconds left, then like HISTORY
+END = 7  # Everything was sent
+ACK = 8  # From the new process: every client is restored, the old process may let go of them
+
+# Sockets passed per frame, under the kernel's limit of 253 (SCM_MAX_FD)
+FDS_PER_FRAME = 250
+COUNTS = struct.Struct('!HI')
+SOCKETS_FRAME_SIZE = protocol.HEADER.size + COUNTS.size
+
+EXPIRY = struct.Struct('!d')
+
+# Largest frame accepted over the handoff socket (bytes). Unhandled input and
+# queued messages can be larger than anything a client may send
+MAX_FRAME = 64 * 1024 * 1024
+
+# Raised when the handoff can't be completed
+class HandoffError(Exception):
+    pass
+
+# Send the sockets in order, FDS_PER_FRAME per message
+def send_sockets(link, sockets):
+    fds = [sock.fileno() for sock in sockets]
+    for start in range(0, len(fds), FDS_PER_FRAME):
+        batch = fds[start:start + FDS_PER_FRAME]
+        socket.send_fds(link, [protocol.encode(SOCKETS, COUNTS.pack(len(batch), len(fds)))], batch)
+
+# Receive the sockets sent by send_sockets(), in the same order
+def receive_sockets(link):
+    sockets = []
+    total = None
+    while total is None or len(sockets) < total:
+        # The frame is read alone, so the sockets it carries are not merged with the next ones
+        data, fds, flags, address = socket.recv_fds(link, SOCKETS_FRAME_SIZE, FDS_PER_FRAME)
+        sockets.extend(socket.socket(fileno=fd) for fd in fds)
+        if flags & socket.MSG_CTRUNC:
+            raise HandoffError("Some sockets were lost on the way, the process may be out of file descriptors")
+        if len(data) < SOCKETS_FRAME_SIZE:
+            raise HandoffError("The handoff socket was closed before every socket was sent")
+
+        length, kind = protocol.HEADER.unpack_from(data)
+        count, total = COUNTS.unpack_from(data, protocol.HEADER.size)
+        if kind != SOCKETS or count != len(fds):
+            raise HandoffError("Expected sockets on the handoff socket")
+    return sockets
+
+# Frames of the state, sent after the sockets
+def encode_session(state):
+    return protocol.encode(SESSION, json.dumps(state).encode('utf-8'))
+
+def decode_session(payload):
+    return json.loads(bytes(payload).decode('utf-8'))
+
+def encode_history(room, message):
+    room = room.encode('utf-8')
+    return protocol.encode(HISTORY, bytes([len(room)]) + room + message)
+
+# Returns the room and the message
+def decode_history(payload):
+    room, message = protocol.decode_routed(payload)
+    return room.decode('utf-8'), bytes(message)
+
+def encode_offline(nickname, expires_in, message):
+    nickname = nickname.encode('utf-8')
+    return protocol.encode(OFFLINE, EXPIRY.pack(expires_in) + bytes([len(nickname)]) + nickname + message)
+
+# Returns the nickname, the seconds the message may still wait, and the message
+def decode_offline(payload):
+    expires_in, = EXPIRY.unpack_from(payload)
+    nickname, message = protocol.decode_routed(payload[EXPIRY.size:])
+    return nickname.decode('utf-8'), expires_in, bytes(message)
+
+# Wait for the new process to confirm it took the clients over
+def receive_ack(link):
+    data = b''
+    while len(data) < protocol.HEADER.size:
+        received = link.recv(protocol.HEADER.size - len(data))
+        if not received:
+            raise HandoffError("The new process went away before taking the clients over")
+        data += received
+    if protocol.HEADER.unpack(data) != (0, ACK):
+        raise HandoffError("Expected the new process to confirm the handoff")
+
+# Yield the (type, payload) of every frame received after the sockets, until END
+def receive(link):
+    reader = protocol.FrameReader(MAX_FRAME)
+    while True:
+        if not reader.recv(link):
+            raise HandoffError("The handoff socket was closed before the state was sent")
+        for kind, frame in reader.frames():
+            if kind == END:
+                return
+            # The frames are views over the reader's buffer, reused by the next recv()
+            yield kind, bytes(protocol.payload(frame))
@@ -0,0 +1,152 @@
+import socket
+import time
+from unittest.mock import Mock, patch
+import handoff  # Importing the handoff to be tested
+import protocol  # Framing of the messages
+from registry import Registry  # Sessions of the connected clients
+from server import ChatServer, hand_over, handed_over  # Importing the functions to be tested from the server module
+from chatserver_test import connect  # Real clients of a real server
+from conftest import add_client  # Helpers shared by the tests
+
+def frames(data):
+    """
+    Returns the (type, payload) of every frame in the data.
+    """
+    reader = protocol.FrameReader(handoff.MAX_FRAME)
+    reader.load(data)
+    return [(kind, bytes(protocol.payload(frame))) for kind, frame in reader.frames()]
+
+# Test 1: Sockets reach the other process in order, several frames of them if needed
+@patch('handoff.FDS_PER_FRAME', 2)  # Fewer sockets per frame than sent
+def test_send_sockets():
+    """
+    Test case where five connected sockets are sent over a Unix socket, two per frame. The
+    received sockets should be the same connections, in the same order.
+    """
+    link, other = socket.socketpair()
+    pairs = [socket.socketpair() for _ in range(5)]
+
+    handoff.send_sockets(link, [one for one, two in pairs])
+    received = handoff.receive_sockets(other)
+
+    assert len(received) == 5
+    for index, (sock, (one, two)) in enumerate(zip(received, pairs)):
+        one.close()  # Only the received copy is left
+        sock.sendall(bytes([index]))
+        assert two.recv(1) == bytes([index])
+    for sock in [link, other] + received + [two for one, two in pairs]:
+        sock.close()
+
+# Test 2: A client is handed over with its unhandled input and the unsent part of its messages
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_handed_over(mock_registry):
+    """
+    Test case where a client that sent half a message has two messages waiting, the first
+    one partly sent. Its session, the half message and only the unsent bytes should be
+    handed over.
+    """
+    session = add_client(mock_registry, Mock(), "TestUser", color=3)
+    mock_registry.move(session, 'games')
+    session.compress = True
+    session.last_seen = 95
+    half = protocol.encode(protocol.TEXT, b'hello')[:7]
+    session.reader.load(half)
+    session.outbox.put(b'first message')
+    session.outbox.put(b'second')
+    session.outbox.offset = 6
+
+    handed = frames(b''.join(handed_over(session, 100)))
+
+    assert handed[0] == (handoff.SESSION, handoff.encode_session({'nickname': "TestUser", 'color': 3, 'room': 'games',
+                                                                  'compress': True, 'idle': 5})[protocol.HEADER.size:])
+    assert handed[1:] == [(handoff.INPUT, half), (handoff.OUTPUT, b'message'), (handoff.OUTPUT, b'second')]
+
+# Test 3: A failed handoff leaves the clients with this process
+@patch('handoff.send_sockets', side_effect=BrokenPipeError)  # The new process went away
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_failed_handoff(mock_registry, mock_selector, mock_send_sockets):
+    """
+    Test case where the new process is gone before it got the sockets. This process should
+    keep the clients and its handoff socket, and only close the link.
+    """
+    session = add_client(mock_registry, Mock(), "TestUser", color=3)
+    session.last_seen = 0
+    listener = Mock()
+    link = Mock()
+    listener.accept.return_value = (link, None)
+
+    assert hand_over(listener) is False
+
+    assert mock_registry.get(session.sock) is session
+    session.sock.close.assert_not_called()
+    listener.close.assert_not_called()
+    link.close.assert_called_once()
+
+# Test 4: A new process takes the clients over without them noticing
+def test_take_over(tmp_path):
+    """
+    Test case where a server in another process hands its clients over to a server in this
+    one, while a client is in the middle of sending a message and a direct message waits for
+    its recipient. The clients should keep their connections and rooms, the message arrive
+    whole, and the history and direct message be there for the next client.
+    """
+    path = str(tmp_path / 'handoff.sock')
+    old = ChatServer(port=0, handoff=path)
+    process = old.run_in_process()
+    first, first_received = connect(old.port, "First")
+    second, second_received = connect(old.port, "Second")
+    assert next(first_received) == (protocol.JOIN, protocol.encode_sender("Second"))
+    assert next(second_received) == (protocol.JOIN, protocol.encode_sender("First"))  # Replayed from the history
+
+    first.sendall(protocol.encode(protocol.TEXT, b'before'))
+    assert next(second_received) == (protocol.CHAT, protocol.encode_sender("First") + b'before')
+    first.sendall(protocol.encode_msg("Later", "see you"))
+    assert next(first_received)[0] == protocol.TEXT  # Will be delivered later
+    message = protocol.encode(protocol.TEXT, b'across the handoff')
+    first.sendall(message[:7])
+    time.sleep(0.2)  # Read by the old process
+
+    new = ChatServer(handoff=path, take_over=True)
+    new.run_in_thread()
+    try:
+        process.join(5)
+        assert process.exitcode == 0  # The old process is done
+        assert new.port == old.port
+
+        first.sendall(message[7:])
+        assert next(second_received) == (protocol.CHAT, protocol.encode_sender("First") + b'across the handoff')
+        later, later_received = connect(new.port, "Later")
+        replayed = [next(later_received) for _ in range(5)]
+        assert (protocol.CHAT, protocol.encode_sender("First") + b'before') in replayed
+        assert replayed[-1] == (protocol.DIRECT, protocol.encode_sender("First") + b'see you')
+        assert next(second_received) == (protocol.JOIN, protocol.encode_sender("Later"))
+    finally:
+        new.stop()
+    for client in (first, second, later):
+        client.close()
+
+# Test 5: The clients stay with this process until the new one confirms it has them
+@patch('handoff.send_sockets')  # The sockets reach the new process
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_handoff_not_confirmed(mock_registry, mock_selector, mock_send_sockets):
+    """
+    Test case where the new process gets everything, then goes away without confirming it
+    restored the clients. This process should keep the clients and its handoff socket.
+    """
+    session = add_client(mock_registry, Mock(), "TestUser", color=3)
+    session.last_seen = 0
+    listener = Mock()
+    link = Mock()
+    link.recv.return_value = b''  # Closed before the ACK
+    listener.accept.return_value = (link, None)
+
+    assert hand_over(listener) is False
+
+    assert link.sendall.call_args_list[-1].args == (protocol.encode(handoff.END),)
+    assert mock_registry.get(session.sock) is session
+    session.sock.close.assert_not_called()
+    listener.close.assert_not_called()
+    mock_selector.unregister.assert_not_called()
+    link.close.assert_called_once()
@@ -0,0 +1,127 @@
+from unittest.mock import Mock, patch
+import protocol  # Framing of the messages
+from history import History  # Recent messages of the rooms
+from metrics import Metrics  # Counters of the server
+from registry import Registry  # Sessions of the connected clients
+from timerwheel import TimerWheel  # Deadlines of the clients
+from server import join, handle, expire_timers, Outbox  # Importing the functions to be tested from the server module
+import client as chat_client
+from conftest import add_pending, feed  # Helpers shared by the tests
+
+def join_client(registry, client, nickname):
+    """
+    Registers a mock client and finishes its handshake with the given nickname, which
+    starts its idle timer.
+    """
+    session = add_pending(registry, client)
+    join(session, nickname)
+    return session
+
+def kinds(session):
+    """
+    Returns the types of the messages queued for a session.
+    """
+    return [protocol.HEADER.unpack_from(message)[1] for message in session.outbox.messages]
+
+# Test 1: A quiet client is pinged, one that sent something is not
+@patch('server.PING_INTERVAL', 30)  # Seconds before a quiet client is pinged
+@patch('server.IDLE_TIMEOUT', 90)  # Seconds before a quiet client is dropped
+@patch('server.timers', new_callable=lambda: TimerWheel(100))  # Mocking the deadlines of the clients
+@patch('server.history', new=History(0))  # No messages to replay
+@patch('server.metrics', new_callable=Metrics)  # Mocking the metrics in the server module
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+@patch('server.time.monotonic', return_value=100)  # The current time
+def test_ping(mock_monotonic, mock_registry, mock_selector, mock_metrics, mock_timers):
+    """
+    Test case where two clients join at the same time and only one of them sends a message
+    afterwards. After the ping interval only the quiet one should be pinged.
+    """
+    quiet = join_client(mock_registry, Mock(), "Quiet")
+    chatty = join_client(mock_registry, Mock(), "Chatty")
+    quiet.outbox = Outbox()  # Forget the join announcement
+
+    mock_monotonic.return_value = 120
+    feed(chatty.sock, protocol.encode(protocol.TEXT, b'Chatty: hello'))
+    assert handle(chatty.sock) is True
+    chatty.outbox = Outbox()
+    quiet.outbox = Outbox()
+
+    mock_monotonic.return_value = 130
+    expire_timers()
+
+    assert kinds(quiet) == [protocol.PING]
+    assert kinds(chatty) == []  # Its check moved to 150
+    assert mock_metrics.pings == 1
+
+# Test 2: A client that never answers is dropped after the idle timeout
+@patch('server.PING_INTERVAL', 30)  # Seconds before a quiet client is pinged
+@patch('server.IDLE_TIMEOUT', 90)  # Seconds before a quiet client is dropped
+@patch('server.timers', new_callable=lambda: TimerWheel(100))  # Mocking the deadlines of the clients
+@patch('server.history', new=History(0))  # No messages to replay
+@patch('server.metrics', new_callable=Metrics)  # Mocking the metrics in the server module
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+@patch('server.time.monotonic', return_value=100)  # The current time
+def test_idle_timeout(mock_monotonic, mock_registry, mock_selector, mock_metrics, mock_timers):
+    """
+    Test case where a client stops answering while another one answers every ping. The
+    silent one should be pinged twice, then removed and its room told.
+    """
+    silent = join_client(mock_registry, Mock(), "Silent")
+    alive = join_client(mock_registry, Mock(), "Alive")
+
+    for now in (130, 160, 190):
+        mock_monotonic.return_value = now
+        expire_timers()
+        # Only the live client answers
+        feed(alive.sock, protocol.encode(protocol.PONG))
+        assert handle(alive.sock) is True
+
+    assert silent.sock not in mock_registry
+    silent.sock.close.assert_called_once()
+    assert mock_metrics.pings == 5  # Twice the silent client, every interval the one that only answers
+    assert mock_metrics.idle_timeouts == 1
+    assert protocol.encode_leave(silent.sender) in alive.outbox.messages
+    assert alive.sock in mock_registry
+    assert alive in mock_timers  # Checked again later
+
+# Test 3: The server answers pings, and pongs are not broadcast
+@patch('server.timers', new_callable=lambda: TimerWheel(0))  # Mocking the deadlines of the clients
+@patch('server.history', new=History(0))  # No messages to replay
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_ping_pong(mock_registry, mock_selector, mock_timers):
+    """
+    Test case where a client sends a ping and a pong. It should get a pong back, and the
+    other clients nothing.
+    """
+    sender = join_client(mock_registry, Mock(), "Sender")
+    other = join_client(mock_registry, Mock(), "Other")
+    sender.outbox = Outbox()
+    feed(sender.sock, protocol.encode(protocol.PING) + protocol.encode(protocol.PONG))
+
+    assert handle(sender.sock) is True
+
+    assert kinds(sender) == [protocol.PONG]
+    assert kinds(other) == []
+
+# Test 4: The client answers the server's pings
+@patch('client.nickname', 'TestUser', create=True)  # Nickname chosen by the user
+@patch('client.client', create=True)  # Mocking the socket connected to the server
+def test_client_pong(mock_client, capsys):
+    """
+    Test case where the server pings the client, then closes the connection. The client
+    should answer with a pong.
+    """
+    calls = iter([protocol.encode(protocol.PING), b''])
+    def deliver(buffer):
+        chunk = next(calls)
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+    mock_client.recv_into.side_effect = deliver
+
+    chat_client.receive()
+
+    mock_client.sendall.assert_called_once_with(protocol.encode(protocol.PONG))
+    assert "The server closed the connection" in capsys.readouterr().out
@@ -0,0 +1,175 @@
+import mmap
+import os
+import time
+from collections import deque
+import protocol
+
+# Size of each log file. Files are allocated in full when created and written
+# through a memory map, so appending a message is a copy into memory
+SEGMENT_SIZE = 4 * 1024 * 1024
+
+# Log files kept on disk, the oldest is deleted when a new one is started
+MAX_SEGMENTS = 8
+
+# Seconds between two flushes of the log to disk
+FSYNC_INTERVAL = 1.0
+
+# Yield (end offset, room, message) for every record of a log file's contents.
+# Records are ROUTED frames, so a file can be read with the protocol's framing.
+# The unused end of a file is zeros, which is never a valid frame
+def _records(data):
+    offset = 0
+    while offset + protocol.HEADER.size <= len(data):
+        length, kind = protocol.HEADER.unpack_from(data, offset)
+        end = offset + protocol.HEADER.size + length
+        if kind != protocol.ROUTED or length == 0 or end > len(data):
+            return
+        room, message = protocol.decode_routed(data[offset + protocol.HEADER.size:end])
+        yield end, room.decode('utf-8'), bytes(message)
+        offset = end
+
+# Append-only log of the messages broadcast in rooms, split in numbered files
+class MessageLog:
+    def __init__(self, directory, segment_size=SEGMENT_SIZE, max_segments=MAX_SEGMENTS,
+                 fsync_interval=FSYNC_INTERVAL):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.fsync_interval = fsync_interval
+        self.segments = sorted(int(name[:-4]) for name in os.listdir(directory)
+                               if name.endswith('.log') and name[:-4].isdigit())
+        self.map = None
+        self.full = []  # Maps of the previous files, closed once they are synced
+        self.offset = 0  # Where the next record is written in the current file
+        self.dirty_since = None  # When the oldest record not flushed yet was written
+
+        # Keep appending to the newest file after a restart
+        if self.segments:
+            self._open(self.segments[-1])
+            for end, room, message in _records(self.map):
+                self.offset = end
+        else:
+            self._open(0)
+            self.segments.append(0)
+
+    def _path(self, number):
+        return os.path.join(self.directory, f"{number:08d}.log")
+
+    def _open(self, number):
+        fd = os.open(self._path(number), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < self.segment_size:
+                os.ftruncate(fd, self.segment_size)
+            self.map = mmap.mmap(fd, self.segment_size)
+        finally:
+            # The map keeps the file open
+            os.close(fd)
+        self.offset = 0
+
+    # Every message in the log, oldest first, as (room, message) pairs
+    def read(self):
+        for number in self.segments:
+            with open(self._path(number), 'rb') as file:
+                data = file.read()
+            for end, room, message in _records(data):
+                yield room, message
+
+    # Add a message to the log. It is in the page cache as soon as this returns,
+    # and reaches the disk with the next sync()
+    def append(self, room, message):
+        room = room.encode('utf-8')
+        size = protocol.HEADER.size + 1 + len(room) + len(message)
+        if size > self.segment_size:
+            # Would not fit in any file
+            return
+        if self.offset + size > self.segment_size:
+            self._roll()
+
+        # Write the record in place instead of building it first
+        offset = self.offset
+        protocol.HEADER.pack_into(self.map, offset, size - protocol.HEADER.size, protocol.ROUTED)
+        offset += protocol.HEADER.size
+        self.map[offset] = len(room)
+        self.map[offset + 1:offset + 1 + len(room)] = room
+        offset += 1 + len(room)
+        self.map[offset:offset + len(message)] = message
+        self.offset = offset + len(message)
+
+        if self.dirty_since is None:
+            self.dirty_since = time.monotonic()
+
+    # Start a new file, deleting the oldest ones past the limit. The previous
+    # file is synced with the next batch, so appending never waits for the disk
+    def _roll(self):
+        self.full.append(self.map)
+        number = self.segments[-1] + 1
+        self._open(number)
+        self.segments.append(number)
+        while len(self.segments) > self.max_segments:
+            os.remove(self._path(self.segments.pop(0)))
+        if self.dirty_since is None:
+            self.dirty_since = time.monotonic()
+
+    # Write the records appended since the last sync to disk
+    def sync(self):
+        if self.dirty_since is not None:
+            for full in self.full:
+                full.flush()
+                full.close()
+            self.full.clear()
+            self.map.flush()
+            self.dirty_since = None
+
+    # Sync if the oldest unsynced record is old enough, returns the seconds
+    # until the next sync is due (None if there is nothing to sync)
+    def tick(self):
+        if self.dirty_since is None:
+            return None
+        remaining = self.dirty_since + self.fsync_interval - time.monotonic()
+        if remaining > 0:
+            return remaining
+        self.sync()
+        return None
+
+    def close(self):
+        self.sync()
+        self.map.close()
+
+# Recent messages of every room, kept in memory for the clients that join
+# later, and optionally in a log that survives restarts
+class History:
+    def __init__(self, size, log=None):
+        self.size = size  # Messages kept per room
+        self.rooms = {}  # Room name -> its most recent messages
+        self.log = log
+
+        # Start from what was logged before the last restart
+        if log is not None and size:
+            for room, message in log.read():
+                self._remember(room, message)
+
+    def _remember(self, room, message):
+        recent = self.rooms.get(room)
+        if recent is None:
+            recent = self.rooms[room] = deque(maxlen=self.size)
+        recent.append(message)
+
+    # Keep a message broadcast in a room
+    def record(self, room, message):
+        if self.size:
+            self._remember(room, message)
+        if self.log is not None:
+            self.log.append(room, message)
+
+    # The most recent messages of a room, oldest first
+    def recent(self, room):
+        return self.rooms.get(room, ())
+
+    # Flush the log when it is due, returns the seconds until the next flush (None if none is needed)
+    def tick(self):
+        return self.log.tick() if self.log is not None else None
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
@@ -0,0 +1,151 @@
+import os
+import pytest
+from unittest.mock import Mock, patch
+import protocol  # Framing of the messages
+from history import History, MessageLog  # Importing the history to be tested
+from registry import Registry, Session  # Sessions of the connected clients
+from server import join, broadcast, Outbox  # Importing the functions to be tested from the server module
+
+def text(message):
+    """
+    Returns the frame of a chat message.
+    """
+    return protocol.encode(protocol.TEXT, message.encode('utf-8'))
+
+# Test 1: Only the most recent messages of each room are kept
+def test_ring_buffer():
+    """
+    Test case where more messages than the limit are recorded. Each room should keep only
+    its own newest messages, oldest first.
+    """
+    history = History(2)
+    for number in range(3):
+        history.record('lobby', text(f"lobby {number}"))
+    history.record('games', text("games 0"))
+
+    assert list(history.recent('lobby')) == [text("lobby 1"), text("lobby 2")]
+    assert list(history.recent('games')) == [text("games 0")]
+    assert list(history.recent('empty')) == []
+
+# Test 2: The log brings the history back after a restart
+def test_log_survives_restart(tmp_path):
+    """
+    Test case where messages are logged, the log is closed and opened again. The history
+    should be reloaded, and new messages appended after the old ones.
+    """
+    history = History(10, MessageLog(tmp_path))
+    history.record('lobby', text("before"))
+    history.record('games', text("in games"))
+    history.close()
+
+    history = History(10, MessageLog(tmp_path))
+    assert list(history.recent('lobby')) == [text("before")]  # Reloaded from the log
+    assert list(history.recent('games')) == [text("in games")]
+
+    history.record('lobby', text("after"))
+    history.close()
+    assert list(MessageLog(tmp_path).read()) == [('lobby', text("before")), ('games', text("in games")),
+                                                 ('lobby', text("after"))]  # Nothing was overwritten
+
+# Test 3: The log is split in files and only the newest are kept
+def test_log_segments(tmp_path):
+    """
+    Test case where the messages do not fit in one file. New files should be started and
+    the oldest deleted once there are too many.
+    """
+    message = text("x" * 20)  # 25 bytes, 36 with the room
+    log = MessageLog(tmp_path, segment_size=72, max_segments=2)
+    for _ in range(5):
+        log.append('lobby', message)
+
+    assert sorted(os.listdir(tmp_path)) == ['00000001.log', '00000002.log']  # Two messages per file
+    assert list(log.read()) == [('lobby', message)] * 3  # The two oldest went with the first file
+
+# Test 4: Messages too large for a file are not logged
+def test_log_oversized(tmp_path):
+    """
+    Test case where a message is larger than a log file. It should be skipped instead of
+    starting files it can never fit in.
+    """
+    log = MessageLog(tmp_path, segment_size=64)
+
+    log.append('lobby', text("x" * 100))
+
+    assert list(log.read()) == []
+    assert log.segments == [0]
+
+# Test 5: Writes reach the disk in batches
+@patch('history.time.monotonic')  # The current time
+def test_fsync_batching(mock_monotonic, tmp_path):
+    """
+    Test case where several messages are logged within one sync interval. The log should be
+    flushed once, when the interval is over, and not for each message.
+    """
+    log = MessageLog(tmp_path, fsync_interval=1.0)
+    assert log.tick() is None  # Nothing to flush yet
+
+    with patch.object(log, 'sync', wraps=log.sync) as mock_sync:  # Watching the flushes
+        mock_monotonic.return_value = 100
+        log.append('lobby', text("first"))
+        mock_monotonic.return_value = 100.5
+        log.append('lobby', text("second"))
+        assert log.tick() == pytest.approx(0.5)  # Half a second until the flush
+        mock_sync.assert_not_called()
+
+        mock_monotonic.return_value = 101
+        assert log.tick() is None  # Flushed, nothing left
+        mock_sync.assert_called_once()
+
+# Test 6: Broadcasts in a room are recorded
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.history', new_callable=lambda: History(10))  # Mocking the history in the server module
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_broadcast_recorded(mock_registry, mock_history, mock_selector):
+    """
+    Test case where messages are broadcast in a room and to everybody. Only the room's
+    messages belong to its history.
+    """
+    broadcast(text("in the lobby"), room='lobby')
+    broadcast(text("to everybody"))
+
+    assert list(mock_history.recent('lobby')) == [text("in the lobby")]
+
+# Test 7: A client that joins gets the recent messages first
+@patch('server.broadcast')  # Mocking the 'broadcast' function in the server module
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.history', new_callable=lambda: History(10))  # Mocking the history in the server module
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_replay_on_join(mock_registry, mock_history, mock_selector, mock_broadcast):
+    """
+    Test case where a client joins a room with history. The messages should be queued in
+    order, without writing to the socket.
+    """
+    for number in range(3):
+        mock_history.record('lobby', text(f"message {number}"))
+    session = Session(Mock(), protocol.FrameReader(), Outbox())
+    mock_registry.add(session)
+
+    join(session, "TestUser")
+
+    assert list(session.outbox.messages) == [text(f"message {number}") for number in range(3)]
+    session.sock.send.assert_not_called()  # Sent later, when the socket is writable
+
+# Test 8: The replay never fills the outbound buffer
+@patch('server.LOW_WATERMARK', 40)  # Room for two messages
+@patch('server.broadcast')  # Mocking the 'broadcast' function in the server module
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.history', new_callable=lambda: History(10))  # Mocking the history in the server module
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_replay_bounded(mock_registry, mock_history, mock_selector, mock_broadcast):
+    """
+    Test case where the history is larger than the low watermark. Only the newest messages
+    that fit should be replayed.
+    """
+    for number in range(5):
+        mock_history.record('lobby', text(f"message {number}"))  # 14 bytes each
+    session = Session(Mock(), protocol.FrameReader(), Outbox())
+    mock_registry.add(session)
+
+    join(session, "TestUser")
+
+    assert list(session.outbox.messages) == [text("message 3"), text("message 4")]
@@ -3,32 +3,36 @@ import socket
 import threading
 import time
 import select
+import protocol  # Framing of the messages
+from server import ChatServer  # The server, run in a thread of the tests
 
 HOST = '127.0.0.1'  # Server host address
-PORT = 55555  # Port for server communication
 
 class ClientThread(threading.Thread):
     """
     Represents a client in the chat system, which runs on a separate thread.
     Each client connects to the server, sends and receives messages.
     """
-    def __init__(self, nickname, event):
+    def __init__(self, nickname, event, port):
         super().__init__()
         self.nickname = nickname  # Client's nickname
+        self.port = port  # Port the server listens on
         self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # Creating the socket for communication
         self.received_messages = []  # List to store messages received by the client
         self.running = True  # Flag to control the client's running state
         self.event = event  # Event used for synchronizing when the client is ready
+        self.reader = protocol.FrameReader()  # Splits the received data into messages
 
     def run(self):
         """Main loop where the client connects to the server and listens for incoming messages."""
         try:
             # Connect to the server
-            self.client.connect((HOST, PORT))
+            self.client.connect((HOST, self.port))
             # Wait for the server to prompt for a nickname
-            self.client.recv(1024)  # Receive the 'NICK' prompt
+            while not self.reader.frames():
+                self.reader.recv(self.client)  # Receive the 'NICK' prompt
             # Send the nickname to the server
-            self.client.send(self.nickname.encode('utf-8'))
+            self.client.send(protocol.encode(protocol.NICK, self.nickname.encode('utf-8')))
             # Signal that the client is ready to receive messages
             self.event.set()
 
@@ -37,11 +41,11 @@ class ClientThread(threading.Thread):
                 # Use select to check for readable messages (non-blocking)
                 readable, writable, exceptional = select.select([self.client], [], [], 1)
                 if readable:
-                    # Receive and decode the message
-                    message = self.client.recv(1024).decode('utf-8')
-                    if message:
-                        # Append the received message to the list
-                        self.received_messages.append(message)
+                    # Receive and decode the messages
+                    if self.reader.recv(self.client):
+                        for kind, frame in self.reader.frames():
+                            # Append the received message to the list
+                            self.received_messages.append(bytes(protocol.payload(frame)).decode('utf-8'))
 
         except OSError:
             # If an error occurs (e.g., the connection is closed), stop the client
@@ -51,7 +55,7 @@ class ClientThread(threading.Thread):
         """Sends a message to the server."""
         try:
             # Send the message to the server
-            self.client.send(message.encode('utf-8'))
+            self.client.send(protocol.encode(protocol.TEXT, message.encode('utf-8')))
         except socket.error:
             # Handle socket errors (e.g., server not reachable)
             pass
@@ -61,19 +65,31 @@ class ClientThread(threading.Thread):
         self.running = False
         self.client.close()
 
+@pytest.fixture(scope='module')
+def chat_server():
+    """
+    Fixture to run the server in a thread of the tests, on any free port.
+    It is stopped once the tests of this file are done.
+    """
+    chat = ChatServer(HOST, 0)
+    chat.run_in_thread()
+    yield chat
+    chat.stop()
+
 @pytest.fixture
-def multiple_clients():
+def multiple_clients(chat_server):
     """
     Fixture to start multiple clients for testing.
     It initializes multiple `ClientThread` instances and synchronizes their start.
     """
-    event = threading.Event()  # Create a threading event for synchronization
-    clients = [ClientThread(f"Client{i}", event) for i in range(3)]  # Create 3 clients with different nicknames
+    # Create 3 clients with different nicknames, each with an event set once it is ready
+    clients = [ClientThread(f"Client{i}", threading.Event(), chat_server.port) for i in range(3)]
     for client in clients:
         client.start()  # Start each client in a separate thread
 
     # Wait until all clients are connected and ready
-    event.wait()  # Ensure all clients are connected to the server
+    for client in clients:
+        client.event.wait()  # Ensure all clients are connected to the server
 
     yield clients  # Provide the clients to the test
     for client in clients:
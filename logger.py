@@ -0,0 +1,142 @@
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+
+# Settings used by setup(), changed from the command line
+LEVEL = 'INFO'
+FORMAT = 'text'  # 'text' or 'json' (one object per line)
+QUEUE_SIZE = 10000  # Records waiting to be written, past it new records are dropped
+BATCH_SIZE = 256  # Records written with a single write()
+
+# How message contents appear in the logs: in full, cut after PAYLOAD_LIMIT
+# bytes, or redacted (only their size is shown)
+PAYLOAD_MODES = ('full', 'truncate', 'redact')
+PAYLOAD_MODE = 'truncate'
+PAYLOAD_LIMIT = 64
+
+# Tells the writer thread to stop
+STOP = None
+
+handler = None
+writer = None
+
+# A message content to log. Only what the payload mode shows is copied, so the
+# record stays valid after the receive buffer is reused
+class Payload:
+    __slots__ = ('data', 'size')
+
+    def __init__(self, data):
+        self.size = len(data)
+        if PAYLOAD_MODE == 'redact':
+            self.data = None
+        elif PAYLOAD_MODE == 'truncate':
+            self.data = bytes(data[:PAYLOAD_LIMIT])
+        else:
+            self.data = bytes(data)
+
+    def __str__(self):
+        if self.data is None:
+            return f"<{self.size} bytes>"
+        if self.size > len(self.data):
+            return f"{self.data!r}... ({self.size} bytes)"
+        return repr(self.data)
+
+# Puts records in a bounded queue instead of writing them. When the queue is
+# full the record is dropped and counted, the server never waits for the log
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, size):
+        super().__init__(queue.Queue(size))
+        self.dropped = 0
+
+    def prepare(self, record):
+        # The writer thread formats the record, the caller only pays for queuing it
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+# One JSON object per record, with the fields given through 'extra'
+class JsonFormatter(logging.Formatter):
+    STANDARD = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+    def format(self, record):
+        fields = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        fields.update((name, str(value)) for name, value in vars(record).items() if name not in self.STANDARD)
+        if record.exc_info:
+            fields['exception'] = self.formatException(record.exc_info)
+        return json.dumps(fields)
+
+# Background thread writing the queued records, as many as are waiting at once
+class LogWriter(threading.Thread):
+    def __init__(self, records, stream, formatter):
+        super().__init__(name='log-writer', daemon=True)
+        self.records = records
+        self.stream = stream
+        self.formatter = formatter
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            batch = [self.records.get()]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines = []
+            for record in batch:
+                if record is STOP:
+                    stopping = True
+                    continue
+                try:
+                    lines.append(self.formatter.format(record) + '\n')
+                except Exception as error:
+                    lines.append(f"Could not format log record {record.msg!r}: {error}\n")
+            if lines:
+                self.stream.write(''.join(lines))
+                self.stream.flush()
+
+    def stop(self):
+        self.records.put(STOP)
+        self.join()
+
+# Send the records of the 'chat' loggers through the queue to a writer thread.
+# Called once per process: threads do not survive fork(), so workers call it again
+def setup(stream=None):
+    global handler, writer
+    chat = logging.getLogger('chat')
+    if handler is not None:
+        chat.removeHandler(handler)
+
+    if FORMAT == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s')
+    handler = DroppingQueueHandler(QUEUE_SIZE)
+    writer = LogWriter(handler.queue, stream or sys.stdout, formatter)
+    writer.start()
+
+    chat.addHandler(handler)
+    chat.setLevel(LEVEL)
+    chat.propagate = False
+
+# Write what is still queued, before the process exits
+def shutdown():
+    if writer is not None and writer.is_alive():
+        writer.stop()
+
+# Records dropped because the queue was full
+def dropped():
+    return handler.dropped if handler is not None else 0
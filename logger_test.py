@@ -0,0 +1,154 @@
+import io
+import json
+import logging
+import pytest
+from unittest.mock import Mock, patch
+import logger  # Importing the logging layer to be tested
+import protocol  # Framing of the messages
+from registry import Registry, Session  # Sessions of the connected clients
+from server import handle, Outbox  # Importing the functions to be tested from the server module
+from conftest import feed  # Helpers shared by the tests
+
+@pytest.fixture
+def output():
+    """
+    Fixture that sends the 'chat' logs to a string for the duration of a test, and puts
+    the logging configuration back afterwards.
+    """
+    stream = io.StringIO()
+    yield stream
+    logger.shutdown()
+    chat = logging.getLogger('chat')
+    chat.removeHandler(logger.handler)
+    chat.setLevel(logging.NOTSET)
+    chat.propagate = True
+    logger.handler = logger.writer = None
+
+# Test 1: Message contents are truncated, redacted or logged in full
+@pytest.mark.parametrize('mode, expected', [
+    ('full', "b'Hello, world!'"),
+    ('truncate', "b'Hello'... (13 bytes)"),
+    ('redact', "<13 bytes>"),
+])
+def test_payload_modes(mode, expected):
+    """
+    Test case where the same message is logged with each payload mode. Only what the mode
+    allows should appear in the log.
+    """
+    with patch('logger.PAYLOAD_MODE', mode), patch('logger.PAYLOAD_LIMIT', 5):
+        assert str(logger.Payload(b'Hello, world!')) == expected
+
+# Test 2: The payload is copied, not referenced
+def test_payload_copied():
+    """
+    Test case where the buffer a message was read from is reused before the record is
+    written. The record should still show the original message.
+    """
+    buffer = bytearray(b'Hello')
+    payload = logger.Payload(memoryview(buffer))
+    buffer[:] = b'XXXXX'
+    assert str(payload) == "b'Hello'"
+
+# Test 3: Records are dropped and counted when the queue is full
+def test_queue_full():
+    """
+    Test case where more records are logged than the queue holds and nothing writes them.
+    The extra records should be dropped without blocking, and counted.
+    """
+    handler = logger.DroppingQueueHandler(2)
+    log = logging.getLogger('chat.test_queue_full')
+    log.addHandler(handler)
+    log.propagate = False
+
+    for number in range(5):
+        log.warning("Record %d", number)
+
+    assert handler.queue.qsize() == 2
+    assert handler.dropped == 3
+
+# Test 4: The writer thread writes the records
+@patch('logger.LEVEL', 'INFO')  # Default level
+def test_writer(output):
+    """
+    Test case where records are logged through the configured logger. They should all be
+    written, in order, once the writer is stopped.
+    """
+    logger.setup(output)
+    log = logging.getLogger('chat.test')
+
+    log.info("Client %s connected", "TestUser")
+    log.warning("Something went wrong")
+    log.debug("Not written at INFO")
+    logger.shutdown()
+
+    lines = output.getvalue().splitlines()
+    assert len(lines) == 2
+    assert lines[0].endswith("INFO chat.test: Client TestUser connected")
+    assert lines[1].endswith("WARNING chat.test: Something went wrong")
+    assert logger.dropped() == 0
+
+# Test 5: Records can be written as JSON
+@patch('logger.FORMAT', 'json')  # One JSON object per line
+def test_json_format(output):
+    """
+    Test case where the JSON format is used. Each record should be a JSON object with the
+    level, logger, message and the extra fields.
+    """
+    logger.setup(output)
+
+    logging.getLogger('chat.test').warning("Client %s is slow", "TestUser", extra={'buffered': 1024})
+    logger.shutdown()
+
+    record = json.loads(output.getvalue())
+    assert record['level'] == 'WARNING'
+    assert record['logger'] == 'chat.test'
+    assert record['message'] == "Client TestUser is slow"
+    assert record['buffered'] == '1024'
+
+# Test 6: Chat messages are not logged by default
+@patch('logger.LEVEL', 'INFO')  # Default level
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_hot_path_quiet(mock_registry, mock_selector, output):
+    """
+    Test case where a client sends a message to another one at the default level. Nothing
+    should be logged for it.
+    """
+    logger.setup(output)
+    sender, receiver = Mock(), Mock()
+    for client, nickname in ((sender, "Sender"), (receiver, "Receiver")):
+        session = Session(client, protocol.FrameReader(), Outbox())
+        mock_registry.add(session)
+        mock_registry.join(session, nickname)
+    message = protocol.encode(protocol.TEXT, b'Sender: hello')
+    feed(sender, message)
+
+    assert handle(sender) is True
+    logger.shutdown()
+
+    assert output.getvalue() == ""
+
+# Test 7: Chat messages are logged at DEBUG, cut to the payload limit
+@patch('logger.LEVEL', 'DEBUG')  # Everything is logged
+@patch('logger.PAYLOAD_LIMIT', 6)  # Only the start of the messages
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_hot_path_debug(mock_registry, mock_selector, output):
+    """
+    Test case where a client sends a message at DEBUG level. The message should be logged
+    once when received and once when broadcast, truncated.
+    """
+    logger.setup(output)
+    sender = Mock()
+    session = Session(sender, protocol.FrameReader(), Outbox())
+    mock_registry.add(session)
+    mock_registry.join(session, "Sender")
+    message = protocol.encode(protocol.TEXT, b'hello, world')
+    feed(sender, message)
+
+    assert handle(sender) is True
+    logger.shutdown()
+
+    lines = output.getvalue().splitlines()
+    assert lines[0].endswith("Received b'hello,'... (12 bytes) from Sender")
+    assert lines[1].endswith("Sending b'\\x06Sende'... (20 bytes) to 1 clients in lobby")  # With its sender
@@ -0,0 +1,98 @@
+import json
+import socket
+import sys
+
+# Histogram of durations in nanoseconds. Bucket i counts the values that need
+# i bits, so recording is a few integer operations and the memory is fixed
+class Histogram:
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.buckets = [0] * 65
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        self.buckets[value.bit_length()] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    # Upper bound of the bucket holding the given fraction of the values
+    def percentile(self, fraction):
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bits, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(1 << bits, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean_ns': self.total // self.count if self.count else None,
+            'p50_ns': self.percentile(0.50),
+            'p99_ns': self.percentile(0.99),
+            'p999_ns': self.percentile(0.999),
+            'max_ns': self.max,
+            # Bucket i: values below 2**i nanoseconds (and at least 2**(i-1))
+            'buckets': {bits: count for bits, count in enumerate(self.buckets) if count},
+        }
+
+# Counters and stage timings of the server. The counters are plain attributes
+# bumped in place, nothing is computed until a snapshot is asked for
+class Metrics:
+    COUNTERS = ('accepted', 'handshakes', 'handshake_timeouts', 'messages_in', 'messages_out',
+                'bytes_in', 'bytes_out', 'send_retries', 'forced_removals',
+                # Pings sent to quiet clients, clients dropped for staying quiet
+                'pings', 'idle_timeouts',
+                # Clients paused and messages dropped by the rate limits, clients
+                # disconnected for going over them too often
+                'throttles', 'messages_dropped', 'flood_removals',
+                # Messages compressed (each once, however many clients get it), and
+                # bytes clients were sent less thanks to it
+                'compressed', 'compression_saved',
+                # Direct messages sent, and those kept for a nickname that was not
+                # connected then delivered when it joined
+                'direct_messages', 'offline_queued', 'offline_delivered',
+                # System calls of the event loop: select wakeups, recv/sendmsg calls,
+                # and changes of the events a socket is watched for
+                'wakeups', 'recv_calls', 'send_calls', 'poll_changes')
+    HISTOGRAMS = ('wakeup_to_handle', 'handle', 'handle_to_send')
+
+    __slots__ = COUNTERS + HISTOGRAMS + ('handle_started',)
+
+    def __init__(self):
+        self.handle_started = None  # When the handle() running now started (ns), None between them
+        for name in self.COUNTERS:
+            setattr(self, name, 0)
+        for name in self.HISTOGRAMS:
+            setattr(self, name, Histogram())
+
+    # Everything measured so far, plus the gauges given by the caller
+    def snapshot(self, **gauges):
+        return {
+            'counters': {name: getattr(self, name) for name in self.COUNTERS},
+            'gauges': gauges,
+            'histograms': {name: getattr(self, name).snapshot() for name in self.HISTOGRAMS},
+        }
+
+# Read a snapshot from the stats socket of a running server
+def read_stats(path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stats:
+        stats.connect(path)
+        data = b''
+        while chunk := stats.recv(65536):
+            data += chunk
+    return json.loads(data)
+
+if __name__ == "__main__":
+    # python metrics.py <stats socket>
+    if len(sys.argv) != 2:
+        sys.exit(f"usage: {sys.argv[0]} STATS_SOCKET")
+    print(json.dumps(read_stats(sys.argv[1]), indent=2))
@@ -0,0 +1,196 @@
+import json
+import socket
+from unittest.mock import Mock, patch
+import protocol  # Framing of the messages
+from metrics import Histogram, Metrics  # Importing the metrics to be tested
+from history import History  # Recent messages of the rooms
+from registry import Registry, Session  # Sessions of the connected clients
+from timerwheel import TimerWheel  # Deadlines of the clients
+from server import accept, handle, flush, broadcast, expire_timers, Outbox  # Importing the functions to be tested from the server module
+import server
+from conftest import add_client, feed  # Helpers shared by the tests
+
+# Test 1: Histogram buckets and percentiles
+def test_histogram():
+    """
+    Test case where durations of different magnitudes are recorded. Each one should land in
+    the bucket of its bit length, and the percentiles be the bounds of those buckets.
+    """
+    histogram = Histogram()
+    for value in [100] * 98 + [5000, 70000]:
+        histogram.record(value)
+
+    snapshot = histogram.snapshot()
+    assert snapshot['buckets'] == {7: 98, 13: 1, 17: 1}  # 100 < 2**7, 5000 < 2**13, 70000 < 2**17
+    assert snapshot['count'] == 100
+    assert snapshot['p50_ns'] == 128
+    assert snapshot['p99_ns'] == 8192
+    assert snapshot['p999_ns'] == 70000  # Never above the largest value
+    assert snapshot['max_ns'] == 70000
+
+# Test 2: An empty histogram has no percentiles
+def test_histogram_empty():
+    """
+    Test case where nothing was recorded. The snapshot should say so instead of failing.
+    """
+    snapshot = Histogram().snapshot()
+    assert snapshot['count'] == 0
+    assert snapshot['p99_ns'] is None
+    assert snapshot['mean_ns'] is None
+
+# Test 3: Accepting, joining and chatting are counted
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.timers', new_callable=lambda: TimerWheel(0))  # Mocking the deadlines of the clients
+@patch('server.history', new=History(0))  # No messages to replay
+@patch('server.metrics', new_callable=Metrics)  # Mocking the metrics in the server module
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_counters(mock_registry, mock_metrics, mock_timers, mock_selector):
+    """
+    Test case where a client connects, sends its nickname and a message to another client.
+    Every step should show in the counters.
+    """
+    add_client(mock_registry, Mock(), "Other")
+    client = Mock()
+    listener = Mock()
+    listener.accept.side_effect = [(client, ('127.0.0.1', 40000)), BlockingIOError()]
+    accept(listener)
+    nick = protocol.encode(protocol.NICK, b'TestUser')
+    message = protocol.encode(protocol.TEXT, b'TestUser: hello')
+    feed(client, nick + message)
+
+    assert handle(client) is True
+
+    assert mock_metrics.accepted == 1
+    assert mock_metrics.handshakes == 1
+    assert mock_metrics.messages_in == 2  # The nickname and the message
+    assert mock_metrics.bytes_in == len(nick) + len(message)
+    assert mock_metrics.messages_out == 2  # The join announcement and the message, for the other client
+
+# Test 4: Sends that have to wait for the socket are counted as retries
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.metrics', new_callable=Metrics)  # Mocking the metrics in the server module
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_send_retries(mock_registry, mock_metrics, mock_selector):
+    """
+    Test case where the socket takes only part of a message, then the rest. The first flush
+    should count as a retry, and the time until everything was sent be recorded once.
+    """
+    client = Mock()
+    session = add_client(mock_registry, client, "TestUser")
+    mock_metrics.handle_started = 0
+    broadcast(b'Hello, world!')
+    client.sendmsg.side_effect = [5]
+
+    assert flush(client) is True
+    assert mock_metrics.send_retries == 1
+    assert mock_metrics.handle_to_send.count == 0  # Not sent yet
+
+    client.sendmsg.side_effect = [8]
+    assert flush(client) is True
+    assert mock_metrics.bytes_out == 13
+    assert mock_metrics.send_retries == 1
+    assert mock_metrics.handle_to_send.count == 1  # Sent to the end
+
+# Test 5: Clients dropped by the server are counted
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.timers', new_callable=lambda: TimerWheel(80))  # Mocking the deadlines of the clients
+@patch('server.metrics', new_callable=Metrics)  # Mocking the metrics in the server module
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+@patch('server.time.monotonic', return_value=100)  # The current time
+def test_forced_removals(mock_monotonic, mock_registry, mock_metrics, mock_timers, mock_selector):
+    """
+    Test case where a client sends an invalid message and another never sends its nickname.
+    Both removals should be counted, the second also as a handshake timeout.
+    """
+    invalid = add_client(mock_registry, Mock(), "Invalid")
+    feed(invalid.sock, protocol.HEADER.pack(protocol.MAX_MESSAGE_SIZE + 1, protocol.TEXT))
+    late = Session(Mock(), protocol.FrameReader(), Outbox())
+    mock_registry.add(late)
+    mock_timers.schedule(late, 90)
+
+    assert handle(invalid.sock) is False
+    expire_timers()
+
+    assert mock_metrics.forced_removals == 2
+    assert mock_metrics.handshake_timeouts == 1
+
+# Test 6: The stats socket answers with a snapshot
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.metrics', new_callable=Metrics)  # Mocking the metrics in the server module
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_stats_socket(mock_registry, mock_metrics, mock_selector, tmp_path):
+    """
+    Test case where a reader connects to the stats socket. It should receive the counters,
+    histograms and the size of the registry as JSON.
+    """
+    add_client(mock_registry, Mock(), "TestUser")
+    mock_metrics.accepted = 3
+    path = str(tmp_path / 'stats.sock')
+    listener = server.create_unix_listener(path)
+    reader = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    reader.connect(path)
+
+    server.serve_stats(listener)
+
+    data = b''
+    while chunk := reader.recv(65536):
+        data += chunk
+    stats = json.loads(data)
+    assert stats['counters']['accepted'] == 3
+    assert stats['gauges']['connections'] == 1
+    assert stats['gauges']['joined'] == 1
+    assert 'wakeup_to_handle' in stats['histograms']
+    reader.close()
+    listener.close()
+
+# Test 7: The stats file is only rewritten when it is due
+@patch('server.STATS_INTERVAL', 10)  # Seconds between two writes
+@patch('server.stats_due', None)  # Never written yet
+@patch('server.metrics', new_callable=Metrics)  # Mocking the metrics in the server module
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+@patch('server.time.monotonic')  # The current time
+def test_stats_file(mock_monotonic, mock_registry, mock_metrics, tmp_path):
+    """
+    Test case where the event loop asks for the stats file several times. It should be
+    written at once, then again only after the interval.
+    """
+    path = tmp_path / 'stats.json'
+    with patch('server.STATS_FILE', str(path)):
+        mock_monotonic.return_value = 100
+        assert server.write_stats_when_due() == 10
+        assert json.loads(path.read_text())['counters']['accepted'] == 0
+
+        mock_metrics.accepted = 1
+        mock_monotonic.return_value = 105
+        assert server.write_stats_when_due() == 5  # Not due yet
+        assert json.loads(path.read_text())['counters']['accepted'] == 0
+
+        mock_monotonic.return_value = 110
+        server.write_stats_when_due()
+        assert json.loads(path.read_text())['counters']['accepted'] == 1
+    assert not (tmp_path / 'stats.json.tmp').exists()  # Replaced in one step
+
+# Test 8: Only messages queued by a handle() count towards the time until they are sent
+@patch('server.pending', new_callable=list)  # Mocking the sessions to flush at the end of the loop pass
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.history', new=History(0))  # No messages to replay
+@patch('server.metrics', new_callable=Metrics)  # Mocking the metrics in the server module
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_handle_to_send_outside_handle(mock_registry, mock_metrics, mock_selector, mock_pending):
+    """
+    Test case where a client's message is handled and sent, then another message is queued
+    outside of any handle(), like a ping from a timer. Only the first should be recorded.
+    """
+    sender = add_client(mock_registry, Mock(), "Sender")
+    other = add_client(mock_registry, Mock(), "Other")
+    feed(sender.sock, protocol.encode(protocol.TEXT, b'hello'))
+    other.sock.sendmsg.side_effect = lambda buffers: sum(len(buffer) for buffer in buffers)
+
+    server.serve([sender], 0)
+    assert flush(other.sock) is True
+    assert mock_metrics.handle_to_send.count == 1
+
+    assert mock_metrics.handle_started is None  # No handle() is running
+    server.queue(other, protocol.encode(protocol.PING))
+    assert flush(other.sock) is True
+    assert mock_metrics.handle_to_send.count == 1  # Not measured from the last handle()
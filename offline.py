@@ -0,0 +1,70 @@
+from collections import OrderedDict, deque
+
+# Messages kept for a nickname that is not connected, the oldest are dropped first
+QUEUE_SIZE = 20
+
+# Seconds a message waits for its recipient before it is dropped
+TTL = 24 * 3600
+
+# Bytes kept for all the nicknames together. Past it, the queues written to
+# least recently are dropped whole, so nicknames nobody uses can't fill the memory
+MAX_BYTES = 4 * 1024 * 1024
+
+# Direct messages for nicknames that are not connected, delivered when they
+# join. Expired messages are only dropped when their queue is used, the byte
+# limit keeps the rest bounded meanwhile
+class OfflineQueues:
+    def __init__(self, size=QUEUE_SIZE, ttl=TTL, max_bytes=MAX_BYTES):
+        self.size = size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.queues = OrderedDict()  # Nickname -> deque of (expiry, message), least recently written first
+        self.bytes = 0  # Size of all the messages kept
+        self.count = 0  # Number of messages kept
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, nickname):
+        return nickname in self.queues
+
+    # Keep a message for a nickname, returns False if it can't be kept at all
+    def put(self, nickname, message, now):
+        if not self.size or len(message) > self.max_bytes:
+            return False
+        queue = self.queues.get(nickname)
+        if queue is None:
+            queue = self.queues[nickname] = deque()
+        else:
+            self.queues.move_to_end(nickname)
+            self._expire(queue, now)
+        if len(queue) >= self.size:
+            self._drop(queue.popleft()[1])
+
+        queue.append((now + self.ttl, message))
+        self.bytes += len(message)
+        self.count += 1
+        while self.bytes > self.max_bytes:
+            oldest, dropped = self.queues.popitem(last=False)
+            for expiry, message in dropped:
+                self._drop(message)
+        return True
+
+    # Remove and return the messages kept for a nickname that have not expired, oldest first
+    def take(self, nickname, now):
+        queue = self.queues.pop(nickname, None)
+        if queue is None:
+            return []
+        self._expire(queue, now)
+        for expiry, message in queue:
+            self._drop(message)
+        return [message for expiry, message in queue]
+
+    # Drop the expired messages at the front of a queue
+    def _expire(self, queue, now):
+        while queue and queue[0][0] <= now:
+            self._drop(queue.popleft()[1])
+
+    def _drop(self, message):
+        self.bytes -= len(message)
+        self.count -= 1
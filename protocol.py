@@ -0,0 +1,270 @@
+import struct
+import zlib
+
+# Every frame starts with the length of its payload and the type of message
+HEADER = struct.Struct('!IB')  # 4 bytes length, 1 byte type
+
+# Types of message
+NICK = 1  # Server asks for the nickname, client answers with it and its color
+TEXT = 2  # Client sends a chat message (just the text), server sends a notice
+ROOM_JOIN = 3  # Client moves to the room named in the payload
+ROOM_LEAVE = 4  # Client goes back to the default room
+ROOM_LIST = 5  # Client asks for the list of rooms
+ROUTED = 6  # Between server workers: a frame for the clients of one room
+PING = 7  # Asks the other side to show it is alive
+PONG = 8  # Answer to a ping
+CHAT = 9  # Server sends a chat message: its sender, then the text
+JOIN = 10  # Server tells somebody joined: the sender, then the room (empty for the chat)
+LEAVE = 11  # Server tells somebody left: the sender, why, then the room (empty for the chat)
+ERROR = 12  # Server tells a client what it asked for was refused
+COMPRESSED = 13  # One or more whole frames, compressed with deflate
+MSG = 14  # Client sends a direct message: the recipient's nickname, a NUL byte, then the text
+DIRECT = 15  # Server delivers a direct message: its sender, then the text
+
+# Colors a client may choose for its nickname, sent as their index. The clients
+# paint the nicknames themselves, no escape codes go over the network
+COLORS = ('black', 'red', 'green', 'yellow', 'blue', 'magenta', 'cyan', 'white')
+DEFAULT_COLOR = COLORS.index('white')
+
+# Longest nickname accepted (bytes), it goes with every message of its owner
+MAX_NICKNAME = 32
+
+# Why somebody left, in LEAVE messages
+LEFT = 0  # Left the chat or the room
+FLOODED = 1  # Disconnected by the server for flooding
+
+# Largest payload accepted in a single frame (bytes)
+MAX_MESSAGE_SIZE = 64 * 1024
+
+# Features a side supports, as bits of a byte sent with the nickname request and
+# its answer. Peers that send no byte support none of them
+COMPRESSION = 1  # Understands COMPRESSED frames
+
+# Frames smaller than this (bytes) are sent as they are, deflate saves little on
+# them and costs as much as the rest of their handling
+COMPRESS_THRESHOLD = 512
+COMPRESS_LEVEL = 6
+
+# Largest content of a COMPRESSED frame once decompressed (bytes), so a small
+# frame can't make its receiver allocate without bound
+MAX_DECOMPRESSED_SIZE = 1024 * 1024
+
+# Size the receive buffers start with, they only grow for larger frames
+INITIAL_BUFFER_SIZE = 4096
+
+# Raised when a peer sends something that is not a valid frame
+class FrameError(Exception):
+    pass
+
+# Build a frame ready to be sent
+def encode(kind, payload=b''):
+    return HEADER.pack(len(payload), kind) + payload
+
+# Incrementally parse the frames received on a socket.
+# The data is received into a reusable buffer, and frames are returned as
+# views over it, which are only valid until the next call to recv().
+class FrameReader:
+    def __init__(self, max_size=None):
+        self.max_size = MAX_MESSAGE_SIZE if max_size is None else max_size
+        self.buffer = bytearray(INITIAL_BUFFER_SIZE)
+        self.start = 0  # First byte not parsed yet
+        self.end = 0  # End of the received data
+        self.needed = HEADER.size  # Bytes needed to complete the next frame
+
+    # Receive whatever is available, returns the number of bytes received (0 on EOF)
+    def recv(self, sock):
+        self._make_room(self.needed)
+        with memoryview(self.buffer) as view:
+            received = sock.recv_into(view[self.end:])
+        self.end += received
+        return received
+
+    # Return every complete frame in the buffer as (type, frame) pairs
+    def frames(self):
+        frames = []
+        view = memoryview(self.buffer)
+        self.needed = HEADER.size
+        while self.end - self.start >= HEADER.size:
+            length, kind = HEADER.unpack_from(self.buffer, self.start)
+            if length > self.max_size:
+                raise FrameError(f"Frame of {length} bytes is over the limit of {self.max_size}")
+
+            frame_end = self.start + HEADER.size + length
+            if frame_end > self.end:
+                # Wait for the rest of the frame, the next recv() makes room for it
+                self.needed = HEADER.size + length
+                break
+
+            frames.append((kind, view[self.start:frame_end]))
+            self.start = frame_end
+        return frames
+
+    # Give back the last `size` bytes of the frames returned by frames(), which
+    # returns them again on its next call. Only valid before the next recv()
+    def unread(self, size):
+        self.start -= size
+
+    # The data received and not returned by frames() yet, whole frames or part of one
+    def unparsed(self):
+        return bytes(self.buffer[self.start:self.end])
+
+    # Add data received by another reader, such as the unparsed() data of a
+    # connection handed over by another process
+    def load(self, data):
+        self._make_room(self.end - self.start + len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    # Make sure `size` bytes fit after the unparsed data
+    def _make_room(self, size):
+        pending = self.end - self.start
+        if pending == 0:
+            self.start = self.end = 0
+            if len(self.buffer) > INITIAL_BUFFER_SIZE and size <= INITIAL_BUFFER_SIZE:
+                # Give back the memory used by a large frame
+                self.buffer = bytearray(INITIAL_BUFFER_SIZE)
+
+        if len(self.buffer) - self.start >= max(size, pending + 1):
+            return
+
+        if len(self.buffer) >= size and pending < len(self.buffer):
+            # Move the unparsed data to the front of the buffer
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+        else:
+            buffer = bytearray(max(size, 2 * len(self.buffer)))
+            buffer[:pending] = self.buffer[self.start:self.end]
+            self.buffer = buffer
+        self.start, self.end = 0, pending
+
+# Build the frame of a text message. Build it once and pass the same frame to
+# every recipient, it is never copied per recipient
+def encode_text(text):
+    return encode(TEXT, text.encode('utf-8'))
+
+# Return the payload of a frame returned by FrameReader.frames()
+def payload(frame):
+    return frame[HEADER.size:]
+
+# Wrap a frame meant for one room (b'' for everyone) to pass it to another worker
+def encode_routed(room, frame):
+    return encode(ROUTED, bytes([len(room)]) + room + frame)
+
+# Split the payload of a ROUTED frame into its room and the frame it carries
+def decode_routed(payload):
+    length = payload[0]
+    return bytes(payload[1:1 + length]), payload[1 + length:]
+
+# Build the nickname request, with the features the server supports
+def encode_prompt(features=0):
+    return encode(NICK, bytes([features]) if features else b'')
+
+# Features in the payload of a nickname request (0 from servers that send none)
+def decode_prompt(payload):
+    return payload[0] if payload else 0
+
+# Build the answer to the nickname request: the nickname, the color it is shown
+# in and the features the client supports. A nickname never holds a NUL byte,
+# which separates them
+def encode_nick(nickname, color=DEFAULT_COLOR, features=0):
+    return encode(NICK, nickname.encode('utf-8') + b'\0' + bytes([color, features]))
+
+# Split the payload of a NICK answer into (nickname, color). A plain nickname, or
+# an unknown color, gets the default color
+def decode_nick(payload):
+    nickname, separator, color = bytes(payload).partition(b'\0')
+    color = color[0] if color and color[0] < len(COLORS) else DEFAULT_COLOR
+    return nickname.decode('utf-8'), color
+
+# Features in the payload of a NICK answer (0 from clients that send none)
+def decode_features(payload):
+    nickname, separator, rest = bytes(payload).partition(b'\0')
+    return rest[1] if len(rest) > 1 else 0
+
+# Whether a nickname sent by a client may be used
+def valid_nickname(nickname):
+    return bool(nickname) and len(nickname.encode('utf-8')) <= MAX_NICKNAME
+
+# Build the sender part of CHAT, JOIN and LEAVE messages: the length of the
+# nickname, the nickname and the color. The server builds it once per client
+def encode_sender(nickname, color=DEFAULT_COLOR):
+    name = nickname.encode('utf-8')
+    return bytes([len(name)]) + name + bytes([color])
+
+# Split the payload of a CHAT, JOIN or LEAVE message into (nickname, color, rest)
+def decode_sender(payload):
+    length = payload[0]
+    nickname = bytes(payload[1:1 + length]).decode('utf-8')
+    return nickname, payload[1 + length], payload[2 + length:]
+
+# Build the frame of a chat message from its sender and text (any bytes-like
+# object, such as the payload of the frame the client sent)
+def encode_chat(sender, text):
+    return HEADER.pack(len(sender) + len(text), CHAT) + sender + text
+
+# Build the frame of a direct message sent by a client to the nickname given
+def encode_msg(nickname, text):
+    return encode(MSG, nickname.encode('utf-8') + b'\0' + text.encode('utf-8'))
+
+# Split the payload of a MSG frame into (nickname, text). The text is left as bytes
+def decode_msg(payload):
+    nickname, separator, text = bytes(payload).partition(b'\0')
+    return nickname.decode('utf-8'), text
+
+# Build the frame delivering a direct message to its recipient, from its sender and text
+def encode_direct(sender, text):
+    return HEADER.pack(len(sender) + len(text), DIRECT) + sender + text
+
+# Build the frame telling a room (or everybody, without a room) that somebody joined
+def encode_join(sender, room=''):
+    return encode(JOIN, sender + room.encode('utf-8'))
+
+# Build the frame telling a room (or everybody, without a room) that somebody left
+def encode_leave(sender, room='', reason=LEFT):
+    return encode(LEAVE, sender + bytes([reason]) + room.encode('utf-8'))
+
+# Build the frame refusing what a client asked for
+def encode_error(text):
+    return encode(ERROR, text.encode('utf-8'))
+
+# Build a COMPRESSED frame holding the given frames (one, or several joined
+# together). Frames that would not get smaller are returned as they are.
+# Compressing a frame doesn't depend on who receives it, so a broadcast is
+# compressed once and the result queued for every recipient that supports it
+def compress(frames):
+    data = zlib.compress(frames, COMPRESS_LEVEL, wbits=-15)
+    if HEADER.size + len(data) >= len(frames):
+        return frames
+    return encode(COMPRESSED, data)
+
+# Return the frames held by the payload of a COMPRESSED frame as (type, frame) pairs
+def decompress(payload):
+    decompressor = zlib.decompressobj(wbits=-15)
+    try:
+        data = decompressor.decompress(payload, MAX_DECOMPRESSED_SIZE)
+    except zlib.error as error:
+        raise FrameError(f"Invalid compressed frame: {error}")
+    if decompressor.unconsumed_tail or not decompressor.eof:
+        raise FrameError(f"Compressed frame over the limit of {MAX_DECOMPRESSED_SIZE} bytes or cut")
+
+    frames = []
+    view = memoryview(data)
+    start = 0
+    while start < len(data):
+        if len(data) - start < HEADER.size:
+            raise FrameError("Compressed frame ends in the middle of a frame")
+        length, kind = HEADER.unpack_from(data, start)
+        end = start + HEADER.size + length
+        if length > MAX_MESSAGE_SIZE or end > len(data) or kind == COMPRESSED:
+            raise FrameError("Compressed frame holds an invalid frame")
+        frames.append((kind, view[start:end]))
+        start = end
+    return frames
+
+# Return the (type, frame) pairs of FrameReader.frames() with the frames of the
+# COMPRESSED ones in their place
+def expand(frames):
+    for kind, frame in frames:
+        if kind == COMPRESSED:
+            yield from decompress(payload(frame))
+        else:
+            yield kind, frame
@@ -0,0 +1,64 @@
+# Tokens missing by less than this are rounding errors of the refills, waiting for
+# them would only take a pass of the event loop that moves time by nothing
+ROUNDING = 1e-9
+
+# Token bucket: earns `rate` tokens per second, up to `burst`. The tokens are
+# only added up when the bucket is used, so nothing runs between two messages
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst  # Starts full
+        self.updated = now
+
+    # Add the tokens earned since the last call, returns how many there are
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    # Tokens needed before `amount` is allowed. More than the burst can never be
+    # saved up, so a full bucket allows anything and goes into debt
+    def needed(self, amount):
+        return min(amount, self.burst)
+
+    # Seconds until `amount` is allowed, counted from the last refill
+    def delay(self, amount):
+        return max(0.0, (self.needed(amount) - self.tokens) / self.rate)
+
+# Limits of what one client sends: messages and bytes per second (a rate of 0
+# is no limit), and how many times it may go over them before it is disconnected
+class RateLimiter:
+    __slots__ = ('buckets', 'strikes')
+
+    def __init__(self, message_rate, message_burst, byte_rate, byte_burst, strikes, window, now):
+        # (bucket, whether it counts bytes) for every limit that is on
+        self.buckets = []
+        if message_rate:
+            self.buckets.append((TokenBucket(message_rate, message_burst, now), False))
+        if byte_rate:
+            self.buckets.append((TokenBucket(byte_rate, byte_burst, now), True))
+        # A strike is taken every time the client goes over the limits, and they
+        # come back over the window
+        self.strikes = TokenBucket(strikes / window, strikes, now)
+
+    # Take a message of `size` bytes if the client has the tokens for it
+    def allow(self, size, now):
+        for bucket, counts_bytes in self.buckets:
+            if bucket.refill(now) + ROUNDING < bucket.needed(size if counts_bytes else 1):
+                return False
+        for bucket, counts_bytes in self.buckets:
+            bucket.tokens -= size if counts_bytes else 1
+        return True
+
+    # Seconds until a message of `size` bytes is allowed, after allow() refused it
+    def delay(self, size):
+        return max(bucket.delay(size if counts_bytes else 1) for bucket, counts_bytes in self.buckets)
+
+    # Count one more time over the limits, returns True once the client has none left
+    def strike(self, now):
+        self.strikes.refill(now)
+        self.strikes.tokens -= 1
+        return self.strikes.tokens < 0
@@ -0,0 +1,190 @@
+import selectors
+import pytest
+from unittest.mock import Mock, patch
+import protocol  # Framing of the messages
+from history import History  # Recent messages of the rooms
+from metrics import Metrics  # Counters of the server
+from ratelimit import TokenBucket, RateLimiter  # Importing the rate limits to be tested
+from registry import Registry  # Sessions of the connected clients
+from server import handle, flush, remove, resume_throttled, serve  # Importing the functions to be tested from the server module
+import server
+from simulation import Simulation  # Clients and time without a network
+from conftest import add_client, feed, texts  # Helpers shared by the tests
+
+def lines(*texts):
+    """
+    Returns the frames of several chat messages, glued together as one read.
+    """
+    return b''.join(protocol.encode(protocol.TEXT, text) for text in texts)
+
+# Test 1: A token bucket refills with time, up to its burst
+def test_token_bucket():
+    """
+    Test case where tokens are taken from a bucket and time passes. It should never hold
+    more than its burst, and tell how long until enough tokens are back.
+    """
+    bucket = TokenBucket(rate=10, burst=5, now=0)
+    assert bucket.refill(100) == 5  # Never more than the burst
+
+    bucket.tokens -= 5
+    assert bucket.refill(100.2) == pytest.approx(2)  # 10 per second
+    assert bucket.delay(4) == pytest.approx(0.2)  # 2 more tokens needed
+    assert bucket.delay(1) == 0
+    assert bucket.needed(50) == 5  # More than the burst only needs a full bucket
+
+# Test 2: Messages are limited by count and by size
+def test_limiter():
+    """
+    Test case where a client sends small messages, then a large one. The small ones should
+    stop at the message burst, the large one at the byte burst.
+    """
+    limiter = RateLimiter(message_rate=1, message_burst=2, byte_rate=10, byte_burst=100,
+                          strikes=2, window=10, now=0)
+
+    assert limiter.allow(10, 0) is True
+    assert limiter.allow(10, 0) is True
+    assert limiter.allow(10, 0) is False  # No message tokens left
+    assert limiter.delay(10) == pytest.approx(1)  # One message per second
+
+    assert limiter.allow(95, 1) is False  # 80 bytes left, plus 10 earned in a second
+    assert limiter.delay(95) == pytest.approx(0.5)
+    assert limiter.allow(1000, 20) is True  # Larger than the burst, allowed with a full bucket
+
+    assert limiter.strike(20) is False
+    assert limiter.strike(20) is False
+    assert limiter.strike(20) is True  # Out of strikes
+    assert limiter.strike(40) is False  # They come back over the window
+
+# Test 3: A client over its limits is paused, then resumes where it stopped
+@patch('server.FLOOD_POLICY', 'throttle')  # Stop reading from clients over their limits
+@patch('server.throttled', new_callable=list)  # Mocking the paused clients
+@patch('server.backlog', new_callable=list)  # Mocking the clients with messages waiting
+@patch('server.history', new=History(0))  # No messages to replay
+@patch('server.metrics', new_callable=Metrics)  # Mocking the metrics in the server module
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+@patch('server.time.monotonic', return_value=100)  # The current time
+def test_throttle(mock_monotonic, mock_registry, mock_selector, mock_metrics, mock_backlog, mock_throttled):
+    """
+    Test case where a client sends 3 messages at once and may only send 2. The third should
+    wait, without reading from the socket, until the client may send again.
+    """
+    sender = add_client(mock_registry, Mock(), "Sender",
+                        limiter=RateLimiter(1, 2, 0, 0, strikes=5, window=10, now=100))
+    receiver = add_client(mock_registry, Mock(), "Receiver")
+    feed(sender.sock, lines(b'one', b'two', b'three'))
+
+    assert handle(sender.sock) is True
+    assert texts(receiver) == [b'one', b'two']
+    assert sender.paused is True
+    mock_selector.unregister.assert_called_once_with(sender.sock)  # Not read from meanwhile
+    assert resume_throttled() == pytest.approx(1)  # The next message is allowed in a second
+
+    mock_monotonic.return_value = 101
+    assert resume_throttled() is None
+    assert sender.paused is False
+    mock_selector.register.assert_called_once_with(sender.sock, selectors.EVENT_READ, sender)
+    assert mock_backlog == [sender]  # Handled with the next pass of the event loop
+
+    serve([], 0)
+    assert texts(receiver) == [b'one', b'two', b'three']  # The message read before the pause
+    sender.sock.recv_into.assert_called_once()  # Nothing more was read
+
+# Test 4: With the drop policy the extra messages are dropped with a notice
+@patch('server.FLOOD_POLICY', 'drop')  # Drop the messages of clients over their limits
+@patch('server.history', new=History(0))  # No messages to replay
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+@patch('server.time.monotonic', return_value=100)  # The current time
+def test_drop(mock_monotonic, mock_registry, mock_selector):
+    """
+    Test case where a client sends 4 messages at once and may only send 2. The others should
+    be dropped, and the client told once.
+    """
+    sender = add_client(mock_registry, Mock(), "Sender",
+                        limiter=RateLimiter(1, 2, 0, 0, strikes=5, window=10, now=100))
+    receiver = add_client(mock_registry, Mock(), "Receiver")
+    feed(sender.sock, lines(b'one', b'two', b'three', b'four'))
+
+    assert handle(sender.sock) is True
+    assert texts(receiver) == [b'one', b'two']
+    assert texts(sender) == [b'You are sending too fast, 2 messages dropped']
+    assert sender.paused is False
+    mock_selector.unregister.assert_not_called()
+
+# Test 5: Repeat offenders are disconnected
+@patch('server.FLOOD_POLICY', 'drop')  # Drop the messages of clients over their limits
+@patch('server.history', new=History(0))  # No messages to replay
+@patch('server.metrics', new_callable=Metrics)  # Mocking the metrics in the server module
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+@patch('server.time.monotonic', return_value=100)  # The current time
+def test_flood_disconnect(mock_monotonic, mock_registry, mock_selector, mock_metrics):
+    """
+    Test case where a client goes over its limits twice with a single strike. The second
+    time it should be disconnected, and its room told why.
+    """
+    sender = add_client(mock_registry, Mock(), "Sender",
+                        limiter=RateLimiter(1, 1, 0, 0, strikes=1, window=10, now=100))
+    receiver = add_client(mock_registry, Mock(), "Receiver")
+
+    feed(sender.sock, lines(b'one', b'two'))
+    assert handle(sender.sock) is True  # First strike
+
+    feed(sender.sock, lines(b'three'))
+    assert handle(sender.sock) is False  # Removed by the event loop
+    assert texts(receiver)[0] == b'one'
+    assert receiver.outbox.messages[-1] == protocol.encode_leave(sender.sender, reason=protocol.FLOODED)  # Told why it left
+    assert mock_metrics.messages_dropped == 2
+    assert mock_metrics.flood_removals == 1
+
+# Test 6: A paused client that leaves or fills its socket buffer is watched correctly
+@patch('server.throttled', new_callable=list)  # Mocking the paused clients
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_paused_watch(mock_registry, mock_selector, mock_throttled):
+    """
+    Test case where a paused client gets messages its socket cannot take at once, then
+    disconnects. It should only be watched for writing, then no longer at all.
+    """
+    client = Mock()
+    session = add_client(mock_registry, client, "Paused")
+    server.pause(session, 1)
+    mock_selector.unregister.assert_called_once_with(client)
+    mock_selector.reset_mock()
+
+    session.outbox.put(b'Hello, world!')
+    client.sendmsg.side_effect = [5]
+    assert flush(client) is True
+    mock_selector.register.assert_called_once_with(client, selectors.EVENT_WRITE, session)  # Writing only
+
+    client.sendmsg.side_effect = [8]
+    assert flush(client) is True
+    mock_selector.unregister.assert_called_once_with(client)  # Nothing to watch it for
+
+    mock_selector.reset_mock()
+    remove(client)
+    mock_selector.unregister.assert_not_called()  # It was not watched anymore
+    client.close.assert_called_once()
+
+# Test 7: Pasting many lines at once is throttled, not taken for flooding
+def test_paste_burst():
+    """
+    Test case where a client with the default limits sends 100 lines at once, far past its
+    burst. The lines should be delivered in order at the allowed rate, and the client stay
+    connected, as going over the limits once is a single strike.
+    """
+    with Simulation() as sim:
+        paster = sim.connect("Paster")
+        reader = sim.connect("Reader")
+        sim.run()
+        reader.read()
+        for index in range(100):
+            paster.say(f"line {index}")
+        sim.run(15)
+
+        received = [bytes(protocol.decode_sender(payload)[2]) for kind, payload in reader.read() if kind == protocol.CHAT]
+        assert received == [f"line {index}".encode() for index in range(100)]
+        assert server.registry.find("Paster") is not None
+        assert server.metrics.flood_removals == 0
+        assert server.metrics.throttles > 5  # Paused many times to catch up
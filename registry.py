@@ -0,0 +1,116 @@
+import protocol
+
+DEFAULT_ROOM = 'lobby'  # Room every client is in after joining the chat
+
+# Everything the server keeps about a connection
+class Session:
+    __slots__ = ('sock', 'nickname', 'sender', 'reader', 'outbox', 'last_seen', 'index', 'room', 'room_index',
+                 'queued_at', 'writing', 'compress', 'limiter', 'paused', 'throttling', 'deficit', 'backlogged',
+                 'messages_in', 'messages_out', 'bytes_in', 'bytes_out')
+
+    def __init__(self, sock, reader, outbox):
+        self.sock = sock
+        self.nickname = None  # Set once the handshake is over
+        self.sender = None  # Nickname and color as sent with its messages, once joined
+        self.reader = reader  # Receive buffer
+        self.outbox = outbox  # Messages waiting to be sent
+        self.last_seen = None  # When it last sent something (time.monotonic())
+        self.index = None  # Position in the fan-out list once joined
+        self.room = None  # Name of the room the client is in once joined
+        self.room_index = None  # Position in the member list of that room
+        self.queued_at = None  # When the handle() that filled the empty outbox started (ns)
+        self.writing = False  # Watched for writing, after its socket buffer filled up
+        self.compress = False  # Gets large messages compressed, if it said it supports it
+        self.limiter = None  # Rate limits of what the client sends, once joined
+        self.paused = False  # Not read from until its rate limits allow more
+        self.throttling = False  # Went over its rate limits, and has not caught up with what it sent since
+        self.deficit = 0  # Bytes of messages it may still have handled in this pass
+        self.backlogged = False  # Has messages received but not handled yet
+        self.messages_in = 0
+        self.messages_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def __repr__(self):
+        return f"Session({self.nickname!r})"
+
+# All the connections of the server, with O(1) add/remove
+class Registry:
+    def __init__(self):
+        self.sessions = {}  # Socket -> session, for every connection
+        self.nicknames = {}  # Nickname -> session, for the clients that joined
+        self.fanout = []  # Sessions that receive broadcasts (never the listening socket)
+        self.rooms = {}  # Room name -> sessions in it, only rooms with members are kept
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, sock):
+        return sock in self.sessions
+
+    def get(self, sock):
+        return self.sessions.get(sock)
+
+    def find(self, nickname):
+        return self.nicknames.get(nickname)
+
+    # Track a new connection that has not sent its nickname yet
+    def add(self, session):
+        self.sessions[session.sock] = session
+
+    # Sessions in a room, the fan-out list for messages sent to it
+    def members(self, room):
+        return self.rooms.get(room, ())
+
+    # Make a connection part of the chat, in the default room
+    def join(self, session, nickname, room=DEFAULT_ROOM, color=protocol.DEFAULT_COLOR):
+        session.nickname = nickname
+        session.sender = protocol.encode_sender(nickname, color)
+        session.index = len(self.fanout)
+        self.fanout.append(session)
+        self.nicknames[nickname] = session
+        self._enter(session, room)
+
+    # Move a joined session to another room, returns the room it left
+    def move(self, session, room):
+        previous = session.room
+        self._leave(session)
+        self._enter(session, room)
+        return previous
+
+    def _enter(self, session, room):
+        members = self.rooms.setdefault(room, [])
+        session.room = room
+        session.room_index = len(members)
+        members.append(session)
+
+    def _leave(self, session):
+        members = self.rooms[session.room]
+        # Same swap-remove as the fan-out list
+        last = members.pop()
+        if last is not session:
+            members[session.room_index] = last
+            last.room_index = session.room_index
+        if not members:
+            del self.rooms[session.room]
+        session.room = None
+        session.room_index = None
+
+    # Forget a connection, returns its session (None if it was unknown)
+    def remove(self, sock):
+        session = self.sessions.pop(sock, None)
+        if session is None:
+            return None
+
+        if session.index is not None:
+            # Move the last session into the freed slot instead of shifting the list
+            last = self.fanout.pop()
+            if last is not session:
+                self.fanout[session.index] = last
+                last.index = session.index
+            session.index = None
+            self._leave(session)
+
+        if self.nicknames.get(session.nickname) is session:
+            del self.nicknames[session.nickname]
+        return session
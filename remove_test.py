@@ -1,6 +1,8 @@
 import pytest
 from unittest.mock import Mock, patch
+from registry import Registry  # Sessions of the connected clients
 from server import remove  # Importing the 'remove' function from the server module
+from conftest import add_client  # Helpers shared by the tests
 
 # Mock data for testing
 @pytest.fixture
@@ -14,42 +16,40 @@ def setup_clients_and_nicknames():
     return client  # Return the mock client for use in the tests
 
 # Test 1: Optimal case - successful removal of a client
-@patch('server.nicknames', new_callable=dict)  # Mocking 'nicknames' dictionary in the server module
-@patch('server.clients', new_callable=list)  # Mocking 'clients' list in the server module
-def test_remove_optimal(mock_clients, mock_nicknames, setup_clients_and_nicknames):
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_remove_optimal(mock_registry, mock_selector, setup_clients_and_nicknames):
     """
     Test case for the optimal scenario where a valid client is removed successfully from both
     the clients list and the nicknames dictionary.
     """
     client = setup_clients_and_nicknames  # Set up a mock client using the fixture
-    mock_clients.append(client)  # Add the client to the mock clients list
-    mock_nicknames[client] = "TestUser"  # Add the client's nickname to the mock nicknames dictionary
-    
-    # Patch the 'clients' and 'nicknames' in the server module, then call 'remove'
-    with patch('server.clients', mock_clients), patch('server.nicknames', mock_nicknames):
-        remove(client)  # Call the remove function to simulate client removal
-    
+    session = add_client(mock_registry, client, "TestUser")  # Add the client and its nickname to the registry
+
+    # Call 'remove' with the registry patched in the server module
+    remove(client)  # Call the remove function to simulate client removal
+
     # Assertions to verify the correct behavior
-    assert client not in mock_clients  # Ensure the client is removed from the clients list
-    assert client not in mock_nicknames  # Ensure the client's nickname is removed from the nicknames dictionary
+    assert client not in mock_registry  # Ensure the client is removed from the registry
+    assert session not in mock_registry.fanout  # Ensure the client no longer receives broadcasts
+    assert mock_registry.find("TestUser") is None  # Ensure the client's nickname is removed from the nickname index
     client.close.assert_called_once()  # Ensure that the 'close' method of the client is called once
+    mock_selector.unregister.assert_called_once_with(client)  # Ensure the client is no longer watched by the selector
 
 # Test 2: Invalid client case - client is an empty string
-@patch('server.nicknames', new_callable=dict)  # Mocking 'nicknames' dictionary in the server module
-@patch('server.clients', new_callable=list)  # Mocking 'clients' list in the server module
-def test_no_client(mock_clients, mock_nicknames):
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_no_client(mock_registry):
     """
     Test case where the client passed to the 'remove' function is an empty string, which is invalid.
     The function should raise a ValueError.
     """
     with pytest.raises(ValueError):  # Expecting a ValueError when passing an invalid client
-        with patch('server.clients', mock_clients), patch('server.nicknames', mock_nicknames):
-            remove("")  # Calling remove with an empty string as the client
+        remove("")  # Calling remove with an empty string as the client
 
 # Test 3: Client not found in either clients or nicknames
-@patch('server.nicknames', new_callable=dict)  # Mocking 'nicknames' dictionary in the server module
-@patch('server.clients', new_callable=list)  # Mocking 'clients' list in the server module
-def test_wrong_client(mock_clients, mock_nicknames, setup_clients_and_nicknames):
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_wrong_client(mock_registry, mock_selector, setup_clients_and_nicknames):
     """
     Test case where the client passed to 'remove' does not exist in the 'clients' or 'nicknames'.
     The original client should not be removed.
@@ -57,14 +57,30 @@ def test_wrong_client(mock_clients, mock_nicknames, setup_clients_and_nicknames)
     client = setup_clients_and_nicknames  # Set up a mock client using the fixture
     fake_client = Mock()  # Create another mock client (which does not exist in the clients list)
 
-    # Add the real client to the mock clients list and nicknames dictionary
-    mock_clients.append(client)
-    mock_nicknames[client] = "TestUser"
-    
-    # Patch the 'clients' and 'nicknames' in the server module, then call 'remove' with a fake client
-    with patch('server.clients', mock_clients), patch('server.nicknames', mock_nicknames):
-        remove(fake_client)  # Attempt to remove a non-existent client
-    
+    # Add the real client and its nickname to the registry
+    session = add_client(mock_registry, client, "TestUser")
+
+    # Call 'remove' with a fake client
+    remove(fake_client)  # Attempt to remove a non-existent client
+
     # Assertions to verify the original client was not affected
-    assert client in mock_clients  # The real client should still be in the clients list
-    assert mock_nicknames[client] == "TestUser"  # The nickname of the real client should still be "TestUser"
+    assert client in mock_registry  # The real client should still be in the registry
+    assert mock_registry.find("TestUser") is session  # The nickname of the real client should still be "TestUser"
+    assert mock_registry.fanout == [session]  # The real client still receives broadcasts
+    mock_selector.unregister.assert_not_called()  # The real client is still watched by the selector
+
+# Test 4: Removing a client keeps the fan-out list compact
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_remove_middle_client(mock_registry, mock_selector):
+    """
+    Test case where a client in the middle of the fan-out list is removed.
+    The last client should take its place, so the others keep their positions.
+    """
+    first, middle, last = (add_client(mock_registry, Mock(), f"User{i}") for i in range(3))
+
+    remove(middle.sock)
+
+    assert mock_registry.fanout == [first, last]  # The last client moved into the free slot
+    assert last.index == 1  # And knows its new position
+    assert mock_registry.find("User2") is last  # The nickname index is untouched
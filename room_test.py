@@ -0,0 +1,217 @@
+import pytest
+from unittest.mock import Mock, patch
+import protocol  # Framing of the messages
+from registry import Registry, Session  # Sessions of the connected clients
+from history import History  # Recent messages of the rooms
+from server import handle, handle_peer, Outbox  # Importing the functions to be tested from the server module
+from client import build_message  # Turning typed lines into messages
+from conftest import add_client, feed, texts  # Helpers shared by the tests
+
+# Test 1: The registry keeps a member list per room
+def test_registry_rooms():
+    """
+    Test case where clients join, change rooms and leave. Each room should list exactly its
+    members, and rooms without members should be forgotten.
+    """
+    registry = Registry()
+    first, second, third = (add_client(registry, Mock(), f"User{i}") for i in range(3))
+
+    assert registry.members('lobby') == [first, second, third]  # Everybody starts in the lobby
+
+    assert registry.move(first, 'games') == 'lobby'  # The room that was left is returned
+    assert registry.members('lobby') == [third, second]  # The last member took the free slot
+    assert third.room_index == 0  # And knows its new position
+    assert registry.members('games') == [first]
+
+    registry.remove(first.sock)
+    assert 'games' not in registry.rooms  # Empty rooms are dropped
+    assert registry.members('games') == ()
+
+# Test 2: Chat messages only reach the sender's room
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_message_stays_in_room(mock_registry, mock_selector):
+    """
+    Test case where a client in a room sends a message. Only the other members of the
+    room should receive it.
+    """
+    sender = add_client(mock_registry, Mock(), "Sender", 'games')
+    member = add_client(mock_registry, Mock(), "Member", 'games')
+    outsider = add_client(mock_registry, Mock(), "Outsider")
+    feed(sender.sock, protocol.encode(protocol.TEXT, b'hello'))
+
+    assert handle(sender.sock) is True
+
+    assert list(member.outbox.messages) == [protocol.encode_chat(sender.sender, b'hello')]  # Delivered in the room
+    assert not outsider.outbox  # Not outside of it
+    assert not sender.outbox  # Nor echoed back
+
+# Test 3: Changing rooms tells both rooms and the client
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.history', new=History(0))  # No messages to replay
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_join_room(mock_registry, mock_selector):
+    """
+    Test case where a client joins another room. The old room hears that it left, the new
+    room that it arrived, and the client gets a confirmation.
+    """
+    mover = add_client(mock_registry, Mock(), "Mover")
+    old = add_client(mock_registry, Mock(), "Old")
+    new = add_client(mock_registry, Mock(), "New", 'games')
+    feed(mover.sock, protocol.encode(protocol.ROOM_JOIN, b'games'))
+
+    assert handle(mover.sock) is True
+
+    assert mover.room == 'games'
+    assert list(old.outbox.messages) == [protocol.encode_leave(mover.sender, 'lobby')]
+    assert list(new.outbox.messages) == [protocol.encode_join(mover.sender, 'games')]
+    assert texts(mover) == [b'You are now in games']
+
+# Test 4: Leaving a room goes back to the lobby
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_leave_room(mock_registry, mock_selector):
+    """
+    Test case where a client leaves its room. It should be back in the default room and the
+    room it left should be gone, since it has no members.
+    """
+    session = add_client(mock_registry, Mock(), "User", 'games')
+    feed(session.sock, protocol.encode(protocol.ROOM_LEAVE))
+
+    assert handle(session.sock) is True
+
+    assert session.room == 'lobby'
+    assert 'games' not in mock_registry.rooms
+
+# Test 5: Listing the rooms only answers the client that asked
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_list_rooms(mock_registry, mock_selector):
+    """
+    Test case where a client asks for the rooms. It should get every room with its number of
+    members, and nobody else should receive anything.
+    """
+    session = add_client(mock_registry, Mock(), "User")
+    other = add_client(mock_registry, Mock(), "Other", 'games')
+    feed(session.sock, protocol.encode(protocol.ROOM_LIST))
+
+    assert handle(session.sock) is True
+
+    assert texts(session) == [b'Rooms: games (1), lobby (1)']
+    assert not other.outbox
+
+# Test 6: Invalid room names are refused
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+@pytest.mark.parametrize('room', [b'', b'   ', b'x' * 33])
+def test_invalid_room(mock_registry, mock_selector, room):
+    """
+    Test case where a client asks for an empty or too long room name. It should stay where
+    it is and be told why.
+    """
+    session = add_client(mock_registry, Mock(), "User")
+    feed(session.sock, protocol.encode(protocol.ROOM_JOIN, room))
+
+    assert handle(session.sock) is True
+
+    assert session.room == 'lobby'
+    assert texts(session) == [b'Room names are 1 to 32 bytes long']
+
+# Test 7: Messages from another worker keep their room
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.peers', new_callable=dict)  # Mocking the links to the other workers in the server module
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_peer_message_for_room(mock_registry, mock_peers, mock_selector):
+    """
+    Test case where another worker forwards a message sent in a room. Only the local members
+    of that room should receive it.
+    """
+    member = add_client(mock_registry, Mock(), "Member", 'games')
+    outsider = add_client(mock_registry, Mock(), "Outsider")
+    link = Session(Mock(), protocol.FrameReader(), Outbox())
+    mock_peers[link.sock] = link
+    message = protocol.encode(protocol.TEXT, b'Someone: hello')
+    feed(link.sock, protocol.encode_routed(b'games', message))
+
+    assert handle_peer(link.sock) is True
+
+    assert list(member.outbox.messages) == [message]
+    assert not outsider.outbox
+
+# Test 8: The client turns commands into room messages
+@pytest.mark.parametrize('line, expected', [
+    ('/join games', protocol.encode(protocol.ROOM_JOIN, b'games')),
+    ('/leave', protocol.encode(protocol.ROOM_LEAVE)),
+    ('/rooms', protocol.encode(protocol.ROOM_LIST)),
+    ('/join', protocol.encode(protocol.TEXT, b'/join')),  # No room given, sent as text
+    ('hello', protocol.encode(protocol.TEXT, b'hello')),  # The server adds who sent it
+])
+def test_client_commands(line, expected):
+    """
+    Test case where the user types commands and plain text. Commands become room messages,
+    anything else is sent as chat.
+    """
+    assert build_message(line) == expected
+
+# Test 9: A room name that is not UTF-8 is refused
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_room_not_utf8(mock_registry, mock_selector):
+    """
+    Test case where a client asks for a room whose name is not valid UTF-8. It should stay
+    where it is, be told why, and the server keep going.
+    """
+    session = add_client(mock_registry, Mock(), "User")
+    feed(session.sock, protocol.encode(protocol.ROOM_JOIN, b'\xff\xfe'))
+
+    assert handle(session.sock) is True
+
+    assert session.room == 'lobby'
+    assert texts(session) == [b'Room names must be valid UTF-8']
+
+# Test 10: A client that never reads is removed even if it only asks for answers
+@patch('server.OVERFLOW_POLICY', 'disconnect')  # Remove clients whose buffer is full
+@patch('server.HIGH_WATERMARK', 100)
+@patch('server.pending', new_callable=list)  # Mocking the sessions to flush at the end of the loop pass
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_list_rooms_overflow(mock_registry, mock_selector, mock_pending):
+    """
+    Test case where a client whose buffer is nearly full asks for the list of rooms again
+    and again. The first answer that goes over the high watermark should remove it, the
+    rest of its requests be ignored, and its room told it left.
+    """
+    session = add_client(mock_registry, Mock(), "Reader")
+    other = add_client(mock_registry, Mock(), "Other")
+    session.outbox.put(b'x' * 90)
+    feed(session.sock, protocol.encode(protocol.ROOM_LIST) * 5)
+
+    assert handle(session.sock) is True  # Already removed, nothing left for the event loop to do
+
+    assert session.sock not in mock_registry
+    session.sock.close.assert_called_once()
+    assert session.messages_out == 1  # Only the answer that overflowed
+    assert list(other.outbox.messages) == [protocol.encode_leave(session.sender)]
+
+# Test 11: The list of rooms always fits in a frame
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_list_many_rooms(mock_registry, mock_selector):
+    """
+    Test case where a client asks for the list of rooms while 2000 rooms have members.
+    The answer should stay under the largest frame the clients read, list the first rooms
+    and say how many more there are.
+    """
+    for index in range(2000):
+        add_client(mock_registry, Mock(), f"User{index}", f"room-{index:04d}-{'x' * 22}")
+    session = mock_registry.find("User0")
+    feed(session.sock, protocol.encode(protocol.ROOM_LIST))
+
+    assert handle(session.sock) is True
+
+    [text] = texts(session)
+    assert len(text) <= protocol.MAX_MESSAGE_SIZE
+    assert text.startswith(b'Rooms: room-0000-' + b'x' * 22 + b' (1), ')
+    listed = text.count(b' (1)')
+    assert text.endswith(f", and {2000 - listed} more".encode())
+    assert 1000 < listed < 2000
@@ -0,0 +1,117 @@
+from unittest.mock import Mock, patch
+import protocol  # Framing of the messages
+from history import History  # Recent messages of the rooms
+from metrics import Metrics  # Counters of the server
+from registry import Registry  # Sessions of the connected clients
+from timerwheel import TimerWheel  # Deadlines of the clients
+from server import accept, serve  # Importing the functions to be tested from the server module
+from conftest import add_client, feed, texts  # Helpers shared by the tests
+
+# Test 1: A client only has its quantum of messages handled per pass
+@patch('server.READ_QUANTUM', 20)  # Bytes handled per client and pass
+@patch('server.backlog', new_callable=list)  # Mocking the clients with messages waiting
+@patch('server.history', new=History(0))  # No messages to replay
+@patch('server.metrics', new_callable=Metrics)  # Mocking the metrics in the server module
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_quantum(mock_registry, mock_selector, mock_metrics, mock_backlog):
+    """
+    Test case where a client sends 3 messages of 8 bytes at once with a quantum of 20 bytes.
+    Two should be handled in the first pass, the third in the next one without reading
+    from the socket again.
+    """
+    sender = add_client(mock_registry, Mock(), "Sender")
+    receiver = add_client(mock_registry, Mock(), "Receiver")
+    feed(sender.sock, b''.join(protocol.encode(protocol.TEXT, text) for text in (b'one', b'two', b'six')))
+
+    serve([sender], 0)
+    assert texts(receiver) == [b'one', b'two']
+    assert mock_backlog == [sender]
+    assert sender.backlogged is True
+    assert sender.deficit == 4  # Left from the quantum
+
+    serve([], 0)
+    assert texts(receiver) == [b'one', b'two', b'six']
+    assert mock_backlog == []
+    assert sender.deficit == 0  # Nothing saved once nothing is waiting
+    sender.sock.recv_into.assert_called_once()
+
+# Test 2: A message larger than the quantum is handled once enough passes add up
+@patch('server.READ_QUANTUM', 20)  # Bytes handled per client and pass
+@patch('server.backlog', new_callable=list)  # Mocking the clients with messages waiting
+@patch('server.history', new=History(0))  # No messages to replay
+@patch('server.metrics', new_callable=Metrics)  # Mocking the metrics in the server module
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_large_message(mock_registry, mock_selector, mock_metrics, mock_backlog):
+    """
+    Test case where a client sends a 35 byte message with a quantum of 20 bytes. It should
+    wait one pass, then be handled with the quantum of two passes.
+    """
+    sender = add_client(mock_registry, Mock(), "Sender")
+    receiver = add_client(mock_registry, Mock(), "Receiver")
+    feed(sender.sock, protocol.encode(protocol.TEXT, b'A' * 30))
+
+    serve([sender], 0)
+    assert texts(receiver) == []
+    assert mock_backlog == [sender]
+
+    serve([], 0)
+    assert texts(receiver) == [b'A' * 30]
+    assert mock_backlog == []
+
+# Test 3: Every pass starts with a different client
+@patch('server.turn', 0)  # First pass
+@patch('server.handle', return_value=True)  # Mocking the 'handle' function in the server module
+@patch('server.metrics', new_callable=Metrics)  # Mocking the metrics in the server module
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_rotation(mock_registry, mock_metrics, mock_handle):
+    """
+    Test case where the same three clients are ready in several passes. Each pass should
+    start one client further, and still handle all of them.
+    """
+    sessions = [add_client(mock_registry, Mock(), f"User{i}") for i in range(3)]
+    orders = []
+    for _ in range(3):
+        mock_handle.reset_mock()
+        serve(sessions, 0)
+        orders.append([sessions.index(mock_registry.get(call.args[0])) for call in mock_handle.call_args_list])
+
+    assert orders == [[0, 1, 2], [1, 2, 0], [2, 0, 1]]
+
+# Test 4: A client removed earlier in the pass is skipped
+@patch('server.turn', 0)  # First pass
+@patch('server.handle', return_value=False)  # Every client fails
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.metrics', new_callable=Metrics)  # Mocking the metrics in the server module
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_removed_skipped(mock_registry, mock_metrics, mock_selector, mock_handle):
+    """
+    Test case where a client that failed is also ready a second time in the same pass. It
+    should be handled and removed only once.
+    """
+    session = add_client(mock_registry, Mock(), "TestUser")
+
+    serve([session, session], 0)
+
+    mock_handle.assert_called_once_with(session.sock)
+    session.sock.close.assert_called_once()
+
+# Test 5: Only a batch of connections is accepted per pass
+@patch('server.ACCEPT_BATCH', 2)  # Connections accepted per pass
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.pending', new_callable=list)  # Mocking the sessions to flush at the end of the loop pass
+@patch('server.timers', new_callable=lambda: TimerWheel(0))  # Mocking the deadlines of the clients
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_accept_batch(mock_registry, mock_timers, mock_pending, mock_selector):
+    """
+    Test case where 3 connections are waiting with a batch of 2. Only 2 should be accepted,
+    the last one is left for the next pass.
+    """
+    listener = Mock()
+    listener.accept.side_effect = [(Mock(), ('127.0.0.1', 40000 + i)) for i in range(3)]
+
+    accept(listener)
+
+    assert len(mock_registry) == 2
+    assert listener.accept.call_count == 2
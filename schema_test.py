@@ -0,0 +1,100 @@
+import pytest
+from unittest.mock import Mock, patch
+import protocol  # Framing of the messages
+from history import History  # Recent messages of the rooms
+from registry import Registry  # Sessions of the connected clients
+from server import handle  # Importing the functions to be tested from the server module
+import client as chat_client
+from conftest import add_client, feed  # Helpers shared by the tests
+
+# Test 1: The nickname and color survive the handshake message
+@pytest.mark.parametrize('payload, expected', [
+    (protocol.payload(protocol.encode_nick('TestUser', 3)), ('TestUser', 3)),
+    (b'TestUser', ('TestUser', protocol.DEFAULT_COLOR)),  # A client that sends no color
+    (b'TestUser\0\xff', ('TestUser', protocol.DEFAULT_COLOR)),  # Or a color nobody knows
+])
+def test_nick(payload, expected):
+    """
+    Test case where the answer to the nickname request is decoded. The color should be the
+    one sent, or the default one when there is no valid color.
+    """
+    assert protocol.decode_nick(payload) == expected
+
+# Test 2: The server sends the sender with the message, whatever the text says
+@patch('server.history', new=History(0))  # No messages to replay
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_sender_attribution(mock_registry, mock_selector):
+    """
+    Test case where a client sends a message pretending to be somebody else. The others
+    should get it with the sender the server knows, and the text as it was sent.
+    """
+    sender = add_client(mock_registry, Mock(), "Sender", color=protocol.COLORS.index('red'))
+    receiver = add_client(mock_registry, Mock(), "Receiver")
+    feed(sender.sock, protocol.encode(protocol.TEXT, b'Admin: hello'))
+
+    assert handle(sender.sock) is True
+
+    message = receiver.outbox.messages[0]
+    assert protocol.HEADER.unpack_from(message)[1] == protocol.CHAT
+    nickname, color, text = protocol.decode_sender(protocol.payload(message))
+    assert (nickname, color, bytes(text)) == ("Sender", 1, b'Admin: hello')
+    assert len(message) == protocol.HEADER.size + 1 + len("Sender") + 1 + len('Admin: hello')  # No escape codes
+
+# Test 3: A message that would not fit with its sender is refused
+@patch('protocol.MAX_MESSAGE_SIZE', 16)  # Largest message accepted
+@patch('server.selector')  # Mocking the selector that watches the sockets
+@patch('server.registry', new_callable=Registry)  # Mocking the registry of clients in the server module
+def test_message_too_long(mock_registry, mock_selector):
+    """
+    Test case where a client sends a message that fits the limit, but not with its sender
+    added. It should be told, and nobody else get it.
+    """
+    sender = add_client(mock_registry, Mock(), "Sender")
+    receiver = add_client(mock_registry, Mock(), "Receiver")
+    feed(sender.sock, protocol.encode(protocol.TEXT, b'x' * 10))
+
+    assert handle(sender.sock) is True
+
+    assert list(sender.outbox.messages) == [protocol.encode_error("Message too long")]
+    assert not receiver.outbox
+
+# Test 4: The client paints the nicknames itself
+@pytest.mark.parametrize('message, expected', [
+    (protocol.encode_chat(protocol.encode_sender('Bob', 4), b'hi'), '\x1b[34mBob\x1b[0m: hi'),
+    (protocol.encode_join(protocol.encode_sender('Bob', 4)), '\x1b[34mBob\x1b[0m joined the chat'),
+    (protocol.encode_join(protocol.encode_sender('Bob', 4), 'games'), '\x1b[34mBob\x1b[0m joined games'),
+    (protocol.encode_leave(protocol.encode_sender('Bob', 4)), '\x1b[34mBob\x1b[0m left the chat.'),
+    (protocol.encode_leave(protocol.encode_sender('Bob', 4), 'games'), '\x1b[34mBob\x1b[0m left games'),
+    (protocol.encode_leave(protocol.encode_sender('Bob', 4), reason=protocol.FLOODED),
+     '\x1b[34mBob\x1b[0m was disconnected for flooding.'),
+    (protocol.encode_text('Rooms: lobby (2)'), 'Rooms: lobby (2)'),
+])
+def test_render(message, expected):
+    """
+    Test case where the client gets chat messages and announcements about a blue user,
+    and a notice. The nickname should be shown in blue, the rest as text.
+    """
+    kind = protocol.HEADER.unpack_from(message)[1]
+    assert chat_client.render(kind, protocol.payload(message)) == expected
+
+# Test 5: The client sends its nickname and color once, at the handshake
+@patch('client.introduced', False)  # Nothing sent yet
+@patch('client.color', 2, create=True)  # Color chosen by the user
+@patch('client.nickname', 'TestUser', create=True)  # Nickname chosen by the user
+@patch('client.client', create=True)  # Mocking the socket connected to the server
+def test_client_handshake(mock_client):
+    """
+    Test case where the server asks for the nickname, then closes the connection. The
+    client should answer with its nickname, color and the features it supports.
+    """
+    calls = iter([protocol.encode(protocol.NICK), b''])
+    def deliver(buffer):
+        chunk = next(calls)
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+    mock_client.recv_into.side_effect = deliver
+
+    chat_client.receive()
+
+    mock_client.sendall.assert_called_once_with(protocol.encode(protocol.NICK, b'TestUser\0\x02\x01'))
@@ -1,125 +1,1551 @@
 import socket
-import select
+import selectors
 import time
+from collections import deque
+from itertools import islice
+import argparse
+import multiprocessing
+import signal
+import threading
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import os
+import async_server
+import handoff
+import logger
+import protocol
+from history import History, MessageLog
+from metrics import Metrics
+from offline import OfflineQueues
+from logger import Payload
+from ratelimit import RateLimiter
+from timerwheel import TimerWheel
+from registry import Registry, Session, DEFAULT_ROOM
+
+# Messages about every single chat message are logged at DEBUG, off by default
+log = logging.getLogger('chat.server')
 
 # Configure the addresses
 HOST = '127.0.0.1'  # localhost
 PORT = 55555 
 
-# Define the type of connection and protocol
-server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-# Configure the host and port to be reusable
-server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+# Create the listening socket. With reuse_port several processes can listen
+# on the same address, and the kernel spreads the connections among them
+def create_listener(host=HOST, port=PORT, reuse_port=False):
+    # Define the type of connection and protocol
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # Configure the host and port to be reusable
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+    # Apply the configurations to the server and start it
+    listener.bind((host, port))
+    listener.listen(socket.SOMAXCONN)
+    listener.setblocking(False)
+    return listener
+
+# The current time (seconds) for the timers, rate limits and queues. A
+# simulation replaces it with a virtual clock
+def clock():
+    return time.monotonic()
+
+# The listening socket, bound by ChatServer.start(). Importing this module opens
+# no socket, so the functions can be used (and tested) without a server running
+server = None
+
+# The selector watches every socket (epoll on Linux). Sockets are registered
+# once, and only watched for writing while they have messages waiting
+selector = selectors.DefaultSelector()
+
+# The event loop runs while this is set. ChatServer.stop() clears it and writes
+# to the wakeup socket, so a loop waiting in select() notices at once
+running = False
+wakeup = None
+
+# Outbound buffer limits per client (bytes). Past the high watermark the
+# overflow policy is applied; 'drop-oldest' trims the buffer to the low watermark
+HIGH_WATERMARK = 256 * 1024
+LOW_WATERMARK = 64 * 1024
+OVERFLOW_POLICIES = ('drop-oldest', 'disconnect')
+OVERFLOW_POLICY = 'disconnect'
+
+# Messages are written as soon as they are queued, several at once, so Nagle's
+# algorithm would only delay them. It can be turned back on from the command line
+TCP_NODELAY = True
+
+# Most buffers passed to a single sendmsg() call (the usual IOV_MAX)
+MAX_BUFFERS = 1024
+
+# Bytes of messages a client may have handled per pass of the event loop (deficit
+# round robin). What it sent beyond that waits for the next pass, so a client
+# sending a lot cannot hold up the others for long
+READ_QUANTUM = 4096
+
+# Connections accepted per pass of the event loop, the rest wait for the next
+# pass so a storm of connections cannot hold up the clients either
+ACCEPT_BATCH = 64
+
+# Seconds a new connection has to send its nickname before it is dropped
+HANDSHAKE_TIMEOUT = 10
+
+# Clients that sent nothing for PING_INTERVAL seconds are sent a ping, which they
+# answer with a pong; those that sent nothing for IDLE_TIMEOUT seconds, not even
+# a pong, are dropped (0 turns either off)
+PING_INTERVAL = 30
+IDLE_TIMEOUT = 90
+
+# What a client may send: messages and bytes per second, in bursts of up to the
+# *_BURST amounts (a rate of 0 turns the limit off). Past them 'throttle' stops
+# reading from the client until it may send again, 'drop' drops its messages
+# and tells it so
+MESSAGE_RATE = 10
+MESSAGE_BURST = 20
+BYTE_RATE = 64 * 1024
+BYTE_BURST = 256 * 1024
+FLOOD_POLICIES = ('throttle', 'drop')
+FLOOD_POLICY = 'throttle'
+
+# Clients going over the limits more than FLOOD_STRIKES times in about
+# FLOOD_WINDOW seconds are disconnected
+FLOOD_STRIKES = 5
+FLOOD_WINDOW = 10
+
+# Longest room name accepted (bytes)
+MAX_ROOM_NAME = 32
+
+# Messages kept per room and replayed to the clients entering it. With a
+# directory they are also logged there, and reloaded when the server restarts
+HISTORY_SIZE = 50
+HISTORY_DIR = None
+
+# Direct messages kept for nicknames that are not connected: how many per
+# nickname, for how long (seconds) and how many bytes for all of them
+OFFLINE_QUEUE_SIZE = 20
+OFFLINE_TTL = 24 * 3600
+OFFLINE_BYTES = 4 * 1024 * 1024
+
+# Where the metrics are published: a Unix socket that answers every connection
+# with a snapshot, and/or a file rewritten every STATS_INTERVAL seconds
+STATS_SOCKET = None
+STATS_FILE = None
+STATS_INTERVAL = 10
+
+# Seconds the handoff to a new process may take before this process gives up
+# and keeps serving the clients itself
+HANDOFF_TIMEOUT = 10
+
+# Messages of at least this many bytes are compressed for the clients that
+# support it, once for all of them. 0 turns compression off, and stops offering it
+COMPRESS_THRESHOLD = protocol.COMPRESS_THRESHOLD
+
+# Every connection, its nickname and buffers (the listening socket is not part of it)
+registry = Registry()
+
+# Recent messages of every room (replaced at startup once the options are known)
+history = History(HISTORY_SIZE)
+
+# Direct messages waiting for their recipient to join (replaced at startup once the options are known)
+offline = OfflineQueues(OFFLINE_QUEUE_SIZE, OFFLINE_TTL, OFFLINE_BYTES)
 
-# Apply the configurations to the server and start it
-server.bind((HOST, PORT))
-server.listen(100)
+# Counters and stage timings, read through the stats socket or file
+metrics = Metrics()
+stats_listener = None
+stats_due = None  # When the stats file is written next
 
-# Create lists for clients/nicknames
-clients = [server]
-nicknames = {}
+# Unix socket a new process connects to, to take the clients over (None without --handoff-socket)
+handoff_listener = None
+
+# The next deadline of every client: the end of its handshake, then when to check
+# whether it went quiet. Each client has a single timer, moved as it goes
+timers = TimerWheel(clock())
+
+# Clients the server gave up on whose rooms are still to be told, as (sender, room)
+departures = deque()
+
+# Clients with messages received but not handled yet, because they used up their
+# quantum. They are handled in the next pass, before anything more is read from them
+backlog = []
+
+# Moves the client each pass of the event loop starts with
+turn = 0
+
+# Clients whose reads are paused by the rate limits, as a heap of
+# (when they may send again, order of pausing, session)
+throttled = []
+throttle_order = itertools.count()
+
+# Heartbeat frames, the same for every client
+PING = protocol.encode(protocol.PING)
+PONG = protocol.encode(protocol.PONG)
+
+# Sessions that got messages during this pass of the event loop. They are flushed
+# at the end of the pass, all their new messages with one call
+pending = []
+
+# Links to the other worker processes (socket -> session) when running with
+# several workers. Broadcasts are forwarded once to every other worker, which
+# delivers them to its own clients only
+peers = {}
+
+# Messages waiting to be sent to a client. The messages are shared by every
+# outbox they were queued in, and are never copied
+class Outbox:
+    __slots__ = ('messages', 'size', 'offset', 'bounded')
+
+    def __init__(self, bounded=True):
+        self.messages = deque()
+        self.size = 0  # Bytes waiting to be sent
+        self.offset = 0  # Bytes of the first message already sent
+        # Whether the overflow policy applies. The links to the other workers are
+        # not bounded: a message dropped there would never reach their clients
+        self.bounded = bounded
+
+    def __len__(self):
+        return self.size
+
+    # Queue a message, returns False if the client should be disconnected
+    def put(self, message):
+        self.messages.append(message)
+        self.size += len(message)
+
+        if self.size > HIGH_WATERMARK and self.bounded:
+            if OVERFLOW_POLICY == 'disconnect':
+                return False
+            # Drop the oldest messages, but never one that is half sent
+            oldest = 1 if self.offset else 0
+            while self.size > LOW_WATERMARK and len(self.messages) > oldest:
+                self.size -= len(self.messages[oldest])
+                del self.messages[oldest]
+        return True
+
+    # Send as much as the socket accepts without blocking, returns the bytes sent.
+    # All the waiting messages go in a single vectored write
+    def flush(self, client):
+        total = 0
+        while self.messages:
+            buffers = [memoryview(self.messages[0])[self.offset:]]
+            buffers.extend(islice(self.messages, 1, MAX_BUFFERS))
+            requested = sum(map(len, buffers))
+            metrics.send_calls += 1
+            try:
+                sent = client.sendmsg(buffers)
+            except BlockingIOError:
+                break
+            total += sent
+            self.size -= sent
+            full = sent < requested
+
+            # Forget the messages sent in full
+            sent += self.offset
+            while self.messages and sent >= len(self.messages[0]):
+                sent -= len(self.messages.popleft())
+            self.offset = sent
+            if full:
+                # The socket buffer is full
+                break
+        return total
 
 # Function to remove and disconnect clients
 def remove(client):
-    if client in clients:
-        clients.remove(client)
-    if client in nicknames:
-        print(f"Client {nicknames[client]} has disconnected")
-        del nicknames[client]
+    if not client:
+        raise ValueError(f"Invalid client: {client!r}")
+
+    session = registry.remove(client)
+    if session is not None:
+        timers.cancel(session)
+        if not session.paused or session.writing:
+            selector.unregister(client)
+        if session.nickname is not None:
+            log.info("Client %s has disconnected", session.nickname)
     client.close()
 
-# Broadcast messages to all clients (announcement)
-def broadcast(message, sender=None):
+# Broadcast messages to the clients of a room, or to all clients (announcement)
+def broadcast(message, sender=None, room=None):
+    # Clients connected to other workers get it through their worker
+    if peers:
+        routed = protocol.encode_routed(room.encode('utf-8') if room else b'', message)
+        for peer in peers.values():
+            # Never refused, their outboxes are not bounded
+            queue(peer, routed)
+    fan_out(message, sender, room)
+
+# Queue a message for a session, returns False if its buffer overflowed
+def queue(session, message):
+    outbox = session.outbox
+    if not outbox:
+        # Sent at the end of this pass of the event loop, with whatever else it gets until then
+        pending.append(session)
+        # Only measured for messages queued by a handle(), None otherwise
+        session.queued_at = metrics.handle_started
+    session.messages_out += 1
+    metrics.messages_out += 1
+    return outbox.put(message)
+
+# Queue a message for one client, and remove it if its buffer overflowed. Returns
+# False if it was removed
+def deliver(session, message):
+    if queue(session, message):
+        return True
+    log.warning("Outbound buffer of %s is full", session.nickname)
+    disconnect(session)
+    return False
+
+# Deliver a message to the clients of this process, only those in the room if one is given
+def fan_out(message, sender=None, room=None):
+    # Remember it for the clients that enter the room later
+    if room is not None:
+        history.record(room, message)
+
+    recipients = registry.fanout if room is None else registry.members(room)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Sending %s to %d clients in %s", Payload(protocol.payload(message)), len(recipients), room or "every room")
+
+    # Large messages are compressed once, for all the clients that support it
+    compressible = COMPRESS_THRESHOLD and len(message) >= COMPRESS_THRESHOLD
+    compressed = None
+
     # List of problematic clients
     clients_to_remove = []
     
-    for client in clients:
-        if client != sender and client != server:
-            
-            # Try to send a message
-            for attempt in range(3):
-                try:
-                    print(f"Trying to send message: {message}")
-                    client.send(message)
-                    break
-                
-                except socket.error as error:
-                    print(f"Error sending message to a client: {error}\n        Retrying: {attempt+1}...")
-                    time.sleep(1)  # Wait before retrying
-            
-            # If, after 3 attempts, it still doesn't work
-            else:
-                clients_to_remove.append(client)
+    for session in recipients:
+        if session.sock is not sender:
+            outgoing = message
+            if compressible and session.compress:
+                if compressed is None:
+                    compressed = protocol.compress(message)
+                    metrics.compressed += 1
+                outgoing = compressed
+                metrics.compression_saved += len(message) - len(compressed)
+
+            # Queue the message, it is sent once the client's socket is writable
+            if not queue(session, outgoing):
+                log.warning("Outbound buffer of %s is full", session.nickname)
+                clients_to_remove.append(session)
     
     # Remove problematic clients
-    for client in clients_to_remove:
-        remove(client)
-        broadcast(f"{nicknames.get(client, 'Unknown')} left the chat.".encode('utf-8'))
+    for session in clients_to_remove:
+        disconnect(session)
+
+# Remove a client the server gave up on, and tell its room
+def disconnect(session):
+    metrics.forced_removals += 1
+    departure = (session.sender, session.room)
+    remove(session.sock)
+    if departure[0] is None:
+        return
+
+    departures.append(departure)
+    if len(departures) > 1:
+        # The disconnect() already telling the rooms tells this one too. Telling it
+        # here could drop more clients, and recurse once for each of them
+        return
+    while departures:
+        sender, room = departures[0]
+        broadcast(protocol.encode_leave(sender), room=room)
+        departures.popleft()
+
+# Send the queued messages of a client (or worker link)
+def flush(client):
+    session = registry.get(client) or peers.get(client)
+    if session is None:
+        return True
+
+    try:
+        sent = session.outbox.flush(client)
+        session.bytes_out += sent
+        metrics.bytes_out += sent
+        if not session.outbox:
+            if session.writing:
+                # Everything was sent, stop watching the client for writing
+                session.writing = False
+                watch(session, True)
+            if session.queued_at is not None:
+                metrics.handle_to_send.record(time.perf_counter_ns() - session.queued_at)
+                session.queued_at = None
+        else:
+            # The socket buffer is full, the rest goes when it is writable again
+            metrics.send_retries += 1
+            if not session.writing:
+                registered = not session.paused
+                session.writing = True
+                watch(session, registered)
+        return True
+
+    except socket.error as error:
+        log.warning("Error sending message to a client: %s", error)
+        return False
 
 # Handle message receiving and transmission from a client
 def handle(client):
-    for attempt in range(3):
+    session = registry.get(client)
+    if session is None:
+        return False
+    reader = session.reader
+
+    # Try to receive messages
+    try:
+        metrics.recv_calls += 1
+        received = reader.recv(client)
+        if received:
+            session.bytes_in += received
+            metrics.bytes_in += received
+            session.last_seen = clock()
+            return process(session)
         
-        # Try to receive a message
-        try:
-            message = client.recv(1024)
-            if message:
-                print(f"received message trying to broadcast: {message}")
-                broadcast(message, client)
-                return True
-            
-            else:
-                # Client exited cleanly
-                broadcast(f"{nicknames.get(client, 'Unknown')} left the chat.".encode('utf-8'))
+        elif session.nickname is None:
+            # Client left before sending its nickname
+            return False
+
+        else:
+            # Client exited cleanly
+            announce_leave(session)
+            return False
+
+    except protocol.FrameError as error:
+        log.warning("Invalid message from a client: %s", error)
+        metrics.forced_removals += 1
+        announce_leave(session)
+        return False
+
+    except BlockingIOError:
+        # Nothing to read after all
+        return True
+        
+    except socket.error as error:
+        # A reset connection does not come back, trying again would only stall the other clients
+        log.warning("Error receiving data from a client: %s", error)
+        metrics.forced_removals += 1
+        announce_leave(session)
+        return False
+
+# Tell the room of a client about to be removed that it left, if it had joined. The
+# client itself is skipped, its outbox goes away with it
+def announce_leave(session):
+    if session.nickname is not None:
+        broadcast(protocol.encode_leave(session.sender), session.sock, session.room)
+
+# Act on the messages received from a client, as far as its rate limits allow.
+# Returns False if the client should be removed
+def process(session):
+    reader = session.reader
+    limiter = session.limiter
+    now = clock()
+    dropped = 0
+    session.deficit += READ_QUANTUM
+
+    # A single read may hold several messages, or only part of one
+    frames = reader.frames()
+    for position, (kind, frame) in enumerate(frames):
+        if len(frame) > session.deficit:
+            # Out of quantum, this message and the ones after it wait for the next pass
+            reader.unread(sum(len(frame) for kind, frame in frames[position:]))
+            session.backlogged = True
+            backlog.append(session)
+            break
+        session.deficit -= len(frame)
+
+        if kind == protocol.COMPRESSED:
+            try:
+                messages = protocol.decompress(protocol.payload(frame))
+            except protocol.FrameError as error:
+                log.warning("Invalid message from a client: %s", error)
+                metrics.forced_removals += 1
+                announce_leave(session)
                 return False
-            
-        except socket.error as error:
-            print(f"Error receiving data from a client: {error}\n        Retrying: {attempt+1}...")
-            time.sleep(1)
-            
-    return False
+            size = sum(len(message) for kind, message in messages)
+        else:
+            messages = ((kind, frame),)
+            size = len(frame)
+
+        if limiter is not None and session.nickname is not None and not limiter.allow(size, now):
+            if FLOOD_POLICY == 'drop':
+                dropped += 1
+                metrics.messages_dropped += 1
+                continue
+
+            # Keep this message and the ones after it for when the client may send again
+            reader.unread(sum(len(frame) for kind, frame in frames[position:]))
+            session.deficit = 0
+            pause(session, limiter.delay(size))
+            # A single strike for the whole burst, not one for every pause it takes to catch up
+            if session.throttling:
+                return True
+            session.throttling = True
+            return not flooding(session, now)
+
+        for kind, message in messages:
+            act(session, kind, message)
+            if registry.get(session.sock) is not session:
+                # Removed for not reading what it was sent, nothing more is handled
+                return True
+    else:
+        # Nothing is waiting, so nothing is saved for later either
+        session.deficit = 0
+        session.throttling = False
+
+    if dropped:
+        if not refuse(session, f"You are sending too fast, {dropped} message{'s' if dropped > 1 else ''} dropped"):
+            return True
+        return not flooding(session, now)
+    return True
+
+# Act on a single message from a client
+def act(session, kind, frame):
+    session.messages_in += 1
+    metrics.messages_in += 1
+    if session.nickname is None:
+        # Nothing but the nickname is accepted during the handshake
+        if kind == protocol.NICK:
+            payload = protocol.payload(frame)
+            session.compress = bool(COMPRESS_THRESHOLD and protocol.decode_features(payload) & protocol.COMPRESSION)
+            try:
+                nickname, color = protocol.decode_nick(payload)
+            except UnicodeDecodeError:
+                # Refused like any other invalid nickname
+                nickname, color = '', protocol.DEFAULT_COLOR
+            introduce(session, nickname, color)
+
+    elif kind == protocol.TEXT:
+        text = protocol.payload(frame)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Received %s from %s", Payload(text), session.nickname)
+        if len(text) + len(session.sender) > protocol.MAX_MESSAGE_SIZE:
+            # The sender would not fit, and neither would the message in the readers of the clients
+            refuse(session, "Message too long")
+        else:
+            # The sender comes from the session, whatever the client wrote in the text
+            broadcast(protocol.encode_chat(session.sender, text), session.sock, session.room)
+
+    elif kind == protocol.MSG:
+        direct(session, protocol.payload(frame))
+
+    elif kind == protocol.ROOM_JOIN:
+        try:
+            room = bytes(protocol.payload(frame)).decode('utf-8').strip()
+        except UnicodeDecodeError:
+            # Only this client's request is refused, the others never see the name
+            refuse(session, "Room names must be valid UTF-8")
+        else:
+            change_room(session, room)
+
+    elif kind == protocol.ROOM_LEAVE:
+        change_room(session, DEFAULT_ROOM)
+
+    elif kind == protocol.ROOM_LIST:
+        list_rooms(session)
+
+    elif kind == protocol.PING:
+        deliver(session, PONG)
+    # A pong only shows the client is alive, which receiving it already did
+
+# Count a client going over its rate limits, and tell its room if it did it too
+# often. Returns True if the client should be removed
+def flooding(session, now):
+    if not session.limiter.strike(now):
+        return False
+    log.warning("Disconnecting %s for flooding", session.nickname)
+    metrics.flood_removals += 1
+    metrics.forced_removals += 1
+    broadcast(protocol.encode_leave(session.sender, reason=protocol.FLOODED), session.sock, session.room)
+    return True
+
+# Watch a client's socket for reading unless its reads are paused, and for writing
+# while its socket buffer is full. Called after either changes, `registered` tells
+# whether the socket was watched for anything before
+def watch(session, registered):
+    events = (0 if session.paused else selectors.EVENT_READ) | (selectors.EVENT_WRITE if session.writing else 0)
+    if not registered:
+        selector.register(session.sock, events, session)
+    elif events:
+        selector.modify(session.sock, events, session)
+    else:
+        selector.unregister(session.sock)
+    metrics.poll_changes += 1
+
+# Stop reading from a client for `delay` seconds. What it sends meanwhile waits
+# in the kernel, until its socket buffer fills and TCP slows the client down
+def pause(session, delay):
+    metrics.throttles += 1
+    registered = not session.paused or session.writing
+    session.paused = True
+    watch(session, registered)
+    heapq.heappush(throttled, (clock() + delay, next(throttle_order), session))
+
+# Read again from the clients whose rate limits allow it. The messages they sent
+# before being paused are handled first, with the backlog. Returns the seconds
+# until the next one (None if none)
+def resume_throttled():
+    now = clock()
+    while throttled:
+        resume_at, order, session = throttled[0]
+        if resume_at > now:
+            return resume_at - now
+        heapq.heappop(throttled)
+
+        # The client may have left meanwhile
+        if registry.get(session.sock) is session and session.paused:
+            session.paused = False
+            watch(session, session.writing)
+            session.backlogged = True
+            backlog.append(session)
+    return None
 
 # Accept new connections
 def accept(server):
-    client, address = server.accept()
-    print(f"Address {str(address)} connected")
+    # Accept the connections waiting, up to ACCEPT_BATCH, without waiting for any of them to answer
+    for _ in range(ACCEPT_BATCH):
+        try:
+            client, address = server.accept()
+        except BlockingIOError:
+            return
+        log.info("Address %s connected", address)
+        metrics.accepted += 1
+
+        # From now on the client is only read when the selector says it is ready
+        client.setblocking(False)
+        if TCP_NODELAY:
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        session = Session(client, protocol.FrameReader(), Outbox())
+        registry.add(session)
+
+        # Request the client's nickname, the answer is read by handle()
+        session.last_seen = clock()
+        timers.schedule(session, session.last_seen + HANDSHAKE_TIMEOUT)
+        session.outbox.put(prompt())
+        pending.append(session)
+        selector.register(client, selectors.EVENT_READ, session)
+
+# Check the nickname a client sent, and let it join if it is valid. Otherwise it
+# is told why and asked again, while its handshake timer keeps running
+def introduce(session, nickname, color):
+    if not protocol.valid_nickname(nickname):
+        if refuse(session, f"Nicknames are 1 to {protocol.MAX_NICKNAME} bytes long"):
+            deliver(session, prompt())
+        return
+    if registry.find(nickname) is not None:
+        if refuse(session, f"The nickname {nickname} is already taken"):
+            deliver(session, prompt())
+        return
+    join(session, nickname, color)
+
+# The nickname request, which tells the client whether it may send compressed messages
+def prompt():
+    return protocol.encode_prompt(protocol.COMPRESSION if COMPRESS_THRESHOLD else 0)
+
+# Finish the handshake of a client that sent its nickname
+def join(session, nickname, color=protocol.DEFAULT_COLOR):
+    registry.join(session, nickname, color=color)
+    metrics.handshakes += 1
+    now = session.last_seen = clock()
+    session.limiter = create_limiter(now)
+    # The handshake timer becomes the idle timer
+    check_idle(session, now)
+    replay(session)
 
-    # Request the client's nickname
-    client.send('NICK'.encode('utf-8'))
-    nickname = client.recv(1024).decode('utf-8')
-    nicknames[client] = nickname
-    clients.append(client)
+    # Then the direct messages sent while it was away
+    for message in offline.take(nickname, now):
+        metrics.offline_delivered += 1
+        deliver(session, message)
+    if registry.get(session.sock) is not session:
+        # Removed, its buffer could not take them all
+        return
 
     # Announce the new connection
-    print(f"The client's nickname is '{nickname}'.")
-    broadcast(f"{nickname} joined the chat".encode('utf-8'), client)
+    log.info("The client's nickname is '%s'", nickname)
+    broadcast(protocol.encode_join(session.sender), session.sock, session.room)
 
-if __name__ == "__main__":
-    print("""
-        #######################################################################
-        #                        SERVER ONLINE                                #
-        #######################################################################
-        """)
+# Rate limits of a client that just joined (None if there are no limits)
+def create_limiter(now):
+    if MESSAGE_RATE or BYTE_RATE:
+        return RateLimiter(MESSAGE_RATE, MESSAGE_BURST, BYTE_RATE, BYTE_BURST, FLOOD_STRIKES, FLOOD_WINDOW, now)
+    return None
+
+# Send a notice to one client only. Returns False if the client was removed
+def reply(session, text):
+    return deliver(session, protocol.encode_text(text))
+
+# Tell one client what it asked for was refused. Returns False if the client was removed
+def refuse(session, text):
+    return deliver(session, protocol.encode_error(text))
+
+# Send a direct message to the client using a nickname, found through the nickname
+# index instead of going through the fan-out list. If nobody uses the nickname,
+# the message waits for it to join
+def direct(session, payload):
+    try:
+        nickname, text = protocol.decode_msg(payload)
+    except UnicodeDecodeError:
+        # Refused like a message without a nickname
+        nickname, text = '', b''
+    if not protocol.valid_nickname(nickname) or not text:
+        refuse(session, "Direct messages need a nickname and a text: /msg <nickname> <text>")
+        return
+    if nickname == session.nickname:
+        refuse(session, "You can't send a direct message to yourself")
+        return
+    if len(text) + len(session.sender) > protocol.MAX_MESSAGE_SIZE:
+        refuse(session, "Message too long")
+        return
+
+    metrics.direct_messages += 1
+    log.debug("Direct message from %s to %s", session.nickname, nickname)
+    message = protocol.encode_direct(session.sender, text)
+    recipient = registry.find(nickname)
+    if recipient is None:
+        if offline.put(nickname, message, clock()):
+            metrics.offline_queued += 1
+            reply(session, f"{nickname} is not connected, the message will be delivered when they join")
+        else:
+            refuse(session, f"{nickname} is not connected")
+        return
+
+    if COMPRESS_THRESHOLD and len(message) >= COMPRESS_THRESHOLD and recipient.compress:
+        compressed = protocol.compress(message)
+        metrics.compressed += 1
+        metrics.compression_saved += len(message) - len(compressed)
+        message = compressed
+    deliver(recipient, message)
+
+# Move a client to another room, telling the members of both rooms
+def change_room(session, room):
+    if not room or len(room.encode('utf-8')) > MAX_ROOM_NAME:
+        refuse(session, f"Room names are 1 to {MAX_ROOM_NAME} bytes long")
+        return
+    if room == session.room:
+        refuse(session, f"You are already in {room}")
+        return
+
+    previous = registry.move(session, room)
+    log.info("%s moved from %s to %s", session.nickname, previous, room)
+    reply(session, f"You are now in {room}")
+    replay(session)
+    broadcast(protocol.encode_leave(session.sender, previous), session.sock, previous)
+    if registry.get(session.sock) is session:
+        # Unless it was removed for a full buffer, its new room was told it left already
+        broadcast(protocol.encode_join(session.sender, room), session.sock, room)
+
+# Queue the recent messages of its room for a client that just entered it. Only the
+# newest that fit under the low watermark are sent, so a replay never overflows the buffer
+def replay(session):
+    budget = LOW_WATERMARK - session.outbox.size
+    messages = []
+    for message in reversed(history.recent(session.room)):
+        budget -= len(message)
+        if budget < 0:
+            break
+        messages.append(message)
+    messages.reverse()
+
+    # The whole replay is compressed together, the messages of a room have a lot in common
+    if session.compress and messages:
+        replayed = b''.join(messages)
+        if COMPRESS_THRESHOLD <= len(replayed) <= protocol.MAX_DECOMPRESSED_SIZE:
+            compressed = protocol.compress(replayed)
+            metrics.compressed += 1
+            metrics.compression_saved += len(replayed) - len(compressed)
+            messages = [compressed]
+    for message in messages:
+        deliver(session, message)
+
+# Tell a client which rooms have members, and how many. The answer has to fit in
+# a frame, past it only the number of the other rooms is given
+def list_rooms(session):
+    rooms = sorted(registry.rooms.items())
+    budget = protocol.MAX_MESSAGE_SIZE - 64  # Room for the start and the end of the answer
+    listed = []
+    for room, members in rooms:
+        entry = f"{room} ({len(members)})"
+        budget -= len(entry.encode('utf-8')) + 2
+        if budget < 0:
+            break
+        listed.append(entry)
+    text = ', '.join(listed)
+    if len(listed) < len(rooms):
+        text += f", and {len(rooms) - len(listed)} more"
+    reply(session, f"Rooms: {text}")
+
+# Act on the timers that are due: drop the connections that did not send their
+# nickname in time, and check the others for going quiet. Returns the seconds
+# until the next tick of the timer wheel (None if there are no timers)
+def expire_timers():
+    now = clock()
+    for session in timers.expire(now):
+        # Timers of removed clients are cancelled, but a client may leave while
+        # the expired ones are handled
+        if registry.get(session.sock) is not session:
+            continue
+        if session.nickname is None:
+            log.info("A client did not send its nickname in time")
+            metrics.handshake_timeouts += 1
+            metrics.forced_removals += 1
+            remove(session.sock)
+        else:
+            check_idle(session, now)
+    return timers.next_tick(now)
+
+# Ping a client that sent nothing for PING_INTERVAL seconds, drop it after
+# IDLE_TIMEOUT seconds, and set its timer for the next check
+def check_idle(session, now):
+    idle = now - session.last_seen
+    if IDLE_TIMEOUT and idle >= IDLE_TIMEOUT:
+        log.info("%s sent nothing for %d seconds", session.nickname, idle)
+        metrics.idle_timeouts += 1
+        disconnect(session)
+        return
+
+    if PING_INTERVAL and idle >= PING_INTERVAL:
+        metrics.pings += 1
+        if not deliver(session, PING):
+            return
+        due = now + PING_INTERVAL
+    elif PING_INTERVAL or IDLE_TIMEOUT:
+        # Whatever it sent since the last check moves the next one
+        due = session.last_seen + (PING_INTERVAL or IDLE_TIMEOUT)
+    else:
+        return
+    if IDLE_TIMEOUT:
+        due = min(due, session.last_seen + IDLE_TIMEOUT)
+    timers.schedule(session, due)
+
+# Deliver the messages forwarded by another worker
+def handle_peer(link):
+    peer = peers[link]
+    try:
+        metrics.recv_calls += 1
+        if not peer.reader.recv(link):
+            # The other worker stopped
+            return False
+        for kind, frame in peer.reader.frames():
+            if kind == protocol.ROUTED:
+                room, message = protocol.decode_routed(protocol.payload(frame))
+                fan_out(bytes(message), room=room.decode('utf-8') or None)
+        return True
+
+    except BlockingIOError:
+        return True
+
+    except (protocol.FrameError, socket.error) as error:
+        log.warning("Error receiving from another worker: %s", error)
+        return False
+
+# Stop exchanging messages with a worker
+def remove_peer(link):
+    if peers.pop(link, None) is not None:
+        selector.unregister(link)
+    link.close()
+
+# Serve clients until the server is stopped
+def run():
+    while running and run_once():
+        pass
 
-    print(f"-> Server listening on {HOST}:{PORT}")
+# A single pass of the event loop. Returns False once the clients were handed
+# over to a new process
+def run_once():
+    # Wait for sockets ready to read or write, the cost does not depend on how many are idle,
+    # or until the next timer is due. Clients with a backlog are not kept waiting
+    due = (expire_timers(), resume_throttled(), history.tick(), write_stats_when_due())
+    timeout = min((timer for timer in due if timer is not None), default=None)
+    # Pings and leave messages of the timers go out before waiting
+    flush_pending()
+    ready = selector.select(0 if backlog else timeout)
+    woke = time.perf_counter_ns()
+    metrics.wakeups += 1
+    readable = []
+    for key, events in ready:
+        sock = key.fileobj
 
+        if sock == server:
+            accept(server)
+            continue
 
+        if sock is wakeup:
+            # stop() was called, `running` tells the loop
+            sock.recv(64)
+            continue
+
+        if sock is stats_listener:
+            serve_stats(sock)
+            continue
+
+        if sock is handoff_listener:
+            if hand_over(sock):
+                # The clients are served by the new process now
+                return False
+            continue
+
+        if sock in peers:
+            if events & selectors.EVENT_READ and not handle_peer(sock):
+                remove_peer(sock)
+            elif events & selectors.EVENT_WRITE and not flush(sock):
+                remove_peer(sock)
+            continue
+
+        # The client may have been removed earlier in this iteration
+        session = key.data
+        if events & selectors.EVENT_WRITE and sock in registry:
+            if not flush(sock):
+                disconnect(session)
+
+        # Clients with a backlog finish it before being read from again
+        if events & selectors.EVENT_READ and sock in registry and not session.backlogged:
+            readable.append(session)
+
+    serve(readable, woke)
+    flush_pending()
+    return True
+
+# Handle the backlog and the clients ready to read, each up to its quantum. Every
+# pass starts one client further, so no client is always handled first
+def serve(readable, woke):
+    global turn
+    sessions = backlog + readable
+    backlog.clear()
+    if not sessions:
+        return
+    start = turn % len(sessions)
+    turn += 1
+
+    for session in sessions[start:] + sessions[:start]:
+        # The client may have been removed earlier in this pass
+        sock = session.sock
+        if registry.get(sock) is not session:
+            continue
+
+        # Time spent waiting behind the clients handled before this one, and handling it
+        started = metrics.handle_started = time.perf_counter_ns()
+        metrics.wakeup_to_handle.record(started - woke)
+        if session.backlogged:
+            # Its messages are already received
+            session.backlogged = False
+            handled = process(session)
+        else:
+            handled = handle(sock)
+        metrics.handle.record(time.perf_counter_ns() - started)
+        # Messages queued from now on, by timers or flushes, were not caused by a handle()
+        metrics.handle_started = None
+        if not handled:
+            remove(sock)
+
+# Send what the sessions got during this pass of the event loop, each with one
+# vectored write. Only the sockets whose buffer fills up are watched for writing
+def flush_pending():
+    index = 0
+    # Removing a client may queue a leave message for others, appended to the list
+    while index < len(pending):
+        session = pending[index]
+        index += 1
+        sock = session.sock
+        if sock in peers:
+            if not flush(sock):
+                remove_peer(sock)
+        elif registry.get(sock) is session:
+            if not flush(sock):
+                disconnect(session)
+    pending.clear()
+
+# Current metrics of this process, with the size of its registry
+def stats():
+    return metrics.snapshot(connections=len(registry), joined=len(registry.fanout),
+                            pending_handshakes=len(registry) - len(registry.fanout),
+                            rooms=len(registry.rooms), workers=len(peers) + 1,
+                            offline_messages=len(offline),
+                            log_records_dropped=logger.dropped())
+
+# Listen on a Unix socket, for stats requests or a new process taking the clients over
+def create_unix_listener(path):
+    if os.path.exists(path):
+        # Left by a server that did not stop cleanly
+        os.unlink(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen()
+    listener.setblocking(False)
+    return listener
+
+# Answer every waiting stats request with a snapshot, then hang up
+def serve_stats(listener):
     while True:
-        
-        # Use select to monitor sockets
-        read_sockets, write_sockets, exception_sockets = select.select(clients, [], clients)  # read, write, exceptions (error)
+        try:
+            connection, address = listener.accept()
+        except BlockingIOError:
+            return
+        # A snapshot is a few KiB, it fits in the socket buffer right away
+        connection.setblocking(False)
+        try:
+            connection.sendall(json.dumps(stats()).encode('utf-8'))
+        except OSError as error:
+            log.warning("Error sending the stats: %s", error)
+        connection.close()
+
+# Rewrite the stats file when it is due, returns the seconds until the next
+# write (None if there is no stats file)
+def write_stats_when_due():
+    global stats_due
+    if STATS_FILE is None:
+        return None
+    now = clock()
+    if stats_due is None or now >= stats_due:
+        # Readers never see a half written file
+        temporary = f"{STATS_FILE}.tmp"
+        with open(temporary, 'w') as file:
+            json.dump(stats(), file)
+        os.replace(temporary, STATS_FILE)
+        stats_due = now + STATS_INTERVAL
+    return stats_due - now
+
+# Publish the metrics where the options say, each worker under its own name
+def start_stats(suffix=''):
+    global stats_listener, STATS_FILE
+    if STATS_SOCKET:
+        stats_listener = create_unix_listener(STATS_SOCKET + suffix)
+        selector.register(stats_listener, selectors.EVENT_READ)
+    if STATS_FILE:
+        STATS_FILE += suffix
+
+# Hand the listening socket and every client over to the new process that
+# connected to the handoff socket, with what it needs to go on serving them.
+# Returns True once it confirmed it has them, this process then stops without
+# closing the connections. If the handoff fails, this process keeps serving the clients
+def hand_over(listener):
+    global registry, handoff_listener
+    try:
+        link, address = listener.accept()
+    except BlockingIOError:
+        return False
+
+    now = clock()
+    sessions = list(registry.sessions.values())
+    try:
+        # Nothing else is done until the new process has everything, so nothing changes meanwhile
+        link.settimeout(HANDOFF_TIMEOUT)
+        handoff.send_sockets(link, [server] + [session.sock for session in sessions])
+        for session in sessions:
+            link.sendall(b''.join(handed_over(session, now)))
+        if history.log is None:
+            # Otherwise the new process reloads them from the log
+            link.sendall(b''.join(handoff.encode_history(room, message)
+                                  for room, recent in history.rooms.items() for message in recent))
+        else:
+            history.log.sync()
+        link.sendall(b''.join(handoff.encode_offline(nickname, expiry - now, message)
+                              for nickname, queue in offline.queues.items()
+                              for expiry, message in queue if expiry > now))
+        link.sendall(protocol.encode(handoff.END))
+        # Nothing is let go of until the new process has restored every client
+        handoff.receive_ack(link)
+    except (OSError, handoff.HandoffError) as error:
+        log.warning("Could not hand the clients over to the new process: %s", error)
+        return False
+    finally:
+        link.close()
+
+    # The new process listens on the same path, replacing the file of this listener
+    selector.unregister(listener)
+    listener.close()
+    handoff_listener = None
+    log.info("Handed %d clients over to the new process", len(sessions))
+    # Closing this process' copy of the sockets leaves the connections open in the new one
+    for session in sessions:
+        if not session.paused or session.writing:
+            selector.unregister(session.sock)
+        session.sock.close()
+    registry = Registry()
+    return True
 
-        # For each socket ready to read
-        for sock in read_sockets:
+# Frames describing a client to the process taking it over: its session, the
+# data it sent that was not handled yet, and the messages waiting for it
+def handed_over(session, now):
+    color = protocol.decode_sender(session.sender)[1] if session.sender is not None else protocol.DEFAULT_COLOR
+    frames = [handoff.encode_session({'nickname': session.nickname, 'color': color, 'room': session.room,
+                                      'compress': session.compress, 'idle': now - session.last_seen})]
+    unparsed = session.reader.unparsed()
+    if unparsed:
+        frames.append(protocol.encode(handoff.INPUT, unparsed))
+    outbox = session.outbox
+    for position, message in enumerate(outbox.messages):
+        # Part of the first one may already be sent
+        frames.append(protocol.encode(handoff.OUTPUT, memoryview(message)[outbox.offset if position == 0 else 0:]))
+    return frames
+
+# Take the listening socket and the clients over from the server listening on
+# the handoff socket at `path`. Returns the listening socket, and the recent
+# messages of the rooms as (room, message) pairs for the history
+def take_over(path):
+    link = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    link.settimeout(HANDOFF_TIMEOUT)
+    with link:
+        link.connect(path)
+        sockets = handoff.receive_sockets(link)
+        try:
+            recent = restore_all(link, sockets)
+            listener = sockets[0]
+            listener.setblocking(False)
+            # The previous process lets go of the clients once told they are all here
+            link.sendall(protocol.encode(handoff.ACK))
+        except BaseException:
+            # Never confirmed, the previous process keeps serving the clients
+            for sock in sockets:
+                sock.close()
+            raise
+
+    log.info("Took %d clients over from the previous process", len(registry))
+    return listener, recent
+
+# Restore the clients whose sockets were received, from the frames that follow
+# them. Returns the recent messages of the rooms as (room, message) pairs
+def restore_all(link, sockets):
+    clients = iter(sockets[1:])
+    now = clock()
+    recent = []
+    session = None
+    for kind, payload in handoff.receive(link):
+        if kind == handoff.SESSION:
+            session = restore(next(clients), handoff.decode_session(payload), now)
+        elif kind == handoff.INPUT:
+            # Handled in the first pass of the event loop, before reading more
+            session.reader.load(payload)
+            session.backlogged = True
+            backlog.append(session)
+        elif kind == handoff.OUTPUT:
+            # Sent at the end of the first pass, like any message queued during it
+            if not session.outbox:
+                pending.append(session)
+            session.outbox.messages.append(payload)
+            session.outbox.size += len(payload)
+        elif kind == handoff.HISTORY:
+            recent.append(handoff.decode_history(payload))
+        elif kind == handoff.OFFLINE:
+            nickname, expires_in, message = handoff.decode_offline(payload)
+            # Kept as if it was sent now, with the time it had left
+            offline.put(nickname, message, now + expires_in - offline.ttl)
+
+    return recent
+
+# Rebuild the session of a client taken over from the previous process
+def restore(sock, state, now):
+    sock.setblocking(False)
+    session = Session(sock, protocol.FrameReader(), Outbox())
+    registry.add(session)
+    session.last_seen = now - state['idle']
+    session.compress = state['compress']
+    if state['nickname'] is None:
+        # Still in its handshake, which goes on from where it was
+        timers.schedule(session, session.last_seen + HANDSHAKE_TIMEOUT)
+    else:
+        registry.join(session, state['nickname'], state['room'], state['color'])
+        session.limiter = create_limiter(now)
+        # Checked for going quiet at the next tick
+        timers.schedule(session, now)
+    selector.register(sock, selectors.EVENT_READ, session)
+    return session
+
+# Body of a worker process: its own listener, selector and clients, plus links to the other workers
+def worker(index, address, links, all_links):
+    global server, selector, history
+
+    # The log writer thread of the parent did not survive the fork
+    logger.setup()
+    # Stopped by the parent with SIGTERM
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    # Listen on the shared address, and watch only this process' sockets
+    server = create_listener(*address, reuse_port=True)
+    selector = selectors.DefaultSelector()
+    selector.register(server, selectors.EVENT_READ)
+
+    for link in all_links:
+        if link not in links:
+            link.close()
+    for link in links:
+        link.setblocking(False)
+        peer = Session(link, protocol.FrameReader(), Outbox(bounded=False))
+        peers[link] = peer
+        selector.register(link, selectors.EVENT_READ, peer)
+
+    # Every worker logs the messages its clients see in its own directory
+    history = create_history(os.path.join(HISTORY_DIR, f"worker-{index}") if HISTORY_DIR else None)
+    start_stats(f".{index}")
+    try:
+        run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        history.close()
+        logger.shutdown()
+
+# History of the rooms, logged to the directory if one is given
+def create_history(directory):
+    return History(HISTORY_SIZE, MessageLog(directory) if directory else None)
+
+# Start `count` worker processes sharing the address, each linked to all the others
+def start_workers(count):
+    # The workers listen themselves, this process only supervises them
+    address = server.getsockname()
+    selector.unregister(server)
+    server.close()
+
+    links = [[] for _ in range(count)]
+    for first in range(count):
+        for second in range(first + 1, count):
+            one, other = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+            links[first].append(one)
+            links[second].append(other)
+    all_links = [link for worker_links in links for link in worker_links]
+
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=worker, args=(index, address, links[index], all_links), daemon=True)
+                 for index in range(count)]
+    for process in processes:
+        process.start()
+    for link in all_links:
+        link.close()
+    return processes
+
+# Start over from a clean registry, timers, metrics and queues, before serving
+def reset():
+    global registry, timers, metrics, offline, stats_due, turn
+    registry = Registry()
+    timers = TimerWheel(clock())
+    metrics = Metrics()
+    offline = OfflineQueues(OFFLINE_QUEUE_SIZE, OFFLINE_TTL, OFFLINE_BYTES)
+    for waiting in (departures, backlog, throttled, pending, peers):
+        waiting.clear()
+    stats_due = None
+    turn = 0
+
+# A chat server that can be started from a script, a test or a benchmark. Nothing
+# is bound until start(), and with port 0 the port the system picked is in `port`.
+# The clients and their buffers are the state of this module, so a process runs
+# one ChatServer at a time; run_in_process() gives each server its own process
+class ChatServer:
+    def __init__(self, host=HOST, port=PORT, engine='select', workers=1, handoff=None, take_over=False):
+        if workers > 1 and engine != 'select':
+            raise ValueError("Several workers need the select engine")
+        if handoff is not None and (workers > 1 or engine != 'select'):
+            raise ValueError("Handing the clients over needs the select engine and a single worker")
+        if take_over and handoff is None:
+            raise ValueError("Taking the clients over needs the path of the handoff socket")
+        self.host = host
+        self.port = port
+        self.engine = engine
+        self.workers = workers
+        self.handoff = handoff  # Path of the Unix socket a new process takes the clients over through
+        self.take_over = take_over  # Start with the clients of the server listening there
+        self.recent = []  # Recent messages of the rooms, as taken over
+        self.listener = None
+        self.waker = None  # Written to by stop(), wakes the event loop up
+        self.serving = False
+        self.thread = None  # Set by run_in_thread()
+        self.process = None  # Set by run_in_process()
+        self.processes = []  # Worker processes
+        self.loop = None  # Event loop and task of the asyncio engine
+        self.task = None
+
+    @property
+    def address(self):
+        return (self.host, self.port)
+
+    # Bind the listener and start from a clean registry, timers and metrics, or
+    # from the listener and clients of the previous server with take_over.
+    # Returns the server, so ChatServer(port=0).start().port gives the port
+    def start(self):
+        global server, selector, running, wakeup
+        if running:
+            raise RuntimeError("A server is already running in this process")
+
+        reset()
+        selector = selectors.DefaultSelector()
+        if self.take_over:
+            server, self.recent = take_over(self.handoff)
+            self.host = server.getsockname()[0]
+        else:
+            server = create_listener(self.host, self.port)
+        self.listener = server
+        self.port = server.getsockname()[1]
+        selector.register(server, selectors.EVENT_READ)
+        wakeup, self.waker = socket.socketpair()
+        wakeup.setblocking(False)
+        selector.register(wakeup, selectors.EVENT_READ)
+        running = True
+        return self
+
+    # Serve clients until stop() is called, starting the server first if needed
+    def serve_forever(self):
+        global history, handoff_listener
+        if self.listener is None:
+            self.start()
+        self.serving = True
+        try:
+            if self.engine == 'asyncio':
+                self.loop = asyncio.new_event_loop()
+                self.task = self.loop.create_task(async_server.serve(server, offline))
+                try:
+                    self.loop.run_until_complete(self.task)
+                except asyncio.CancelledError:
+                    pass
+                finally:
+                    # Like asyncio.run(), let the connections left finish before closing the loop
+                    connections = asyncio.all_tasks(self.loop)
+                    for connection in connections:
+                        connection.cancel()
+                    if connections:
+                        self.loop.run_until_complete(asyncio.gather(*connections, return_exceptions=True))
+                    self.loop.close()
+
+            elif self.workers > 1:
+                self.processes = start_workers(self.workers)
+                for process in self.processes:
+                    process.join()
 
-            if sock == server:
-                accept(server)
-            
             else:
-                # Try to receive/transmit
-                if not handle(sock):
-                    remove(sock)
-        
-        # For each socket with errors
-        for sock in exception_sockets:
+                history = create_history(HISTORY_DIR)
+                for room, message in self.recent:
+                    history.record(room, message)
+                self.recent = []
+                start_stats()
+                if self.handoff is not None:
+                    # Bound here rather than in start(): after run_in_process(), the parent closing
+                    # its copy would also unregister it from the epoll instance it shares with the child
+                    handoff_listener = create_unix_listener(self.handoff)
+                    selector.register(handoff_listener, selectors.EVENT_READ)
+                try:
+                    run()
+                finally:
+                    history.close()
+        finally:
+            self.serving = False
+            self.close()
+
+    # Serve in a background thread of this process, returns once the server is
+    # bound and accepting connections
+    def run_in_thread(self):
+        if self.listener is None:
+            self.start()
+        self.thread = threading.Thread(target=self.serve_forever, name='chat-server', daemon=True)
+        self.thread.start()
+        return self.thread
+
+    # Serve in a child process, with its own copy of this module's state. Returns
+    # the process once the server is bound and accepting connections
+    def run_in_process(self):
+        self.start()
+        context = multiprocessing.get_context('fork')
+        self.process = context.Process(target=self.serve_child, name='chat-server', daemon=True)
+        self.process.start()
+        # The child serves the clients, this process lets go of its copy of the sockets
+        self.close()
+        return self.process
+
+    # Body of the process started by run_in_process()
+    def serve_child(self):
+        # The log writer thread of the parent did not survive the fork
+        if logger.writer is not None:
+            logger.setup()
+        # The copy of the process handle belongs to the parent, here stop() serves
+        self.process = None
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        try:
+            self.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            logger.shutdown()
+
+    # Stop serving, from any thread. The clients are disconnected by the thread
+    # serving them, which run_in_thread() servers wait for
+    def stop(self):
+        global running
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+            return
+        if self.listener is None:
+            return
+
+        # The loop may finish and close them as soon as `running` is cleared
+        waker, loop, task = self.waker, self.loop, self.task
+        running = False
+        if not self.serving:
+            # Started, but nothing is serving
+            self.close()
+            return
+        if task is not None:
+            loop.call_soon_threadsafe(task.cancel)
+        for process in self.processes:
+            process.terminate()
+        try:
+            waker.send(b'\0')
+        except OSError:
+            pass  # The loop is already done
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    # Close the listener and every connection, once nothing serves them anymore
+    def close(self):
+        global server, running, wakeup, stats_listener, handoff_listener
+        running = False
+        for sock in list(registry.sessions):
             remove(sock)
+        for link in list(peers):
+            remove_peer(link)
+        for listener in (stats_listener, handoff_listener):
+            if listener is not None:
+                selector.unregister(listener)
+                listener.close()
+        stats_listener = handoff_listener = None
+        selector.close()
+        for sock in (server, wakeup, self.waker):
+            if sock is not None:
+                sock.close()
+        server = wakeup = self.listener = self.waker = None
+        self.loop = self.task = None
+        self.processes = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+if __name__ == "__main__":
+    # Choose the engine that runs the server
+    parser = argparse.ArgumentParser(description="Chat server")
+    parser.add_argument('--port', type=int, default=PORT,
+                        help=f"port to listen on, 0 for any free port (default: {PORT})")
+    parser.add_argument('--engine', choices=['select', 'asyncio'], default='select',
+                        help="selectors event loop (default) or one asyncio coroutine per connection")
+    parser.add_argument('--overflow-policy', choices=OVERFLOW_POLICIES, default=OVERFLOW_POLICY,
+                        help="what to do when a client's outbound buffer is full")
+    parser.add_argument('--high-watermark', type=int, default=HIGH_WATERMARK,
+                        help="bytes queued for a client before the overflow policy applies")
+    parser.add_argument('--low-watermark', type=int, default=LOW_WATERMARK,
+                        help="bytes left queued after dropping the oldest messages")
+    parser.add_argument('--max-message-size', type=int, default=protocol.MAX_MESSAGE_SIZE,
+                        help="largest message accepted from a client (bytes)")
+    parser.add_argument('--handshake-timeout', type=float, default=HANDSHAKE_TIMEOUT,
+                        help="seconds a new connection has to send its nickname")
+    parser.add_argument('--ping-interval', type=float, default=PING_INTERVAL,
+                        help=f"seconds a client may be quiet before it is pinged, 0 for never (default: {PING_INTERVAL})")
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help=f"seconds a client may be quiet before it is dropped, 0 for never (default: {IDLE_TIMEOUT})")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="processes sharing the port, each serving part of the clients (select engine only)")
+    parser.add_argument('--nagle', action='store_true',
+                        help="leave Nagle's algorithm on (TCP_NODELAY off) for the client connections")
+    parser.add_argument('--read-quantum', type=int, default=READ_QUANTUM,
+                        help=f"bytes of messages handled per client and pass of the event loop (default: {READ_QUANTUM})")
+    parser.add_argument('--accept-batch', type=int, default=ACCEPT_BATCH,
+                        help=f"connections accepted per pass of the event loop (default: {ACCEPT_BATCH})")
+    parser.add_argument('--message-rate', type=float, default=MESSAGE_RATE,
+                        help=f"messages per second a client may send, 0 for no limit (default: {MESSAGE_RATE})")
+    parser.add_argument('--message-burst', type=int, default=MESSAGE_BURST,
+                        help=f"messages a client may send at once above the rate (default: {MESSAGE_BURST})")
+    parser.add_argument('--byte-rate', type=float, default=BYTE_RATE,
+                        help=f"bytes per second a client may send, 0 for no limit (default: {BYTE_RATE})")
+    parser.add_argument('--byte-burst', type=int, default=BYTE_BURST,
+                        help=f"bytes a client may send at once above the rate (default: {BYTE_BURST})")
+    parser.add_argument('--flood-policy', choices=FLOOD_POLICIES, default=FLOOD_POLICY,
+                        help="stop reading from a client over its limits, or drop its messages (default: throttle)")
+    parser.add_argument('--flood-strikes', type=int, default=FLOOD_STRIKES,
+                        help=f"times a client may go over its limits per --flood-window before it is disconnected (default: {FLOOD_STRIKES})")
+    parser.add_argument('--flood-window', type=float, default=FLOOD_WINDOW,
+                        help=f"seconds over which the strikes of a client are counted (default: {FLOOD_WINDOW})")
+    parser.add_argument('--compress-threshold', type=int, default=COMPRESS_THRESHOLD,
+                        help=f"messages of at least this many bytes are compressed for the clients that support it, 0 to disable (default: {COMPRESS_THRESHOLD})")
+    parser.add_argument('--history', type=int, default=HISTORY_SIZE,
+                        help="messages kept per room and replayed to the clients entering it (0 to disable)")
+    parser.add_argument('--history-dir',
+                        help="directory where the messages are logged, to keep the history across restarts")
+    parser.add_argument('--offline-queue', type=int, default=OFFLINE_QUEUE_SIZE,
+                        help=f"direct messages kept per nickname that is not connected, 0 to keep none (default: {OFFLINE_QUEUE_SIZE})")
+    parser.add_argument('--offline-ttl', type=float, default=OFFLINE_TTL,
+                        help=f"seconds a direct message waits for its recipient (default: {OFFLINE_TTL})")
+    parser.add_argument('--offline-bytes', type=int, default=OFFLINE_BYTES,
+                        help=f"bytes of direct messages kept for all the nicknames together (default: {OFFLINE_BYTES})")
+    parser.add_argument('--handoff-socket',
+                        help="Unix socket where a new server started with --take-over takes the clients over (select engine, single worker)")
+    parser.add_argument('--take-over', action='store_true',
+                        help="start with the listening socket and clients of the server listening on --handoff-socket")
+    parser.add_argument('--stats-socket',
+                        help="Unix socket answering every connection with the metrics (select engine only)")
+    parser.add_argument('--stats-file',
+                        help="file rewritten with the metrics every --stats-interval seconds (select engine only)")
+    parser.add_argument('--stats-interval', type=float, default=STATS_INTERVAL,
+                        help=f"seconds between two writes of the stats file (default: {STATS_INTERVAL})")
+    parser.add_argument('--log-level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default=logger.LEVEL,
+                        help=f"DEBUG logs every message, which slows down busy servers (default: {logger.LEVEL})")
+    parser.add_argument('--log-format', choices=['text', 'json'], default=logger.FORMAT,
+                        help=f"plain lines or one JSON object per line (default: {logger.FORMAT})")
+    parser.add_argument('--log-payloads', choices=logger.PAYLOAD_MODES, default=logger.PAYLOAD_MODE,
+                        help=f"how message contents are logged at DEBUG (default: {logger.PAYLOAD_MODE})")
+    parser.add_argument('--log-payload-limit', type=int, default=logger.PAYLOAD_LIMIT,
+                        help=f"bytes of each message logged with --log-payloads truncate (default: {logger.PAYLOAD_LIMIT})")
+    parser.add_argument('--log-queue', type=int, default=logger.QUEUE_SIZE,
+                        help=f"log records waiting to be written before new ones are dropped (default: {logger.QUEUE_SIZE})")
+    args = parser.parse_args()
+    if args.workers > 1 and args.engine != 'select':
+        parser.error("--workers needs the select engine")
+    if args.handoff_socket and (args.workers > 1 or args.engine != 'select'):
+        parser.error("--handoff-socket needs the select engine and a single worker")
+    if args.take_over and not args.handoff_socket:
+        parser.error("--take-over needs --handoff-socket")
+    HANDSHAKE_TIMEOUT = args.handshake_timeout
+    PING_INTERVAL = args.ping_interval
+    IDLE_TIMEOUT = args.idle_timeout
+    protocol.MAX_MESSAGE_SIZE = args.max_message_size
+    OVERFLOW_POLICY = args.overflow_policy
+    HIGH_WATERMARK = args.high_watermark
+    LOW_WATERMARK = args.low_watermark
+    TCP_NODELAY = not args.nagle
+    READ_QUANTUM = args.read_quantum
+    ACCEPT_BATCH = args.accept_batch
+    MESSAGE_RATE = args.message_rate
+    MESSAGE_BURST = args.message_burst
+    BYTE_RATE = args.byte_rate
+    BYTE_BURST = args.byte_burst
+    FLOOD_POLICY = args.flood_policy
+    FLOOD_STRIKES = args.flood_strikes
+    FLOOD_WINDOW = args.flood_window
+    COMPRESS_THRESHOLD = args.compress_threshold
+    HISTORY_SIZE = args.history
+    HISTORY_DIR = args.history_dir
+    OFFLINE_QUEUE_SIZE = args.offline_queue
+    OFFLINE_TTL = args.offline_ttl
+    OFFLINE_BYTES = args.offline_bytes
+    STATS_SOCKET = args.stats_socket
+    STATS_FILE = args.stats_file
+    STATS_INTERVAL = args.stats_interval
+    logger.LEVEL = args.log_level
+    logger.FORMAT = args.log_format
+    logger.PAYLOAD_MODE = args.log_payloads
+    logger.PAYLOAD_LIMIT = args.log_payload_limit
+    logger.QUEUE_SIZE = args.log_queue
+
+    chat = ChatServer(HOST, args.port, args.engine, args.workers, args.handoff_socket, args.take_over).start()
+
+    print("""
+        #######################################################################
+        #                        SERVER ONLINE                                #
+        #######################################################################
+        """)
+
+    print(f"-> Server listening on {HOST}:{chat.port} ({args.engine} engine, {args.workers} worker{'s' if args.workers > 1 else ''})")
+
+    # The workers are forked before the log writer thread starts, and start their own
+    if args.workers == 1:
+        logger.setup()
+    # Stopping this process closes the connections, or stops the workers
+    signal.signal(signal.SIGTERM, lambda signum, frame: chat.stop())
+    try:
+        chat.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logger.shutdown()
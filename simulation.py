@@ -0,0 +1,334 @@
+import errno
+import selectors
+from collections import deque
+import client
+import protocol
+import server
+
+# Runs the select engine of server.py without a network or real time: the
+# listener, the connections and the selector are in memory, and the clock only
+# moves when the server would wait for its next timer. The same scenario gives
+# the same result every time, and thousands of clients take seconds
+
+# Bytes a simulated client's receive buffer holds. Past it, the server's writes
+# are partial and then blocked until the client reads, like a real socket buffer
+CAPACITY = 256 * 1024
+
+# Time as the server sees it during a simulation (seconds). It stands still
+# unless the simulation waits or advance() is called
+class VirtualClock:
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+# One end of a simulated connection, with the socket methods the server uses.
+# Ends the selector watches are kept in its ready list while there is something
+# to read, so select() never looks at idle connections
+class MemorySocket:
+    def __init__(self, capacity=CAPACITY, ready=None):
+        self.capacity = capacity  # Bytes the receive buffer holds (None for no limit)
+        self.ready = ready  # Ready list of the selector watching this end, if any
+        self.inbox = bytearray()  # Received, not read yet
+        self.peer = None  # The other end
+        self.closed = False
+        self.shut = False  # The other end was closed, reads return b'' once the inbox is empty
+        self.reset = False  # The other end was aborted, reads fail once the inbox is empty
+
+    # Two connected ends, the first one with a receive buffer of `capacity`
+    @staticmethod
+    def pair(capacity=CAPACITY, peer_capacity=None, peer_ready=None):
+        one, other = MemorySocket(capacity), MemorySocket(peer_capacity, peer_ready)
+        one.peer, other.peer = other, one
+        return one, other
+
+    def setblocking(self, flag):
+        pass
+
+    def setsockopt(self, *args):
+        pass
+
+    def _mark(self):
+        if self.ready is not None:
+            self.ready[self] = None
+
+    def _unmark(self):
+        if self.ready is not None:
+            self.ready.pop(self, None)
+
+    def readable(self):
+        return bool(self.inbox) or self.shut or self.reset
+
+    # The server may write while the other end has room, or once writing fails
+    def writable(self):
+        peer = self.peer
+        return peer.closed or peer.capacity is None or len(peer.inbox) < peer.capacity
+
+    def recv_into(self, buffer):
+        data = self.recv(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def recv(self, size):
+        if self.closed:
+            raise OSError(errno.EBADF, "Socket closed")
+        if self.inbox:
+            data = bytes(self.inbox[:size])
+            del self.inbox[:size]
+            if not self.readable():
+                self._unmark()
+            return data
+        if self.reset:
+            raise ConnectionResetError(errno.ECONNRESET, "Connection reset by peer")
+        if self.shut:
+            return b''
+        raise BlockingIOError(errno.EAGAIN, "Nothing to read")
+
+    # Write as much as the other end's receive buffer has room for
+    def sendmsg(self, buffers):
+        if self.closed:
+            raise OSError(errno.EBADF, "Socket closed")
+        peer = self.peer
+        if peer.closed or self.reset:
+            raise BrokenPipeError(errno.EPIPE, "Broken pipe")
+        room = None if peer.capacity is None else peer.capacity - len(peer.inbox)
+        if room is not None and room <= 0:
+            raise BlockingIOError(errno.EAGAIN, "Socket buffer full")
+
+        sent = 0
+        for buffer in buffers:
+            size = len(buffer)
+            if room is not None and sent + size >= room:
+                # Only the start of this buffer fits
+                peer.inbox += memoryview(buffer)[:room - sent]
+                sent = room
+                break
+            peer.inbox += buffer
+            sent += size
+        if sent:
+            peer._mark()
+        return sent
+
+    def send(self, data):
+        return self.sendmsg([data])
+
+    # Close the connection, the other end reads what was sent then b''
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.inbox.clear()
+        self._unmark()
+        if not self.peer.closed:
+            self.peer.shut = True
+            self.peer._mark()
+
+    # Close the connection with a reset, the other end's reads fail
+    def abort(self):
+        if not self.closed and not self.peer.closed:
+            self.peer.reset = True
+            self.peer._mark()
+        self.close()
+
+# A listening socket, connected to by connect()
+class MemoryListener:
+    def __init__(self, ready):
+        self.ready = ready  # Ready list of the selector, which the accepted ends go in too
+        self.backlog = deque()
+        self.accepted = 0
+
+    def connect(self, capacity=CAPACITY):
+        end, accepted = MemorySocket.pair(capacity, None, self.ready)
+        self.backlog.append(accepted)
+        self.ready[self] = None
+        return end
+
+    def accept(self):
+        if not self.backlog:
+            raise BlockingIOError(errno.EAGAIN, "No connection waiting")
+        sock = self.backlog.popleft()
+        if not self.backlog:
+            self.ready.pop(self, None)
+        self.accepted += 1
+        return sock, ('memory', self.accepted)
+
+    def readable(self):
+        return bool(self.backlog)
+
+    def getsockname(self):
+        return ('memory', 0)
+
+    def close(self):
+        pass
+
+# Selector over memory sockets. Sockets are reported in the order they became
+# ready, so runs are repeatable. With nothing ready, select() moves the clock
+# instead of waiting, up to `until` at most
+class MemorySelector:
+    def __init__(self, clock):
+        self.clock = clock
+        self.ready = {}  # Sockets with something to read, in the order they got it
+        self.keys = {}  # Socket -> its key
+        self.writers = {}  # Keys of the sockets watched for writing
+        self.until = None  # Furthest the clock is moved by a select() (None to never move it)
+        self.idle = False  # Whether the last select() found nothing ready
+
+    def register(self, fileobj, events, data=None):
+        if fileobj in self.keys:
+            raise KeyError(f"{fileobj!r} is already registered")
+        key = self.keys[fileobj] = selectors.SelectorKey(fileobj, -1, events, data)
+        if events & selectors.EVENT_WRITE:
+            self.writers[fileobj] = key
+        return key
+
+    def modify(self, fileobj, events, data=None):
+        self.unregister(fileobj)
+        return self.register(fileobj, events, data)
+
+    def unregister(self, fileobj):
+        self.writers.pop(fileobj, None)
+        return self.keys.pop(fileobj)
+
+    def select(self, timeout=None):
+        ready = {}
+        for sock in self.ready:
+            key = self.keys.get(sock)
+            if key is not None and key.events & selectors.EVENT_READ:
+                ready[sock] = (key, selectors.EVENT_READ)
+        for sock, key in self.writers.items():
+            if sock.writable():
+                events = ready[sock][1] if sock in ready else 0
+                ready[sock] = (key, events | selectors.EVENT_WRITE)
+
+        self.idle = not ready
+        if self.idle and self.until is not None and timeout != 0:
+            # Wait for the next timer, or until the end of the run if there is none
+            wake = self.until if timeout is None else min(self.clock.now + timeout, self.until)
+            self.clock.now = max(self.clock.now, wake)
+        return list(ready.values())
+
+    def close(self):
+        pass
+
+# A client of a simulation. What the server sends waits in its receive buffer
+# until read() is called, so a client that is not read from is a slow reader
+class SimulatedClient:
+    def __init__(self, sock, nickname=None):
+        self.sock = sock
+        self.nickname = nickname
+        self.reader = protocol.FrameReader(protocol.MAX_DECOMPRESSED_SIZE)
+        self.received = []  # (type, payload) of every message read so far
+        self.disconnected = False  # The server closed the connection
+
+    # Send a frame. Simulated clients never wait to send: what the server does
+    # not read yet stays in its receive buffer
+    def send(self, message):
+        peer = self.sock.peer
+        if not peer.closed:
+            peer.inbox += message
+            peer._mark()
+
+    # Send a line the way a user types it: a command or a chat message
+    def say(self, line):
+        self.send(client.build_message(line))
+
+    # Read up to `size` bytes of what the server sent (all of it by default), and
+    # return the messages they completed. Pings are answered like real clients do
+    def read(self, size=None):
+        messages = []
+        while not self.sock.closed and (size is None or size > 0):
+            try:
+                data = self.sock.recv(size or len(self.sock.inbox) or 1)
+            except BlockingIOError:
+                break
+            except ConnectionResetError:
+                self.disconnected = True
+                break
+            if not data:
+                self.disconnected = True
+                break
+            if size is not None:
+                size -= len(data)
+            self.reader.load(data)
+            for kind, frame in protocol.expand(self.reader.frames()):
+                if kind == protocol.PING:
+                    self.send(protocol.encode(protocol.PONG))
+                messages.append((kind, bytes(protocol.payload(frame))))
+        self.received.extend(messages)
+        return messages
+
+    def close(self):
+        self.sock.close()
+
+    # Disconnect without closing cleanly, the server's next read fails
+    def abort(self):
+        self.sock.abort()
+
+# The select engine of server.py serving simulated clients. Only one runs at a
+# time, in place of a ChatServer, with the same module settings
+class Simulation:
+    def __init__(self, now=0.0):
+        self.clock = VirtualClock(now)
+        self.selector = MemorySelector(self.clock)
+        self.listener = MemoryListener(self.selector.ready)
+        self.clients = []
+        self.saved = None  # What the simulation replaced in the server module
+
+    def start(self):
+        if server.running:
+            raise RuntimeError("A server is already running in this process")
+        self.saved = (server.clock, server.selector, server.server, server.history)
+        server.clock = self.clock
+        server.reset()
+        server.selector = self.selector
+        server.server = self.listener
+        server.history = server.create_history(None)
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        return self
+
+    def stop(self):
+        for sock in list(server.registry.sessions):
+            server.remove(sock)
+        server.clock, server.selector, server.server, server.history = self.saved
+        self.saved = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    # Connect a client, which sends its nickname at once if it has one (it is
+    # read once the server accepted the connection). `capacity` is the size of
+    # its receive buffer
+    def connect(self, nickname=None, color=protocol.DEFAULT_COLOR, features=0, capacity=CAPACITY):
+        simulated = SimulatedClient(self.listener.connect(capacity), nickname)
+        if nickname is not None:
+            simulated.send(protocol.encode_nick(nickname, color, features))
+        self.clients.append(simulated)
+        return simulated
+
+    # Run a single pass of the event loop, without moving the clock
+    def step(self):
+        server.run_once()
+
+    # Run the event loop until there is nothing left to do `seconds` from now.
+    # The clock jumps from one timer to the next in between
+    def run(self, seconds=0):
+        self.selector.until = self.clock.now + seconds
+        try:
+            while True:
+                before = self.clock.now
+                server.run_once()
+                if self.selector.idle and not server.backlog and self.clock.now == before >= self.selector.until:
+                    return
+        finally:
+            self.selector.until = None
+
+    # Read what every client got, returns the number of messages
+    def read_all(self):
+        return sum(len(simulated.read()) for simulated in self.clients)
@@ -0,0 +1,175 @@
+from unittest.mock import patch
+import protocol  # Framing of the messages
+import server
+from simulation import Simulation  # Importing the harness to be tested
+
+def chats(received):
+    """
+    Returns the texts of the chat messages among the messages a client received.
+    """
+    texts = []
+    for kind, payload in received:
+        if kind == protocol.CHAT:
+            nickname, color, text = protocol.decode_sender(payload)
+            texts.append(bytes(text))
+    return texts
+
+# Test 1: Timers fire on the virtual clock, without waiting for them
+def test_timers():
+    """
+    Test case where a client never sends its nickname, one never answers the pings and one
+    does, over 150 simulated seconds. The first two should be dropped when their timers
+    expire, the third one kept, and the clock end where the run did.
+    """
+    with Simulation() as sim:
+        silent = sim.connect()
+        quiet = sim.connect("Quiet")  # Never reads, so never answers
+        alive = sim.connect("Alive")
+        for _ in range(10):
+            sim.run(15)
+            alive.read()
+
+        assert sim.clock.now == 150
+        assert (server.metrics.handshake_timeouts, server.metrics.idle_timeouts) == (1, 1)
+        assert [session.nickname for session in server.registry.sessions.values()] == ["Alive"]
+        quiet.read()
+        silent.read()
+        assert quiet.disconnected and silent.disconnected
+        assert (protocol.PING, b'') in quiet.received
+        assert not alive.disconnected
+
+# Test 2: A client that does not read only slows itself down
+@patch('server.BYTE_RATE', 0)  # No rate limits
+@patch('server.MESSAGE_RATE', 0)
+def test_slow_reader():
+    """
+    Test case where a client with a 4 KiB receive buffer stops reading while another client
+    sends 400 KiB of messages. The writes to it should be partial and then wait, until its
+    outbound buffer overflows and it is disconnected, while the client that reads gets
+    every message in order.
+    """
+    with Simulation() as sim:
+        sender = sim.connect("Sender")
+        reader = sim.connect("Reader")
+        slow = sim.connect("Slow", capacity=4096)
+        sim.run()
+        texts = [f"{index:04d}".encode() * 256 for index in range(400)]
+        for start in range(0, 400, 50):
+            for text in texts[start:start + 50]:
+                sender.send(protocol.encode(protocol.TEXT, text))
+            sim.run()
+            reader.read()
+
+        assert chats(reader.received) == texts
+        assert server.metrics.send_retries > 0
+        assert server.registry.find("Slow") is None
+        slow.read()
+        assert slow.disconnected
+        assert chats(slow.received) == texts[:len(chats(slow.received))]  # A prefix, nothing cut or reordered
+        assert (protocol.LEAVE, protocol.encode_sender("Slow") + bytes([protocol.LEFT])) in reader.received
+
+# Test 3: A client sending a lot does not hold up the others
+@patch('server.BYTE_RATE', 0)  # No rate limits
+@patch('server.MESSAGE_RATE', 0)
+def test_fairness():
+    """
+    Test case where a client sends 1000 messages at once, and another one a single message
+    once the server started on them. The single message should be delivered after a few
+    passes at most, not after all the others.
+    """
+    with Simulation() as sim:
+        flooder = sim.connect("Flooder")
+        polite = sim.connect("Polite")
+        observer = sim.connect("Observer", capacity=None)
+        sim.run()
+        observer.read()
+        for _ in range(1000):
+            flooder.send(protocol.encode(protocol.TEXT, b'x' * 100))
+        sim.step()
+        polite.say("hello")
+        sim.run()
+        observer.read()
+
+        received = chats(observer.received)
+        assert len(received) == 1001
+        assert received.index(b'hello') < 100
+
+# Test 4: Many clients leaving at once
+def test_disconnect_storm():
+    """
+    Test case where 100 of 200 clients drop their connection and 50 leave cleanly at the same
+    time. The others should be told of every departure, and the registry keep just them.
+    """
+    with Simulation() as sim:
+        clients = [sim.connect(f"User{index}") for index in range(200)]
+        sim.run()
+        sim.read_all()
+        for simulated in clients[:100]:
+            simulated.abort()
+        for simulated in clients[100:150]:
+            simulated.close()
+        sim.run()
+
+        assert len(server.registry) == len(server.registry.fanout) == 50
+        assert server.metrics.forced_removals == 100
+        for simulated in clients[150:]:
+            leaves = [payload for kind, payload in simulated.read() if kind == protocol.LEAVE]
+            assert len(leaves) == 150
+
+# Test 5: Ten thousand clients in a thousand rooms
+@patch('server.HISTORY_SIZE', 0)  # Nothing replayed
+def test_scale():
+    """
+    Test case where 10000 clients join 1000 rooms, one client of every room sends a message,
+    then half of the clients leave. Every client should get the message of its room only,
+    and the rooms be told who left.
+    """
+    with Simulation() as sim:
+        clients = [sim.connect(f"User{index}") for index in range(10000)]
+        for index, simulated in enumerate(clients):
+            simulated.say(f"/join room{index % 1000}")
+        sim.run()
+        assert len(server.registry.rooms) == 1000
+        sim.read_all()
+
+        for simulated in clients[:1000]:
+            simulated.say(f"hello from {simulated.nickname}")
+        sim.run()
+        for index, simulated in enumerate(clients[1000:], 1000):
+            assert chats(simulated.read()) == [f"hello from User{index % 1000}".encode()]
+
+        for simulated in clients[5000:]:
+            simulated.close()
+        sim.run()
+        assert len(server.registry) == 5000
+        assert all(len(simulated.read()) == 5 for simulated in clients[:5000])  # 10 per room, half left
+
+# Test 6: The same scenario gives the same result
+@patch('server.BYTE_RATE', 0)  # No rate limits
+@patch('server.MESSAGE_RATE', 0)
+def test_deterministic():
+    """
+    Test case where clients join, chat, read slowly and leave while pings go out, twice. Both
+    runs should give every client the same messages and the server the same counters.
+    """
+    def scenario():
+        with Simulation() as sim:
+            clients = [sim.connect(f"User{index}", capacity=2048 if index % 7 == 0 else 65536) for index in range(300)]
+            for step in range(20):
+                for index, simulated in enumerate(clients):
+                    if (index + step) % 13 == 0:
+                        simulated.say(f"message {step} from {index}" * 20)
+                    if (index * step) % 5 == 0:
+                        simulated.read(1500)
+                if step == 10:
+                    for simulated in clients[::11]:
+                        simulated.close()
+                sim.run(5)
+            counters = {name: getattr(server.metrics, name) for name in ('messages_in', 'messages_out', 'bytes_out',
+                                                                         'send_retries', 'forced_removals', 'pings')}
+            return [simulated.received for simulated in clients], counters
+
+    first, second = scenario(), scenario()
+
+    assert first == second
+    assert first[1]['send_retries'] and first[1]['pings']
@@ -0,0 +1,60 @@
+import math
+
+# Length of a tick of the wheel (seconds): timers fire at most this late
+TICK = 1.0
+
+# Slots of the wheel. Timers due within SLOTS * TICK seconds (8.5 minutes) are
+# only looked at when they expire, later ones also once per turn of the wheel
+SLOTS = 512
+
+# Hashed timer wheel. A timer goes in the slot of the tick it is due, so
+# scheduling, moving and cancelling one are O(1), and every tick only looks at
+# the timers of one slot, however many there are in total
+class TimerWheel:
+    def __init__(self, now, tick=TICK, slots=SLOTS):
+        self.tick = tick
+        self.slots = [{} for _ in range(slots)]  # Item -> tick it is due
+        self.where = {}  # Item -> index of its slot
+        self.current = math.floor(now / tick)  # Last tick expired
+
+    def __len__(self):
+        return len(self.where)
+
+    def __contains__(self, item):
+        return item in self.where
+
+    # Fire `item` once `deadline` (time.monotonic()) has passed, replacing its
+    # previous timer if it had one
+    def schedule(self, item, deadline):
+        self.cancel(item)
+        # Never early, and never in a tick that was already expired
+        due = max(math.ceil(deadline / self.tick), self.current + 1)
+        index = due % len(self.slots)
+        self.slots[index][item] = due
+        self.where[item] = index
+
+    def cancel(self, item):
+        index = self.where.pop(item, None)
+        if index is not None:
+            del self.slots[index][item]
+
+    # Remove and return the items whose deadline has passed
+    def expire(self, now):
+        target = math.floor(now / self.tick)
+        expired = []
+        # After a long pause, a single turn still reaches every slot
+        for due in range(self.current + 1, min(target, self.current + len(self.slots)) + 1):
+            slot = self.slots[due % len(self.slots)]
+            ready = [item for item, item_due in slot.items() if item_due <= target]
+            for item in ready:
+                del slot[item]
+                del self.where[item]
+            expired.extend(ready)
+        self.current = max(self.current, target)
+        return expired
+
+    # Seconds until the next tick, when timers may expire (None if there are none)
+    def next_tick(self, now):
+        if not self.where:
+            return None
+        return max(0.0, (self.current + 1) * self.tick - now)
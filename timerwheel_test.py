@@ -0,0 +1,75 @@
+import pytest
+from timerwheel import TimerWheel  # Importing the timer wheel to be tested
+
+# Test 1: Timers expire once their deadline has passed, never before
+def test_expire():
+    """
+    Test case where timers are scheduled at different times. Each one should be returned
+    by the first expire() at or after its deadline, and only once.
+    """
+    wheel = TimerWheel(now=100, tick=1, slots=8)
+    wheel.schedule('first', 101.5)
+    wheel.schedule('second', 103)
+
+    assert wheel.expire(101.9) == []  # Not due before the end of its tick
+    assert wheel.expire(102) == ['first']
+    assert wheel.expire(102.5) == []
+    assert wheel.expire(103) == ['second']
+    assert len(wheel) == 0
+
+# Test 2: Timers can be moved and cancelled
+def test_reschedule_cancel():
+    """
+    Test case where a timer is moved later and another is cancelled. Only the moved one
+    should expire, at its new deadline.
+    """
+    wheel = TimerWheel(now=0, tick=1, slots=8)
+    wheel.schedule('moved', 2)
+    wheel.schedule('cancelled', 2)
+
+    wheel.schedule('moved', 5)
+    wheel.cancel('cancelled')
+    wheel.cancel('unknown')  # Cancelling what is not scheduled does nothing
+
+    assert wheel.expire(4) == []
+    assert wheel.expire(5) == ['moved']
+
+# Test 3: Deadlines further than a turn of the wheel wait for their turn
+def test_long_deadline():
+    """
+    Test case where a timer is due after more than a full turn of the wheel. It should
+    stay in its slot until the turn it is due in.
+    """
+    wheel = TimerWheel(now=0, tick=1, slots=4)
+    wheel.schedule('later', 10)
+    wheel.schedule('soon', 2)
+
+    assert wheel.expire(6) == ['soon']  # Slot 2 was passed once already
+    assert 'later' in wheel
+    assert wheel.expire(10) == ['later']
+
+# Test 4: A long pause does not lose timers
+def test_long_pause():
+    """
+    Test case where nothing expires the wheel for several turns. Every timer due meanwhile
+    should come out of a single expire(), without going around the wheel more than once.
+    """
+    wheel = TimerWheel(now=0, tick=1, slots=4)
+    for number in range(1, 9):
+        wheel.schedule(number, number)
+
+    assert sorted(wheel.expire(100)) == list(range(1, 9))
+    assert wheel.current == 100
+    assert wheel.next_tick(100) is None  # Nothing left to wait for
+
+# Test 5: The time until the next tick is given while timers are waiting
+def test_next_tick():
+    """
+    Test case where a timer is waiting. The wheel should ask to be expired again at the end
+    of the current tick, and a deadline in the past should be due at that tick.
+    """
+    wheel = TimerWheel(now=10.25, tick=0.5, slots=16)
+    wheel.schedule('past', 3)
+
+    assert wheel.next_tick(10.25) == pytest.approx(0.25)
+    assert wheel.expire(10.5) == ['past']